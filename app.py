@@ -1,43 +1,128 @@
-import os
+import time
+from datetime import datetime
+
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Blueprint, Flask, Response, current_app, render_template, request, flash,
+    abort, redirect, session, g, stream_with_context,
+)
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from wtforms import ValidationError
 
+from availability import init_availability, current_availability, unavailable, explain_conflict, API_FIELDS
+from cache import init_cache, cached, touch
+from compression import init_compression
+from config import Config, get_config
+from export import FORMATS, init_export, export_user
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditProfileForm
-from models import db, connect_db, User, Message, Like, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
-
-load_dotenv()
+from followgraph import init_follow_graph, log_deleted_user, log_follow, UNFOLLOW
+from ingest import CommitPending, init_ingest, current_committer, after_commit, parse_batch, write_messages
+from likes import init_likes, lazy_likes_page
+from loaders import init_loaders, load, load_or_404
+from follows import FOLLOWERS, FOLLOWING, lazy_follow_page
+from partitions import init_partitions, feed_cutoff
+from profiler import init_profiler, current_profiler, authorized as profiler_authorized
+from pubsub import init_pubsub, message_event_data
+from recommendations import init_recommendations
+from replicas import init_replicas
+from search import Cursor, init_search, index_message, unindex_message, find_messages
+from sharding import init_sharding, get_router, queue_user_deletion, sharded_feed
+from slowlog import init_slow_queries
+from streaming import stream_page
+from tags import (
+    init_tags, index_message_tags, unindex_message_tags, decode_cursor,
+    tag_timeline, mentions_timeline,
+)
+from trending import WINDOWS, init_trending, combined_trending, current_trending, record_like
+from views import AuthorView, MessageView, ProfileView, SuggestionView, detach, feed, message as message_view, iter_user_cards, user_messages
+from notifications import FOLLOW, LIKE, init_notifications, mark_seen, notifications_page, notify
+from models import db, connect_db, User, Message, MessageTerm, MessageTag, Mention, Like, Recommendation, StaleRecommendation, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint("warbler", __name__)
+
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+def create_app(config=None, **settings):
+    """Build and return a configured Warbler app.
 
-connect_db(app)
+    `config` is a profile name ("development", "testing", "production") or a
+    Config instance; it defaults to ``$WARBLER_ENV``. Extra keyword
+    `settings` are applied on top of the profile.
+    """
+
+    load_dotenv()
+
+    if not isinstance(config, Config):
+        config = get_config(config)
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(settings)
+
+    if app.config["DEBUG_TB_ENABLED"]:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    init_replicas(app)
+    init_sharding(app)
+    init_pubsub(app)
+    init_follow_graph(app)
+    init_trending(app)
+    init_search(app)
+    init_tags(app)
+    init_availability(app)
+    init_partitions(app)
+    init_likes(app)
+    init_loaders(app)
+    init_cache(app)
+    init_export(app)
+    init_ingest(app)
+    init_compression(app)
+    init_slow_queries(app)
+    init_profiler(app)
+    init_notifications(app)
+    init_recommendations(app)
+    app.register_blueprint(bp)
+
+    if app.config["WARM_UP_TEMPLATES"]:
+        warm_up(app)
+
+    return app
+
+
+def warm_up(app):
+    """Compile every template into the Jinja cache.
+
+    Run before workers accept traffic (in the gunicorn master when using
+    ``--preload``), so the first requests don't pay for template compilation.
+    """
+
+    env = app.jinja_env
+
+    for name in env.list_templates(extensions=["html"]):
+        env.get_template(name)
 
 
 ##############################################################################
 # User signup/login/logout
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load(User, session[CURR_USER_KEY])
         g.csrf_form = CSRFProtectForm()
     else:
         g.user = None
 
 
-@app.before_request
+@bp.before_app_request
 def add_csrf_form_to_g():
     """add the csrf form to Flask global"""
     g.csrf_form = CSRFProtectForm()
@@ -56,7 +141,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -64,8 +149,8 @@ def signup():
 
     If form not valid, present form.
 
-    If the there already is a user with that username: flash message
-    and re-present form.
+    If the username or email is already taken: show the error on that field
+    and re-present form (checked before the password is hashed).
     """
 
     do_logout()
@@ -73,6 +158,9 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        if unavailable(form):
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -83,7 +171,11 @@ def signup():
             db.session.commit()
 
         except IntegrityError:
-            flash("Username already taken", 'danger')
+            db.session.rollback()
+
+            if not explain_conflict(form):
+                flash("Username or email already taken", 'danger')
+
             return render_template('users/signup.html', form=form)
 
         do_login(user)
@@ -94,7 +186,25 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.get('/api/availability')
+def check_availability():
+    """Is ?username= free? e.g. {"username": true}
+
+    A logged-in user's own username counts as free (for the edit profile
+    form). Emails aren't answered, so this can't reveal who has an account.
+    """
+
+    index = current_availability()
+    user_id = g.user.id if g.user else None
+
+    return {
+        field: index.is_available(field, request.args[field], user_id)
+        for field in API_FIELDS
+        if request.args.get(field)
+    }
+
+
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -116,7 +226,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -139,7 +249,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
 def list_users():
     """Page with listing of users.
 
@@ -152,15 +262,12 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = iter_user_cards(search)
 
-    return render_template('users/index.html', users=users, form=g.csrf_form)
+    return stream_page('users/index.html', users=users, form=g.csrf_form)
 
 
-@app.get('/users/<int:user_id>')
+@bp.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
 
@@ -168,14 +275,22 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    def profile():
+        user = load_or_404(User, user_id)
+        return ProfileView(user), user_messages(user.id)
 
-    liked_messages = g.user.liked_messages
+    user, messages = cached(f"profile:{user_id}", profile,
+                            depends=[f"user:{user_id}"])
+    liked_ids = {like.message_id for like in g.user.likes}
 
-    return render_template('users/show.html', user=user, liked=liked_messages, form=g.csrf_form)
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           liked=liked_ids,
+                           form=g.csrf_form)
 
 
-@app.get('/users/<int:user_id>/following')
+@bp.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -183,11 +298,15 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user, form=g.csrf_form)
+    user = load_or_404(User, user_id)
+    cards = lazy_follow_page(
+        user.id, FOLLOWING, g.user.id, request.args.get('after', 0, type=int))
+
+    return stream_page('users/following.html', user=user, cards=cards,
+                       form=g.csrf_form)
 
 
-@app.get('/users/<int:user_id>/followers')
+@bp.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -195,11 +314,15 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user, form=g.csrf_form)
+    user = load_or_404(User, user_id)
+    cards = lazy_follow_page(
+        user.id, FOLLOWERS, g.user.id, request.args.get('after', 0, type=int))
 
+    return stream_page('users/followers.html', user=user, cards=cards,
+                       form=g.csrf_form)
 
-@app.post('/users/follow/<int:follow_id>')
+
+@bp.post('/users/follow/<int:follow_id>')
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
@@ -211,16 +334,21 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = load_or_404(User, follow_id)
     g.user.following.append(followed_user)
+    StaleRecommendation.mark(g.user.id)
     db.session.commit()
 
+    log_follow(g.user.id, followed_user.id)
+    touch(f"user:{g.user.id}", f"user:{followed_user.id}")
+    notify(FOLLOW, followed_user.id, followed_user.id, g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
     # TODO: refactor all of the if not g.user or not form.validate_on_submit():
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
@@ -233,14 +361,18 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = load_or_404(User, follow_id)
     g.user.following.remove(followed_user)
+    StaleRecommendation.mark(g.user.id)
     db.session.commit()
 
+    log_follow(g.user.id, followed_user.id, UNFOLLOW)
+    touch(f"user:{g.user.id}", f"user:{followed_user.id}")
+
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def edit_profile():
     """Update profile for current user and return to user detail"""
 
@@ -251,6 +383,9 @@ def edit_profile():
     form = EditProfileForm(obj=g.user)
 
     if form.validate_on_submit():
+        if unavailable(form, g.user.id):
+            return render_template('users/edit.html', form=form)
+
         user = User.authenticate(
             g.user.username,
             form.password.data,
@@ -264,7 +399,18 @@ def edit_profile():
             g.user.bio = form.bio.data
             g.user.location = form.location.data
 
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+                if not explain_conflict(form, g.user.id):
+                    flash("Username or email already taken", 'danger')
+
+                return render_template('users/edit.html', form=form)
+
+            touch(f"user:{g.user.id}")
+
             return redirect(f'/users/{g.user.id}')
 
         else:
@@ -275,7 +421,7 @@ def edit_profile():
         return render_template('users/edit.html', form=form)
 
 
-@app.post('/users/delete')
+@bp.post('/users/delete')
 def delete_user():
     """Delete user and redirect to signup page."""
 
@@ -285,20 +431,73 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # Their follows, and likes of their messages, change other users' counts.
+    user_id = g.user.id
+    following = g.user.following_ids()
+    followers = [user.id for user in g.user.followers]
+    own_messages = select(Message.id).where(Message.user_id == g.user.id)
+    likers = db.session.scalars(
+        select(Like.user_id).where(Like.message_id.in_(own_messages))).all()
+    affected = {user_id, *following, *followers, *likers}
+
+    # Bulk deletes skip the ORM, so the shards are told separately.
+    queue_user_deletion(g.user.id)
+    Like.query.filter(
+        (Like.user_id == g.user.id) | Like.message_id.in_(own_messages)
+    ).delete(synchronize_session=False)
+
+    # SQLite doesn't enforce ON DELETE CASCADE, so the search and tag
+    # index rows would outlive their messages.
+    for index in (MessageTerm, MessageTag, Mention):
+        index.query.filter(index.message_id.in_(own_messages)).delete(
+            synchronize_session=False)
+
     Message.query.filter_by(user_id=g.user.id).delete()
 
     db.session.delete(g.user)
     db.session.commit()
 
+    log_deleted_user(user_id, following, followers)
+    touch(*(f"user:{affected_id}" for affected_id in affected))
+
     do_logout()
 
     return redirect("/signup")
 
 
+@bp.get('/users/export')
+def export_data():
+    """Download all of the current user's data (``?format=ndjson|csv``).
+
+    Streamed as it is read (see export.py).
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+
+    if fmt not in FORMATS:
+        abort(400)
+
+    # stream_with_context keeps the request (and its DB session) open
+    # until the last chunk is sent.
+    body = export_user(db.session.execute, g.user.id, fmt)
+
+    return Response(stream_with_context(body),
+                    mimetype=FORMATS[fmt],
+                    headers={
+                        "Content-Disposition":
+                            f'attachment; filename="warbler-{g.user.id}.{fmt}"',
+                        "X-Accel-Buffering": "no",
+                    })
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """
     Add a message:
@@ -315,16 +514,147 @@ def add_message():
 # TODO: HELP!!!
 # ASK ABOUT THIS
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        committer = current_committer()
+
+        if committer:
+            # Committed together with other concurrent posts (see ingest.py),
+            # on the writer's connection: hand ours back to the pool first.
+            user_id = g.user.id
+            author = AuthorView(user_id, g.user.username, g.user.image_url)
+            db.session.commit()
+            db.session.info["wrote"] = True
+
+            try:
+                row = committer.submit(user_id, {"text": form.text.data,
+                                                 "timestamp": datetime.utcnow()})
+            except CommitPending as slow:
+                # The writer may still commit it: finish the post then, and
+                # don't report a failure the user would retry as a duplicate.
+                slow.pending.then(finish_late_post(author))
+                flash("Your message is taking a while to post. It will "
+                      "appear shortly.", "warning")
+
+                return redirect(f"/users/{user_id}")
+
+            after_commit([row])
+            msg = MessageView(*row, author)
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            index_message(msg)
+            index_message_tags(msg)
+            db.session.commit()
+            touch(f"user:{g.user.id}")
+
+        timeline_bus().publish("message", g.user.id, message_event_data(msg))
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+def finish_late_post(author):
+    """Callback for a post the group committer finished after its request
+    gave up waiting: run what ``add_message`` would have, or log the failure.
+
+    Runs on the writer thread, so it pushes its own app context.
+    """
+
+    app = current_app._get_current_object()
+
+    def finish(row, error):
+        with app.app_context():
+            if error is not None:
+                app.logger.error("late post by user %s failed: %s",
+                                 author.id, error)
+                return
+
+            try:
+                after_commit([row])
+                timeline_bus().publish(
+                    "message", author.id,
+                    message_event_data(MessageView(*row, author)))
+            except Exception:
+                app.logger.exception("finishing late post %s failed", row.id)
+
+    return finish
+
+
+@bp.post('/messages/bulk')
+def bulk_add_messages():
+    """Post a batch of messages: an NDJSON body, one {"text": ...} per line.
+
+    All or nothing: any invalid line fails the batch with a 400 listing the
+    errors. Send the CSRF token in an X-CSRFToken header.
+    """
+
+    if not g.user:
+        return {"error": "login required"}, 401
+
+    if current_app.config.get("WTF_CSRF_ENABLED", True):
+        try:
+            validate_csrf(request.headers.get("X-CSRFToken"))
+        except ValidationError:
+            return {"error": "bad CSRF token"}, 400
+
+    # Refuse an oversized body before reading any of it.
+    if request.content_length is None:
+        return {"error": "Content-Length required"}, 411
+
+    if request.content_length > current_app.config["INGEST_MAX_BYTES"]:
+        return {"error": f"at most {current_app.config['INGEST_MAX_BYTES']} "
+                         "bytes per batch"}, 413
+
+    lines = request.get_data(as_text=True).splitlines()
+
+    if len(lines) > current_app.config["INGEST_MAX_BATCH"]:
+        return {"error": f"at most {current_app.config['INGEST_MAX_BATCH']} "
+                         "messages per batch"}, 413
+
+    messages, errors = parse_batch(lines)
+
+    if errors:
+        return {"errors": [{"line": number, "error": error}
+                           for number, error in errors]}, 400
+
+    rows = write_messages(db.session.connection(), g.user.id, messages)
+    db.session.commit()
+    db.session.info["wrote"] = True
+    after_commit(rows)
+
+    bus = timeline_bus()
+
+    for row in rows:
+        bus.publish("message", g.user.id,
+                    message_event_data(MessageView(*row, g.user)))
+
+    return {"posted": len(rows), "ids": [row.id for row in rows]}, 201
+
+
+@bp.get('/messages/search')
+def search_messages():
+    """Full-text search of messages (see search.py).
+
+    Takes the query in 'q' and the page position in 'cursor'.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    q = request.args.get("q", "")
+    cursor = Cursor.decode(request.args.get("cursor", ""))
+
+    messages, next_cursor = find_messages(q, cursor=cursor)
+
+    return render_template('messages/search.html',
+                            q=q,
+                            messages=messages,
+                            next_cursor=next_cursor and next_cursor.encode(),
+                            form=g.csrf_form)
+
+
+@bp.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
@@ -332,18 +662,27 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    def message():
+        found = message_view(message_id)
+
+        if found is None:
+            abort(404)
 
-    liked_messages = set(g.user.liked_messages)
+        return found
+
+    msg = cached(f"message:{message_id}", message,
+                 depends=lambda msg: [f"message:{msg.id}", f"user:{msg.user_id}"])
+
+    liked_ids = {like.message_id for like in g.user.likes}
 
     return render_template('messages/show.html',
                             user = g.user,
                             message=msg,
-                            liked = liked_messages,
+                            liked = liked_ids,
                             form=g.csrf_form)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@bp.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -357,19 +696,25 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    message = load_or_404(Message, message_id)
 
     if g.user.id != message.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    unindex_message(message.id)
+    unindex_message_tags(message.id)
     db.session.delete(message)
     db.session.commit()
 
+    timeline_bus().publish("delete", g.user.id, {"id": message_id})
+    current_trending().forget(message_id)
+    touch(f"message:{message_id}", f"user:{g.user.id}")
+
     return redirect(f"/users/{g.user.id}")
 
 
-@app.post('/messages/<int:message_id>/like')
+@bp.post('/messages/<int:message_id>/like')
 def like_message(message_id):
 
     """
@@ -382,17 +727,23 @@ def like_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    message = load_or_404(Message, message_id)
 
-    like = Like(user_id=g.user.id, message_id=message.id)
+    like = Like(user_id=g.user.id, message_id=message.id,
+                message_timestamp=message.timestamp)
 
     db.session.add(like)
+    StaleRecommendation.mark(g.user.id)
     db.session.commit()
 
+    record_like(message.id)
+    touch(f"user:{g.user.id}")
+    notify(LIKE, message.user_id, message.id, g.user.id)
+
     return redirect("/")
 
 
-@app.post('/messages/<int:message_id>/unlike')
+@bp.post('/messages/<int:message_id>/unlike')
 def unlike_message(message_id):
     """
     unlikes a message, deletes like from database, redirects to homepage
@@ -407,13 +758,17 @@ def unlike_message(message_id):
     like = Like.query.filter_by(user_id=g.user.id, message_id=message_id).first()
 
     db.session.delete(like)
+    StaleRecommendation.mark(g.user.id)
     db.session.commit()
 
+    record_like(message_id, -1)
+    touch(f"user:{g.user.id}")
+
     return redirect("/")
 
-@app.get("/users/<int:user_id>/likes")
+@bp.get("/users/<int:user_id>/likes")
 def display_liked_messages(user_id):
-    """displays all of the clicked on users liked messages"""
+    """displays the clicked on user's liked messages, most recent like first"""
 
     form = g.csrf_form
 
@@ -421,17 +776,195 @@ def display_liked_messages(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = load_or_404(User, user_id)
+
+    likes = lazy_likes_page(
+        user.id, before=decode_cursor(request.args.get("before", "")))
+
+    return stream_page('users/likes.html', likes=likes, user=user, form=form)
+
+
+@bp.get('/trending')
+def show_trending():
+    """Most-liked messages of the last hour (or ``?window=day``).
+
+    Counts come from the trending aggregator (see trending.py), not from
+    the likes table.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    window = request.args.get("window", "hour")
+
+    if window not in WINDOWS:
+        window = "hour"
+
+    top = combined_trending().top(window)
+    messages = {
+        msg.id: msg
+        for msg in Message.query
+        .filter(Message.id.in_([message_id for message_id, _ in top]))
+        .options(db.selectinload(Message.user))
+    }
+
+    trending = [
+        (messages[message_id], count)
+        for message_id, count in top
+        if message_id in messages
+    ]
+
+    return render_template('messages/trending.html',
+                            trending=trending,
+                            window=window,
+                            windows=WINDOWS,
+                            form=g.csrf_form)
 
-    liked_messages = user.liked_messages
+@bp.get('/tags/<tag>')
+def show_tag(tag):
+    """Messages tagged #tag, newest first; older pages via 'before'."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, next_cursor = tag_timeline(
+        tag, before=decode_cursor(request.args.get("before", "")))
+
+    return render_template('messages/timeline.html',
+                            title=f"#{tag.lower()}",
+                            messages=messages,
+                            next_cursor=next_cursor,
+                            form=g.csrf_form)
+
+
+@bp.get('/mentions')
+def show_mentions():
+    """Messages mentioning the current user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages, next_cursor = mentions_timeline(
+        g.user.id, before=decode_cursor(request.args.get("before", "")))
+
+    return render_template('messages/timeline.html',
+                            title=f"Mentions of @{g.user.username}",
+                            messages=messages,
+                            next_cursor=next_cursor,
+                            form=g.csrf_form)
+
+
+@bp.get('/notifications')
+def show_notifications():
+    """The current user's notifications, most recently active first.
+
+    Opening the page marks everything as seen.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    seen_at = mark_seen(g.user.id)
+    g.unread_notifications = 0
+    notifications, next_cursor = notifications_page(
+        g.user.id, before=decode_cursor(request.args.get("before", "")),
+        seen_at=seen_at)
+
+    return render_template('users/notifications.html',
+                           notifications=notifications,
+                           next_cursor=next_cursor,
+                           form=g.csrf_form)
+
+##############################################################################
+# Live timeline
+
+
+def timeline_bus():
+    """The current app's pub/sub bus (see pubsub.py)."""
+
+    return current_app.extensions["timeline_bus"]
+
+
+@bp.get('/stream')
+def stream_timeline():
+    """Server-Sent Events stream of new/deleted messages for the homepage.
+
+    Covers the same authors as the homepage feed. Reconnecting clients send
+    Last-Event-ID and are caught up from the bus, not the database. Each
+    stream holds a worker thread, so it is off unless ``STREAM_ENABLED``
+    (see wsgi.py), and is closed after ``STREAM_MAX_SECONDS`` for the
+    client to reconnect.
+    """
+
+    if not current_app.config.get("STREAM_ENABLED"):
+        abort(404)
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    author_ids = g.user.following_ids()
+    author_ids.append(g.user.id)
+
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    heartbeat = current_app.config["STREAM_HEARTBEAT_SECONDS"]
+    deadline = time.monotonic() + current_app.config["STREAM_MAX_SECONDS"]
+
+    bus = timeline_bus()
+    subscription = bus.subscribe(author_ids, last_event_id)
+
+    # The generator outlives the request, so it must not touch g or the DB.
+    def events():
+        try:
+            yield f"retry: {heartbeat * 1000}\n\n"
+
+            if subscription.stale:
+                yield "event: reload\ndata: {}\n\n"
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                event = subscription.get(timeout=min(heartbeat, remaining))
+                yield event.to_sse() if event else ": heartbeat\n\n"
+        finally:
+            bus.unsubscribe(subscription)
+
+    return Response(events(),
+                    mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+##############################################################################
+# Operations
+
+
+@bp.post('/_profile')
+def start_profile():
+    """Sample this worker's requests for ?seconds=N (operators only).
+
+    Stacks are written to the returned path when the run ends.
+    """
+
+    if not profiler_authorized():
+        abort(404)
+
+    seconds = min(request.args.get("seconds", 10, type=float),
+                  current_app.config["PROFILER_MAX_SECONDS"])
+    path = current_profiler().start(seconds)
+
+    if path is None:
+        return {"error": "this worker is already profiling"}, 409
+
+    return {"path": path, "seconds": seconds}, 202
 
-    return render_template('users/likes.html', messages=liked_messages, user=user, form=form)
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.get('/')
+@bp.get('/')
 def homepage():
     """Show homepage:
 
@@ -440,22 +973,40 @@ def homepage():
     """
 
     if g.user:
-        # following lines create list of all ID for which to render messages
-        following_ids = [f.id for f in g.user.following]
-        following_ids.append(g.user.id)
+        user_id = g.user.id
+
+        def home():
+            # following lines create list of all ID for which to render messages
+            following_ids = g.user.following_ids()
+            following_ids.append(user_id)
+
+            router = get_router()
+
+            if router:
+                messages = detach(sharded_feed(following_ids, limit=100))
+                liked_by_curr_user = router.liked_message_ids(user_id)
+
+            else:
+                # feed_cutoff() lets Postgres skip the archived partitions.
+                messages = feed(following_ids, limit=100, since=feed_cutoff())
+
+                liked_by_curr_user = {liked.message_id for liked in g.user.likes}
+
+            suggestions = [SuggestionView(recommendation) for recommendation
+                           in Recommendation.for_user(user_id)]
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+            return following_ids, messages, liked_by_curr_user, suggestions
 
-        liked_by_curr_user = {liked.message_id for liked in g.user.likes}
+        # A refresh with nothing new is served from the cache: posts, likes
+        # and follows touch() the authors' and this user's versions.
+        _, messages, liked_by_curr_user, suggestions = cached(
+            f"home:{user_id}", home,
+            depends=lambda value: [f"user:{author_id}" for author_id in value[0]])
 
         return render_template('home.html',
                                 messages=messages,
                                 liked=liked_by_curr_user,
+                                suggestions=suggestions,
                                 user=g.user,
                                 form=g.csrf_form)
 
@@ -463,7 +1014,7 @@ def homepage():
         return render_template('home-anon.html')
 
 
-@app.after_request
+@bp.after_app_request
 def add_header(response):
     """Add non-caching headers on every request."""
 
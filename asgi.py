@@ -0,0 +1,12 @@
+"""ASGI entry point.
+
+    WARBLER_ENV=production uvicorn asgi:app --workers 4
+
+Serves ``/``, ``/messages/<id>`` and ``/users/<id>`` with async handlers (see
+async_app.py) and everything else through the sync Flask app.
+"""
+
+from app import create_app
+from async_app import create_asgi_app
+
+app = create_asgi_app(create_app())
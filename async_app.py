@@ -0,0 +1,294 @@
+"""Async (ASGI) serving path for Warbler's hot read endpoints.
+
+``homepage``, ``show_message`` and ``show_user`` run as coroutines on an
+async SQLAlchemy session, so a worker waiting on the database can serve
+other requests meanwhile. Every other route is passed through to the
+regular Flask app, and the same models and templates are used throughout.
+
+Templates still expect Flask's ``g``, ``session``, CSRF forms and flashed
+messages, so each async request runs inside a Flask request context (these
+are contextvars, so they are private to the request's task). Nothing may
+lazy-load under asyncio, so pages are built from the same column-only
+queries as the sync views (views.py), and ``g.user`` is a ``CurrentUser``
+holding just the counts and ids the templates check.
+
+The app's ``after_request`` hooks run as usual (``process_response``), but
+its ``before_request`` hooks do not, since several would query the database
+synchronously. Their async equivalents are applied here instead:
+
+* replica routing (replicas.py): reads go to an async engine for the bind
+  ``pick_replica()`` chooses, so writers still read their own writes;
+* ``g.user`` and the CSRF form: ``load_current_user`` and ``run_view``;
+* slow-query logging (slowlog.py): the recorder is attached to the async
+  engines too, and tags entries with the route as usual;
+* request loaders (loaders.py): reset per request, though these views
+  never call them.
+
+The per-request profiler (``X-Profile``, profiler.py) samples the thread
+serving a request, and every async request shares the event loop's thread,
+so it only applies to the sync routes; the whole-process profiler still
+covers both.
+"""
+
+from flask import g, session, flash, redirect, render_template
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException, NotFound
+
+from app import CURR_USER_KEY
+from forms import CSRFProtectForm
+from loaders import _reset as reset_loaders
+from models import db, Follow, Like, Recommendation
+from notifications import unread_count_query
+from partitions import feed_cutoff
+from replicas import pick_replica
+from sharding import get_router, sharded_feed
+from views import (
+    ProfileView, feed_query, message_query, message_views, profile_query,
+    user_messages_query,
+)
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+class CurrentUser:
+    """``g.user`` for async requests: the logged-in user's profile fields and
+    counts, plus the ids of who they follow and what they've liked.
+
+    Has the ``User`` methods the templates and views call.
+    """
+
+    __slots__ = (*ProfileView.__slots__, "header_image_url", "_following",
+                 "liked_ids")
+
+    def __init__(self, row, following, liked_ids):
+        for name in ProfileView.__slots__ + ("header_image_url",):
+            setattr(self, name, getattr(row, name))
+
+        self._following = set(following)
+        self.liked_ids = set(liked_ids)
+
+    def following_ids(self):
+        return list(self._following)
+
+    def is_following(self, other_user):
+        return other_user.id in self._following
+
+
+def async_database_url(url):
+    """Swap the sync driver in `url` for its asyncio equivalent."""
+
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def create_asgi_app(flask_app):
+    """Wrap `flask_app` in an ASGI app with async versions of the hot routes."""
+
+    # The primary (None) and each replica bind, as configured for Flask.
+    with flask_app.app_context():
+        urls = {bind: db.engines[bind].url
+                for bind in [None, *flask_app.config.get("REPLICA_BINDS", [])]}
+
+    recorder = flask_app.extensions.get("slow_queries")
+    engines = {}
+
+    for bind, url in urls.items():
+        engines[bind] = create_async_engine(
+            async_database_url(url),
+            **flask_app.config.get("ASYNC_ENGINE_OPTIONS", {}),
+        )
+
+        if recorder:
+            recorder.attach(engines[bind].sync_engine)
+
+    sessionmakers = {bind: async_sessionmaker(engine, expire_on_commit=False)
+                     for bind, engine in engines.items()}
+
+    async def dispose():
+        for engine in engines.values():
+            await engine.dispose()
+
+    def endpoint(view):
+        async def handle(request):
+            return await run_view(flask_app, sessionmakers, view, request)
+
+        return handle
+
+    asgi_app = Starlette(
+        routes=[
+            Route("/", endpoint(homepage)),
+            Route("/messages/{message_id:int}", endpoint(show_message)),
+            Route("/users/{user_id:int}", endpoint(show_user)),
+            Mount("/", WSGIMiddleware(flask_app)),
+        ],
+        on_shutdown=[dispose],
+    )
+    asgi_app.state.flask_app = flask_app
+    asgi_app.state.engine = engines[None]
+    asgi_app.state.engines = engines
+
+    return asgi_app
+
+
+async def run_view(flask_app, sessionmakers, view, request):
+    """Run async `view` inside a Flask request context built from `request`.
+
+    Mirrors Flask's request handling: the session cookie is opened on the
+    way in and saved (with after_request hooks) on the way out, and reads
+    go to the replica (or primary) that ``pick_replica`` chooses.
+    """
+
+    ctx = flask_app.test_request_context(
+        request.url.path,
+        base_url=f"{request.url.scheme}://{request.url.netloc}",
+        query_string=request.url.query,
+        method=request.method,
+        headers=[(k.decode("latin-1"), v.decode("latin-1"))
+                 for k, v in request.headers.raw],
+    )
+    ctx.push()
+
+    try:
+        reset_loaders()
+
+        async with sessionmakers[pick_replica()]() as db_session:
+            g.user = await load_current_user(db_session)
+            g.csrf_form = CSRFProtectForm()
+
+            try:
+                rv = await view(db_session, **request.path_params)
+            except HTTPException as e:
+                rv = e
+
+        response = flask_app.process_response(flask_app.make_response(rv))
+    finally:
+        ctx.pop()
+
+    asgi_response = Response(
+        response.get_data(), status_code=response.status_code)
+    asgi_response.raw_headers = [
+        (k.lower().encode("latin-1"), v.encode("latin-1"))
+        for k, v in response.headers.items()
+    ]
+
+    return asgi_response
+
+
+async def load_current_user(db_session):
+    """Async version of ``add_user_to_g``."""
+
+    if CURR_USER_KEY not in session:
+        return None
+
+    user_id = session[CURR_USER_KEY]
+    row = (await db_session.execute(profile_query(user_id))).first()
+
+    if row is None:
+        return None
+
+    following = await db_session.scalars(
+        select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == user_id))
+    liked = await db_session.scalars(
+        select(Like.message_id).where(Like.user_id == user_id))
+
+    # For the nav badge; the sync lookup would block the event loop.
+    g.unread_notifications = (
+        await db_session.scalar(unread_count_query(user_id))) or 0
+
+    return CurrentUser(row, following, liked)
+
+
+async def first_or_404(db_session, query):
+    row = (await db_session.execute(query)).first()
+
+    if row is None:
+        raise NotFound()
+
+    return row
+
+
+##############################################################################
+# Async views: same behaviour and templates as their sync counterparts
+
+
+async def homepage(db_session):
+    """Show homepage (see ``app.homepage``)."""
+
+    if not g.user:
+        return render_template('home-anon.html')
+
+    following_ids = g.user.following_ids()
+    following_ids.append(g.user.id)
+
+    router = get_router()
+
+    if router:
+        # The shard engines are sync; keep them off the event loop.
+        messages = await run_in_threadpool(sharded_feed, following_ids, 100)
+        liked_by_curr_user = await run_in_threadpool(
+            router.liked_message_ids, g.user.id)
+
+    else:
+        messages = message_views(await db_session.execute(
+            feed_query(following_ids, limit=100, since=feed_cutoff())))
+        liked_by_curr_user = g.user.liked_ids
+
+    suggestions = (await db_session.scalars(
+        Recommendation.for_user_query(g.user.id))).all()
+
+    return render_template('home.html',
+                           messages=messages,
+                           liked=liked_by_curr_user,
+                           suggestions=suggestions,
+                           user=g.user,
+                           form=g.csrf_form)
+
+
+async def show_user(db_session, user_id):
+    """Show user profile (see ``app.show_user``)."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = ProfileView(await first_or_404(db_session, profile_query(user_id)))
+    messages = message_views(
+        await db_session.execute(user_messages_query(user_id)))
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           liked=g.user.liked_ids,
+                           form=g.csrf_form)
+
+
+async def show_message(db_session, message_id):
+    """Show a message (see ``app.show_message``)."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    found = message_views(await db_session.execute(message_query(message_id)))
+
+    if not found:
+        raise NotFound()
+
+    msg = found[0]
+
+    return render_template('messages/show.html',
+                           user=g.user,
+                           message=msg,
+                           liked=g.user.liked_ids,
+                           form=g.csrf_form)
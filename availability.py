@@ -0,0 +1,431 @@
+"""Username and email availability, answered from a Bloom filter.
+
+Every worker keeps a Bloom filter of the usernames and emails in ``users``.
+A name the filter has never seen is certainly free, so most checks (and every
+check for a fresh name during a spam burst) never touch the database; a
+possible hit is confirmed with a lookup on the column's unique index. Names
+are compared exactly, as the unique constraints and login compare them.
+Signup and profile edits check here *before* hashing the password.
+
+The filter is built from the table at startup (with ``AVAILABILITY_PRELOAD``)
+or else on a background thread the first time it is needed; until it is
+ready every check is a lookup. It is
+kept current by mapper events on ``User``, so any insert or rename in this
+process is added at flush time. Signups made by other workers are picked up
+every ``AVAILABILITY_SYNC_SECONDS`` (users with a higher id than we have
+seen), and the whole filter is rebuilt in the background every
+``AVAILABILITY_REBUILD_SECONDS`` or once it is over capacity, so no request
+waits on the full scan. Bloom filters can't forget, so deleted and
+renamed-away names stay as possible hits (one extra lookup each) until that
+rebuild.
+
+Only usernames (which the user directory shows anyway) can be checked through
+``/api/availability``; emails are checked on submit, so the endpoint can't be
+used to find out who has an account.
+
+The unique constraints on ``users`` still decide races; the filter only
+saves work.
+"""
+
+import hashlib
+import math
+import random
+import string
+import threading
+import time
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, User
+
+FIELDS = ("username", "email")
+
+# What /api/availability will answer for anyone who asks.
+API_FIELDS = ("username",)
+
+MESSAGES = {
+    "username": "Username already taken",
+    "email": "Email already registered",
+}
+
+
+##############################################################################
+# Bloom filter
+
+
+class BloomFilter:
+    """Bloom filter sized for `capacity` keys at `error_rate` false positives.
+
+    Uses double hashing over one 128-bit blake2b digest per key.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def fill_ratio(self):
+        return sum(bin(byte).count("1") for byte in self.bits) / self.size
+
+    def expected_error_rate(self):
+        """False-positive rate implied by the bits actually set."""
+
+        return self.fill_ratio() ** self.hashes
+
+
+def key(field, value):
+    return f"{field}:{value}"
+
+
+##############################################################################
+# Availability index
+
+
+class AvailabilityIndex:
+    """A BloomFilter over ``users`` plus the bookkeeping to keep it fresh."""
+
+    def __init__(self, error_rate=0.01, sync_seconds=2, rebuild_seconds=3600,
+                 background=True, clock=time.monotonic):
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.background = background
+        self.clock = clock
+
+        self.filter = None
+        self.max_id = 0
+        self.stale = 0
+        self.built_at = self.synced_at = 0
+        self._pending = None
+        self._building = False
+        self._lock = threading.Lock()
+
+        self.checks = self.possible_hits = self.false_positives = 0
+
+    # Building
+
+    def build(self):
+        """Rebuild the filter from ``users``."""
+
+        with self._lock:
+            self._pending = []
+
+        users = db.session.execute(
+            select(func.count()).select_from(User)).scalar()
+        rows = db.session.execute(
+            select(User.id, User.username, User.email)
+            .execution_options(yield_per=10000))
+
+        # Room to double before the next rebuild.
+        bloom = BloomFilter(max(2 * users, 10000) * len(FIELDS),
+                            self.error_rate)
+        max_id = 0
+
+        for user_id, username, email in rows:
+            bloom.add(key("username", username))
+            bloom.add(key("email", email))
+            max_id = max(max_id, user_id)
+
+        with self._lock:
+            # Keys flushed while we were reading may be missing from `rows`.
+            for pending in self._pending:
+                bloom.add(pending)
+
+            self.filter = bloom
+            self.max_id = max(max_id, self.max_id)
+            self.stale = 0
+            self.built_at = self.synced_at = self.clock()
+            self._pending = None
+            self.checks = self.possible_hits = self.false_positives = 0
+
+    def sync(self):
+        """Add users created since the last build or sync (by other workers)."""
+
+        rows = db.session.execute(
+            select(User.id, User.username, User.email)
+            .where(User.id > self.max_id)
+        ).all()
+
+        for user_id, username, email in rows:
+            self.add_user(user_id, username, email)
+
+        self.synced_at = self.clock()
+
+    def build_in_background(self):
+        """Start a build on its own thread (and app context), unless one is
+        already running."""
+
+        with self._lock:
+            if self._building:
+                return
+
+            self._building = True
+
+        app = current_app._get_current_object()
+
+        def run():
+            try:
+                with app.app_context():
+                    self.build()
+            except Exception:
+                app.logger.exception("availability filter build failed")
+            finally:
+                with self._lock:
+                    self._building = False
+
+        threading.Thread(
+            target=run, name="availability-build", daemon=True).start()
+
+    def refresh(self):
+        """Start a build or rebuild, and sync, whichever is due."""
+
+        now = self.clock()
+        bloom = self.filter
+
+        if (bloom is None
+                or now - self.built_at >= self.rebuild_seconds
+                or bloom.count + self.stale > bloom.capacity):
+            if self.background:
+                self.build_in_background()
+            else:
+                self.build()
+
+        if (self.filter is not None
+                and self.clock() - self.synced_at >= self.sync_seconds):
+            self.sync()
+
+    # Keeping current
+
+    def add(self, field, value):
+        entry = key(field, value)
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(entry)
+
+            if self.filter is not None:
+                self.filter.add(entry)
+
+    def add_user(self, user_id, username, email):
+        self.add("username", username)
+        self.add("email", email)
+
+        if user_id is not None:
+            self.max_id = max(self.max_id, user_id)
+
+    def forget(self, count=1):
+        """Note names that no longer exist (cleared at the next rebuild)."""
+
+        self.stale += count
+
+    # Checking
+
+    def lookup(self, field, value):
+        """Id of the user whose `field` is `value`, or None."""
+
+        column = getattr(User, field)
+
+        return db.session.execute(
+            select(User.id).where(column == value)
+        ).scalar()
+
+    def is_available(self, field, value, user_id=None):
+        """Is `value` free for `field`? `user_id`'s own value counts as free."""
+
+        self.refresh()
+        bloom = self.filter
+
+        if bloom is None:
+            # The first build is still running.
+            owner = self.lookup(field, value)
+            return owner is None or owner == user_id
+
+        self.checks += 1
+
+        if key(field, value) not in bloom:
+            return True
+
+        self.possible_hits += 1
+        owner = self.lookup(field, value)
+
+        if owner is None:
+            self.false_positives += 1
+
+        return owner is None or owner == user_id
+
+    def stats(self):
+        bloom = self.filter
+        free = self.checks - (self.possible_hits - self.false_positives)
+
+        return {
+            "keys": bloom.count if bloom else 0,
+            "bits": bloom.size if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "stale": self.stale,
+            "expected_fp_rate": bloom.expected_error_rate() if bloom else 0.0,
+            "checks": self.checks,
+            "possible_hits": self.possible_hits,
+            "false_positives": self.false_positives,
+            "observed_fp_rate": self.false_positives / free if free else 0.0,
+        }
+
+
+def init_availability(app):
+    """Attach an AvailabilityIndex to `app`."""
+
+    index = AvailabilityIndex(
+        error_rate=app.config.get("AVAILABILITY_ERROR_RATE", 0.01),
+        sync_seconds=app.config.get("AVAILABILITY_SYNC_SECONDS", 2),
+        rebuild_seconds=app.config.get("AVAILABILITY_REBUILD_SECONDS", 3600),
+        background=app.config.get("AVAILABILITY_BACKGROUND_BUILD", True),
+    )
+    app.extensions["availability"] = index
+    app.cli.add_command(availability_cli)
+
+    if app.config.get("AVAILABILITY_PRELOAD"):
+        with app.app_context():
+            try:
+                index.build()
+            except SQLAlchemyError as exc:
+                # e.g. tables not created yet; build on first use instead.
+                app.logger.warning("availability filter not preloaded: %s", exc)
+
+
+def current_availability():
+    """The current app's AvailabilityIndex."""
+
+    return current_app.extensions["availability"]
+
+
+def unavailable(form, user_id=None):
+    """Add "already taken" errors to `form`'s username/email fields.
+
+    Returns True if any field was taken.
+    """
+
+    index = current_availability()
+    taken = False
+
+    for field in FIELDS:
+        if not index.is_available(field, form[field].data, user_id):
+            form[field].errors.append(MESSAGES[field])
+            taken = True
+
+    return taken
+
+
+def explain_conflict(form, user_id=None):
+    """After an IntegrityError, mark whichever field actually collided.
+
+    Goes straight to the database, since the row may have come from another
+    worker that our filter hasn't synced yet.
+    """
+
+    index = current_availability()
+    taken = False
+
+    for field in FIELDS:
+        owner = index.lookup(field, form[field].data)
+
+        if owner is not None and owner != user_id:
+            index.add(field, form[field].data)
+            form[field].errors.append(MESSAGES[field])
+            taken = True
+
+    return taken
+
+
+##############################################################################
+# Mapper events
+
+
+def _index():
+    if has_app_context():
+        return current_app.extensions.get("availability")
+
+
+@event.listens_for(User, "after_insert")
+def _user_inserted(mapper, connection, user):
+    index = _index()
+
+    if index:
+        index.add_user(user.id, user.username, user.email)
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, user):
+    index = _index()
+
+    if not index:
+        return
+
+    for field in FIELDS:
+        history = db.inspect(user).attrs[field].history
+
+        if history.deleted:
+            index.add(field, getattr(user, field))
+            index.forget(len(history.deleted))
+
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(mapper, connection, user):
+    index = _index()
+
+    if index:
+        index.forget(len(FIELDS))
+
+
+##############################################################################
+# Command line
+
+
+availability_cli = AppGroup(
+    "availability", help="Inspect the username/email Bloom filter.")
+
+
+@availability_cli.command("stats")
+@click.option("--probes", default=100000,
+              help="Random unused names to test for false positives.")
+def stats_command(probes):
+    """Build the filter and measure its false-positive rate."""
+
+    index = current_availability()
+    index.build()
+
+    alphabet = string.ascii_lowercase + string.digits
+    hits = sum(
+        key("username", "".join(random.choices(alphabet, k=24))) in index.filter
+        for _ in range(probes)
+    )
+
+    for name, value in index.stats().items():
+        click.echo(f"{name:>18}: {value}")
+
+    click.echo(f"{'measured_fp_rate':>18}: {hits / probes if probes else 0:.5f}")
@@ -0,0 +1,198 @@
+"""Benchmark sync (gunicorn) vs async (uvicorn) serving at equal memory.
+
+Starts each server in turn against the same database, measures the resident
+memory of its whole process tree, then drives the hot read endpoints with
+`--concurrency` keep-alive clients for `--duration` seconds.
+
+    DATABASE_URL=postgresql:///warbler SECRET_KEY=... \\
+        python bench_async.py --sync-workers 8 --async-workers 2 --user-id 1
+
+Pick worker counts so both servers use similar memory; the report includes
+requests/s per 100 MB so the two can be compared directly.
+"""
+
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from flask import session
+
+from app import CURR_USER_KEY, create_app
+
+SERVERS = {
+    "sync": ["gunicorn", "wsgi:app", "--preload", "--workers", "{workers}",
+             "--bind", "127.0.0.1:{port}"],
+    "async": ["uvicorn", "asgi:app", "--workers", "{workers}",
+              "--port", "{port}", "--no-access-log"],
+}
+
+
+def session_cookie(user_id):
+    """A signed Flask session cookie logging in `user_id`."""
+
+    app = create_app()
+
+    with app.test_request_context():
+        session[CURR_USER_KEY] = user_id
+        response = app.make_response("")
+        app.session_interface.save_session(app, session, response)
+
+    return response.headers["Set-Cookie"].split(";")[0]
+
+
+def tree_rss_mb(pid):
+    """Resident memory of `pid` and all of its descendants, in MB."""
+
+    children = {}
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total_kb = 0
+    stack = [pid]
+
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            pass
+
+    return total_kb / 1024
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def drive(port, paths, cookie, concurrency, duration):
+    """Hit `paths` round-robin from `concurrency` threads; return latencies."""
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine = []
+        i = 0
+
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", paths[i % len(paths)],
+                             headers={"Cookie": cookie})
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    errors.append(resp.status)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(e)
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            mine.append(time.perf_counter() - start)
+            i += 1
+
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return latencies, errors
+
+
+def run(kind, workers, port, args, paths, cookie):
+    cmd = [part.format(workers=workers, port=port) for part in SERVERS[kind]]
+    env = {**os.environ, "WARBLER_ENV": "production"}
+    server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(port)
+        drive(port, paths, cookie, args.concurrency, 2)  # warm up
+        rss = tree_rss_mb(server.pid)
+        latencies, errors = drive(
+            port, paths, cookie, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    rps = len(latencies) / args.duration
+
+    return {
+        "server": f"{kind} x{workers}",
+        "rss_mb": rss,
+        "rps": rps,
+        "rps_per_100mb": rps / rss * 100,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--message-id", type=int)
+    parser.add_argument("--sync-workers", type=int, default=8)
+    parser.add_argument("--async-workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=int, default=15)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    paths = ["/", f"/users/{args.user_id}"]
+    if args.message_id:
+        paths.append(f"/messages/{args.message_id}")
+
+    cookie = session_cookie(args.user_id)
+
+    results = [
+        run("sync", args.sync_workers, args.port, args, paths, cookie),
+        run("async", args.async_workers, args.port + 1, args, paths, cookie),
+    ]
+
+    print(f"{'server':<12}{'RSS MB':>9}{'req/s':>9}{'req/s/100MB':>13}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+
+    for r in results:
+        print(f"{r['server']:<12}{r['rss_mb']:>9.1f}{r['rps']:>9.1f}"
+              f"{r['rps_per_100mb']:>13.1f}{r['p50_ms']:>9.1f}"
+              f"{r['p99_ms']:>9.1f}{r['errors']:>8}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""Compare CPU time and bytes saved per compression level on real pages.
+
+Adds `--users` users who all follow one of them, plus messages that user
+has liked. It then renders the pages that user sees: ``/users``, their
+followers, their likes and the homepage. Each page is compressed with gzip
+at every level in `--gzip-levels`, and with brotli at every level in
+`--brotli-levels` when the ``brotli`` package is installed. For each
+combination it reports the compressed size, the ratio, and the median CPU
+time per page.
+
+    DATABASE_URL=sqlite:///bench_compression.db SECRET_KEY=... \\
+        python bench_compression.py --users 500
+
+The generated rows are added to whatever is there, so use a scratch
+database.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from app import create_app, CURR_USER_KEY
+from compression import BrotliCoder, GzipCoder, brotli
+from models import db, User, Message, Follow, Like
+
+SETTINGS = {
+    "COMPRESS_ENABLED": False,
+    "CACHE_ENABLED": False,
+    "AVAILABILITY_PRELOAD": False,
+}
+
+
+def generate(count):
+    """Insert `count` users following the first, who likes their messages.
+
+    Returns the first user's id.
+    """
+
+    now = datetime.utcnow()
+    tag = int(time.time())
+
+    user_ids = db.session.execute(
+        insert(User).returning(User.id),
+        [{"username": f"bench{tag}_{i}", "email": f"bench{tag}_{i}@example.com",
+          "password": "x", "bio": "A bio of typical length. " * 4}
+         for i in range(count)],
+    ).scalars().all()
+
+    messages = db.session.execute(
+        insert(Message).returning(Message.id, Message.timestamp),
+        [{"text": f"Message {i}: " + "lorem ipsum " * 10,
+          "timestamp": now - timedelta(seconds=i),
+          "user_id": user_ids[i]}
+         for i in range(count)],
+    ).all()
+
+    db.session.execute(insert(Follow), [
+        {"user_being_followed_id": user_ids[0], "user_following_id": user_id}
+        for user_id in user_ids[1:]
+    ])
+    db.session.execute(insert(Like), [
+        {"user_id": user_ids[0], "message_id": message.id,
+         "message_timestamp": message.timestamp}
+        for message in messages[1:]
+    ])
+    db.session.commit()
+
+    return user_ids[0]
+
+
+def render(app, user_id):
+    """{path: uncompressed body} for the pages `user_id` sees."""
+
+    pages = {}
+
+    with app.test_client() as c:
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        for path in ["/users", f"/users/{user_id}/followers",
+                     f"/users/{user_id}/likes", "/"]:
+            resp = c.get(path)
+
+            if resp.status_code != 200:
+                raise RuntimeError(f"{path}: {resp.status_code}")
+
+            pages[path] = resp.data
+
+    return pages
+
+
+def measure(coder, level, data, repeat):
+    """(compressed bytes, median CPU seconds) for `data`."""
+
+    timings = []
+
+    for _ in range(repeat):
+        started = time.process_time()
+        c = coder(level)
+        out = c.compress(data) + c.finish()
+        timings.append(time.process_time() - started)
+
+    return len(out), statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--gzip-levels", type=int, nargs="+", default=[1, 4, 6, 9])
+    parser.add_argument("--brotli-levels", type=int, nargs="+", default=[1, 4, 6, 11])
+    args = parser.parse_args()
+
+    app = create_app(**SETTINGS)
+
+    with app.app_context():
+        db.create_all()
+        user_id = generate(args.users)
+
+    pages = render(app, user_id)
+    codings = [("gzip", GzipCoder, level) for level in args.gzip_levels]
+
+    if brotli is not None:
+        codings += [("br", BrotliCoder, level) for level in args.brotli_levels]
+    else:
+        print("brotli is not installed; gzip only")
+
+    print(f"{'page':<24}{'coding':>8}{'level':>7}{'bytes':>10}{'ratio':>8}"
+          f"{'cpu ms':>9}{'MB/s':>8}")
+
+    for path, data in pages.items():
+        print(f"{path:<24}{'-':>8}{'-':>7}{len(data):>10}")
+
+        for name, coder, level in codings:
+            size, seconds = measure(coder, level, data, args.repeat)
+            rate = len(data) / seconds / 1e6 if seconds else float("inf")
+            print(f"{'':<24}{name:>8}{level:>7}{size:>10}{len(data) / size:>8.1f}"
+                  f"{seconds * 1000:>9.2f}{rate:>8.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Benchmark message posting: per request, group commit and bulk.
+
+Posts `--messages` messages three ways through the app:
+
+- single: ``POST /messages/new`` from `--concurrency` threads, one commit
+  per message (group commit off)
+- group: the same requests with group commit on (see ingest.py)
+- bulk: ``POST /messages/bulk`` with `--batch-size` messages per request
+
+and reports messages per second and request latency for each.
+
+    DATABASE_URL=postgresql:///warbler_bench SECRET_KEY=... \\
+        python bench_ingest.py --messages 5000 --concurrency 16
+
+Messages are added to whatever is there, so use a scratch database. On
+SQLite, concurrent writers queue on the database lock.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+
+from app import create_app, CURR_USER_KEY
+from models import db, User
+
+SETTINGS = {
+    "WTF_CSRF_ENABLED": False,
+    "AVAILABILITY_PRELOAD": False,
+    "CACHE_ENABLED": False,
+}
+
+
+def make_user():
+    user = User.signup(f"bench{time.time_ns()}", f"bench{time.time_ns()}@example.com",
+                       "password")
+    db.session.commit()
+
+    return user.id
+
+
+def run(app, user_id, requests, concurrency):
+    """Send `requests` [(path, kwargs)] from `concurrency` threads.
+
+    Returns (seconds, latencies).
+    """
+
+    latencies = []
+    lock = threading.Lock()
+    todo = iter(requests)
+
+    def client():
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            while True:
+                with lock:
+                    request = next(todo, None)
+
+                if request is None:
+                    return
+
+                path, kwargs = request
+                started = time.perf_counter()
+                resp = c.post(path, **kwargs)
+                elapsed = time.perf_counter() - started
+
+                if resp.status_code >= 400:
+                    raise RuntimeError(f"{path}: {resp.status_code} {resp.text[:200]}")
+
+                with lock:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - started, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    single_app = create_app(INGEST_GROUP_COMMIT=False, **SETTINGS)
+    group_app = create_app(INGEST_GROUP_COMMIT=True, **SETTINGS)
+
+    with single_app.app_context():
+        db.create_all()
+        user_id = make_user()
+
+    texts = [f"bench message {i} #bench" for i in range(args.messages)]
+    single = [("/messages/new", {"data": {"text": text}}) for text in texts]
+    bulk = [
+        ("/messages/bulk", {
+            "data": "\n".join(json.dumps({"text": text})
+                              for text in texts[i:i + args.batch_size]),
+            "content_type": "application/x-ndjson",
+        })
+        for i in range(0, len(texts), args.batch_size)
+    ]
+
+    print(f"{'path':<8}{'requests':>10}{'msgs/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+
+    for name, app, requests in [("single", single_app, single),
+                                ("group", group_app, single),
+                                ("bulk", single_app, bulk)]:
+        seconds, latencies = run(app, user_id, requests, args.concurrency)
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{name:<8}{len(requests):>10}{args.messages / seconds:>10.0f}"
+              f"{statistics.median(latencies) * 1000:>10.1f}{p99 * 1000:>10.1f}")
+
+    committer = group_app.extensions["group_commit"]
+    print(f"group commit: {committer.stats['messages']} messages in "
+          f"{committer.stats['commits']} commits")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Benchmark message search latency on a generated corpus.
+
+Fills the configured database with `--messages` synthetic warbles (Zipf
+distributed vocabulary, timestamps spread over `--days`), indexes them, then
+times a mix of queries: common and rare words, two-word AND, phrase and
+prefix, each for the first page and for a page reached by cursor.
+
+    DATABASE_URL=postgresql:///warbler_bench SECRET_KEY=... \\
+        python bench_search.py --messages 10000000
+
+Use ``--skip-generate`` to re-run the queries against an existing corpus.
+The generated rows are added to whatever is there, so use a scratch
+database.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import insert, select, func
+
+from app import create_app
+from models import db, User, Message, MessageTerm
+from search import find_messages, postings
+
+VOCABULARY = 50_000
+
+
+def word(rank):
+    """A pronounceable fake word for vocabulary `rank` (0 = most common)."""
+
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "be", "du"]
+    parts = []
+
+    rank += 1
+    while rank:
+        rank, digit = divmod(rank, len(syllables))
+        parts.append(syllables[digit])
+
+    return "".join(parts)
+
+
+def generate(count, days, batch_size=10_000, seed=0):
+    """Insert `count` messages (and their postings) in batches."""
+
+    rng = random.Random(seed)
+    words = [word(rank) for rank in range(VOCABULARY)]
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+
+    user_id = db.session.execute(
+        insert(User).values(username=f"bench{rng.randrange(10**9)}",
+                            email=f"bench{rng.randrange(10**9)}@example.com",
+                            password="x")
+        .returning(User.id)
+    ).scalar()
+
+    next_id = (db.session.execute(select(func.max(Message.id))).scalar() or 0) + 1
+    end = datetime.utcnow()
+    span = timedelta(days=days).total_seconds()
+    start = time.perf_counter()
+
+    for offset in range(0, count, batch_size):
+        size = min(batch_size, count - offset)
+        messages = []
+
+        for i in range(size):
+            n_words = rng.randint(3, 20)
+            text = " ".join(rng.choices(words, cum_weights=cum_weights, k=n_words))[:140]
+            # Ids increase with time, as they do for real messages.
+            age = span * (1 - (offset + i) / count)
+            messages.append(Message(
+                id=next_id + offset + i,
+                text=text,
+                timestamp=end - timedelta(seconds=age),
+                user_id=user_id,
+            ))
+
+        db.session.execute(insert(Message), [
+            {"id": m.id, "text": m.text, "timestamp": m.timestamp,
+             "user_id": m.user_id}
+            for m in messages
+        ])
+        db.session.execute(
+            insert(MessageTerm), [row for m in messages for row in postings(m)])
+        db.session.commit()
+
+        done = offset + size
+        rate = done / (time.perf_counter() - start)
+        print(f"\r{done}/{count} messages ({rate:.0f}/s)", end="", flush=True)
+
+    print()
+
+
+def time_query(text, repeat, pages):
+    """Latencies (seconds) of fetching page `pages` of `text`, `repeat` times."""
+
+    latencies = []
+
+    for _ in range(repeat):
+        cursor = None
+
+        for _ in range(pages - 1):
+            _, cursor = find_messages(text, cursor=cursor)
+            if cursor is None:
+                break
+
+        started = time.perf_counter()
+        find_messages(text, cursor=cursor)
+        latencies.append(time.perf_counter() - started)
+        db.session.remove()
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=10_000_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-generate", action="store_true")
+    args = parser.parse_args()
+
+    app = create_app()
+    words = [word(rank) for rank in range(VOCABULARY)]
+
+    with app.app_context():
+        db.create_all()
+
+        if not args.skip_generate:
+            generate(args.messages, args.days, args.batch_size)
+
+        queries = {
+            "common word": words[0],
+            "mid word": words[200],
+            "rare word": words[20_000],
+            "two words": f"{words[3]} {words[40]}",
+            "phrase": f'"{words[1]} {words[2]}"',
+            "prefix": f"{words[5][:3]}*",
+        }
+
+        print(f"{'query':<14}{'page':>6}{'p50 ms':>10}{'p99 ms':>10}")
+
+        for name, text in queries.items():
+            for page in (1, 5):
+                latencies = sorted(time_query(text, args.repeat, page))
+                p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+                print(f"{name:<14}{page:>6}"
+                      f"{statistics.median(latencies) * 1000:>10.1f}"
+                      f"{p99 * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
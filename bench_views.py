@@ -0,0 +1,123 @@
+"""Compare memory and time of ORM rows vs. view objects for list pages.
+
+Adds `--authors` users with enough messages between them for the largest
+size, then builds a feed of each size (default 100 and 1000 messages) both
+ways: as ``Message`` instances with their ``user`` loaded, the way the
+homepage used to, and with ``views.feed``. For each it reports the memory
+still held by the result, the peak while building it, and the time taken.
+
+    DATABASE_URL=sqlite:///bench_views.db SECRET_KEY=... \\
+        python bench_views.py --sizes 100 1000
+
+The generated rows are added to whatever is there, so use a scratch
+database.
+"""
+
+import argparse
+import gc
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from app import create_app
+from models import db, User, Message
+from views import feed
+
+
+def generate(authors, count):
+    """Insert `authors` users and `count` messages spread among them."""
+
+    now = datetime.utcnow()
+    tag = int(time.time())
+
+    user_ids = db.session.execute(
+        insert(User).returning(User.id),
+        [{"username": f"bench{tag}_{i}", "email": f"bench{tag}_{i}@example.com",
+          "password": "x", "bio": "A bio of typical length. " * 4}
+         for i in range(authors)],
+    ).scalars().all()
+
+    db.session.execute(insert(Message), [
+        {"text": f"Message {i}: " + "lorem ipsum " * 10,
+         "timestamp": now - timedelta(seconds=i),
+         "user_id": user_ids[i % authors]}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+    return user_ids
+
+
+def orm_feed(user_ids, limit):
+    return (Message.query
+            .filter(Message.user_id.in_(user_ids))
+            .order_by(Message.timestamp.desc())
+            .options(db.selectinload(Message.user))
+            .limit(limit)
+            .all())
+
+
+def view_feed(user_ids, limit):
+    return feed(user_ids, limit=limit)
+
+
+def measure(build, user_ids, limit, repeat):
+    """(retained bytes, peak bytes, median seconds) of `build` on a fresh session."""
+
+    timings = []
+
+    for _ in range(repeat):
+        db.session.remove()
+        started = time.perf_counter()
+        build(user_ids, limit)
+        timings.append(time.perf_counter() - started)
+
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    result = build(user_ids, limit)
+    # Everything reachable from the result stays alive while the page renders,
+    # including the session's identity map for ORM rows.
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    peak = tracemalloc.get_traced_memory()[1] - before
+
+    tracemalloc.stop()
+    del result
+    db.session.remove()
+
+    return retained, peak, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--authors", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        user_ids = generate(args.authors, max(args.sizes))
+
+        print(f"{'items':>6}  {'path':<6}{'retained KiB':>14}{'peak KiB':>10}"
+              f"{'ms':>8}{'bytes/item':>12}")
+
+        for size in args.sizes:
+            for name, build in (("orm", orm_feed), ("views", view_feed)):
+                retained, peak, seconds = measure(build, user_ids, size, args.repeat)
+                print(f"{size:>6}  {name:<6}{retained / 1024:>14.1f}"
+                      f"{peak / 1024:>10.1f}{seconds * 1000:>8.2f}"
+                      f"{retained / size:>12.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,431 @@
+"""Two-tier cache for hot pages, shared by all workers on a host.
+
+L1 is a small LRU inside each worker process. L2 is a SQLite file that
+every worker opens (``CACHE_PATH``). It stands in for Redis, with the same
+get/set/lease shape. A miss in L1 is looked up in L2 before anything is
+computed, so a profile warmed by one worker is warm for all of them.
+Without ``CACHE_PATH`` L2 is an in-memory database private to the process.
+
+Values are invalidated by version. Each value is stamped with the versions
+of the rows it was built from (``user:12``, ``message:34``), and write
+handlers call ``touch()`` to bump those versions. A value whose stamps no
+longer match is ignored. Versions live in L2, so a bump made by one worker
+is seen by all of them.
+
+A hot key is computed once, not once per waiting request:
+
+- Within a worker, concurrent misses for a key wait for the first one
+  (single flight).
+- Across workers, the first takes a short lease on the key in L2. The others
+  poll L2 for its result.
+- Shortly before a value expires, requests start recomputing it early with
+  rising probability. This is "XFetch": the time the last computation took,
+  scaled by ``beta``, is weighed against the time left. So one request
+  refreshes a hot key ahead of time, and the key never expires under load.
+  Everyone else keeps serving the current value meanwhile.
+"""
+
+import math
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+
+# stamps: ((version name, version), ...) at the time value was computed
+Entry = namedtuple("Entry", "value expires delta stamps")
+
+PURGE_EVERY = 1000
+POLL_SECONDS = 0.01
+
+
+class LRU:
+    """L1: the `size` most recently used entries of this process."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedStore:
+    """L2: entries, versions and leases in a SQLite database."""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS entries"
+        " (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS versions"
+        " (name TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS leases"
+        " (key TEXT PRIMARY KEY, expires REAL NOT NULL)",
+    ]
+
+    def __init__(self, path=None, clock=time.time):
+        self.path = path or ":memory:"
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._sets = 0
+
+    def _connection(self):
+        # A connection must not be used across fork, so each worker opens
+        # its own on first use.
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                   check_same_thread=False)
+
+            if self.path != ":memory:":
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+            self._conn, self._pid = conn, os.getpid()
+
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def get(self, key):
+        rows = self._execute(
+            "SELECT value FROM entries WHERE key = ? AND expires > ?",
+            (key, self.clock()))
+
+        return pickle.loads(rows[0][0]) if rows else None
+
+    def set(self, key, entry):
+        self._execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+            (key, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), entry.expires))
+
+        self._sets += 1
+
+        if self._sets % PURGE_EVERY == 0:
+            self._execute("DELETE FROM entries WHERE expires <= ?", (self.clock(),))
+
+    def clear(self):
+        """Drop every entry. Versions are kept: resetting them could make
+        an entry that an L1 still holds look current again."""
+
+        self._execute("DELETE FROM entries")
+
+    def size(self):
+        return self._execute("SELECT COUNT(*) FROM entries")[0][0]
+
+    def versions(self, names):
+        """{name: version} for `names` (0 for one never bumped)."""
+
+        names = list(names)
+        found = dict(self._execute(
+            f"SELECT name, version FROM versions"
+            f" WHERE name IN ({', '.join('?' * len(names))})", names))
+
+        return {name: found.get(name, 0) for name in names}
+
+    def bump(self, names):
+        with self._lock:
+            self._connection().executemany(
+                "INSERT INTO versions VALUES (?, 1) ON CONFLICT (name)"
+                " DO UPDATE SET version = version + 1",
+                [(name,) for name in names])
+
+    def acquire(self, key, seconds):
+        """Take the lease on `key` for `seconds`; False if someone has it."""
+
+        now = self.clock()
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                conn.execute("DELETE FROM leases WHERE key = ? AND expires <= ?",
+                             (key, now))
+                taken = conn.execute("INSERT OR IGNORE INTO leases VALUES (?, ?)",
+                                     (key, now + seconds)).rowcount == 1
+            finally:
+                conn.execute("COMMIT")
+
+        return taken
+
+    def release(self, key):
+        self._execute("DELETE FROM leases WHERE key = ?", (key,))
+
+
+class Flight:
+    """One in-progress computation that other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self, timeout):
+        if not self.done.wait(timeout):
+            raise TimeoutError
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+class Cache:
+    """L1 in front of a SharedStore, with single flight and early refresh."""
+
+    def __init__(self, store, l1_size=1000, ttl=60, beta=1.0, lease_seconds=5,
+                 clock=time.time, rand=random.random):
+        self.l1 = LRU(l1_size)
+        self.l2 = store
+        self.ttl = ttl
+        self.beta = beta
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.rand = rand
+        self.stats = Counter()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def get(self, key, compute, depends=(), ttl=None):
+        """The value of `compute()` for `key`, from L1, L2 or computed now.
+
+        `depends` names the versions to stamp the value with. It can also be
+        a function of the computed value, for names only known afterwards
+        (e.g. a message's author).
+        """
+
+        entry = self._lookup(key)
+
+        if entry is not None:
+            if not self._refresh_early(entry):
+                return entry.value
+
+            self.stats["early_refreshes"] += 1
+
+        return self._fly(key, compute, depends, ttl, entry)
+
+    def touch(self, names):
+        """Bump the versions `names`, invalidating values stamped with them."""
+
+        self.l2.bump(names)
+
+    def _lookup(self, key):
+        now = self.clock()
+
+        for tier, store in (("l1", self.l1), ("l2", self.l2)):
+            entry = store.get(key)
+
+            if entry is not None and entry.expires > now and self._current(entry):
+                self.stats[f"{tier}_hits"] += 1
+
+                if store is self.l2:
+                    self.l1.set(key, entry)
+
+                return entry
+
+        self.stats["misses"] += 1
+        return None
+
+    def _current(self, entry):
+        if not entry.stamps:
+            return True
+
+        stamps = dict(entry.stamps)
+        return self.l2.versions(stamps) == stamps
+
+    def _refresh_early(self, entry):
+        # log(u) for u in (0, 1] is <= 0, so this looks ahead of now by a
+        # random multiple of the time the value took to compute.
+        gap = -entry.delta * self.beta * math.log(1.0 - self.rand())
+        return self.clock() + gap >= entry.expires
+
+    def _fly(self, key, compute, depends, ttl, current):
+        """Compute `key` once per process, however many threads ask."""
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            self.stats["coalesced"] += 1
+
+            if current is not None:
+                return current.value
+
+            try:
+                return flight.wait(self.lease_seconds)
+            except TimeoutError:
+                return compute()
+
+        try:
+            flight.value = self._compute_once(key, compute, depends, ttl, current)
+            return flight.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+    def _compute_once(self, key, compute, depends, ttl, current):
+        """Compute `key` once per host, unless the lease holder is too slow."""
+
+        if self.l2.acquire(key, self.lease_seconds):
+            try:
+                return self._compute(key, compute, depends, ttl)
+            finally:
+                self.l2.release(key)
+
+        # Another worker is computing it.
+        self.stats["coalesced"] += 1
+
+        if current is not None:
+            return current.value
+
+        deadline = time.monotonic() + self.lease_seconds
+
+        while time.monotonic() < deadline:
+            time.sleep(POLL_SECONDS)
+            entry = self.l2.get(key)
+
+            if entry is not None and self._current(entry):
+                self.l1.set(key, entry)
+                return entry.value
+
+        return self._compute(key, compute, depends, ttl)
+
+    def _compute(self, key, compute, depends, ttl):
+        # Versions known up front are read first: a bump made while computing
+        # then leaves the value stamped with the old version, i.e. stale.
+        stamps = None if callable(depends) else self._stamps(depends)
+
+        started = time.perf_counter()
+        value = compute()
+        delta = time.perf_counter() - started
+
+        if stamps is None:
+            stamps = self._stamps(depends(value))
+
+        entry = Entry(value, self.clock() + (ttl or self.ttl), delta, stamps)
+        self.l1.set(key, entry)
+        self.l2.set(key, entry)
+        self.stats["computes"] += 1
+
+        return value
+
+    def _stamps(self, names):
+        return tuple(sorted(self.l2.versions(names).items())) if names else ()
+
+
+##############################################################################
+# App setup and access
+
+
+cache_cli = AppGroup("cache", help="Inspect the shared page cache.")
+
+
+def init_cache(app):
+    if app.config.get("CACHE_ENABLED"):
+        app.extensions["cache"] = Cache(
+            SharedStore(app.config.get("CACHE_PATH")),
+            l1_size=app.config.get("CACHE_L1_SIZE", 1000),
+            ttl=app.config.get("CACHE_TTL_SECONDS", 60),
+            beta=app.config.get("CACHE_EARLY_REFRESH_BETA", 1.0),
+            lease_seconds=app.config.get("CACHE_LEASE_SECONDS", 5),
+        )
+
+    app.cli.add_command(cache_cli)
+
+
+def current_cache():
+    """The current app's Cache, or None when caching is off."""
+
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get("cache")
+
+
+def cached(key, compute, depends=(), ttl=None):
+    """``Cache.get`` on the current app's cache; just `compute()` without one."""
+
+    cache = current_cache()
+
+    if cache is None:
+        return compute()
+
+    return cache.get(key, compute, depends, ttl)
+
+
+def touch(*names):
+    """Invalidate cached values built from `names` (e.g. ``"user:12"``)."""
+
+    cache = current_cache()
+
+    if cache is not None:
+        cache.touch(names)
+
+
+@cache_cli.command("stats")
+def stats_command():
+    """Show how many entries the shared tier holds."""
+
+    cache = current_cache()
+
+    if cache is None:
+        raise click.ClickException("Caching is off (CACHE_ENABLED).")
+
+    click.echo(f"path: {cache.l2.path}")
+    click.echo(f"entries: {cache.l2.size()}")
+
+
+@cache_cli.command("clear")
+def clear_command():
+    """Drop every shared entry (workers' L1s expire on their own)."""
+
+    cache = current_cache()
+
+    if cache is None:
+        raise click.ClickException("Caching is off (CACHE_ENABLED).")
+
+    cache.l2.clear()
+    click.echo("cleared")
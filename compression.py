@@ -0,0 +1,166 @@
+"""gzip/brotli response compression.
+
+Text responses are compressed with the best coding the client accepts
+(``Accept-Encoding``): brotli when the ``brotli`` package is installed,
+otherwise gzip.
+
+- A buffered response is compressed in one go and keeps a Content-Length.
+- A streamed response (``/users/export``, static files) is compressed
+  chunk by chunk as it is sent, never buffered. Generated chunks are
+  flushed as they go, so the client sees each one straight away.
+
+Skipped: tiny bodies (under ``COMPRESS_MIN_SIZE``), types that are already
+compressed (images, fonts, archives), responses that already have a
+Content-Encoding or say ``Cache-Control: no-transform``, partial content,
+and Server-Sent Events. SSE events are tiny and must not wait in a
+compressor.
+
+Levels are ``COMPRESS_GZIP_LEVEL`` (1-9) and ``COMPRESS_BROTLI_LEVEL``
+(0-11). ``bench_compression.py`` measures CPU against bytes saved on real
+pages.
+"""
+
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESSIBLE = (
+    "text/html", "text/css", "text/plain", "text/csv", "text/xml",
+    "text/javascript", "application/javascript", "application/json",
+    "application/x-ndjson", "application/xml", "image/svg+xml",
+)
+
+
+class GzipCoder:
+    def __init__(self, level):
+        # wbits 16 + MAX_WBITS: gzip header and trailer, not raw zlib.
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class BrotliCoder:
+    def __init__(self, level):
+        self._c = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+def coders():
+    """{coding: (coder class, level config key)}, most preferred first."""
+
+    available = {}
+
+    if brotli is not None:
+        available["br"] = (BrotliCoder, "COMPRESS_BROTLI_LEVEL")
+
+    available["gzip"] = (GzipCoder, "COMPRESS_GZIP_LEVEL")
+
+    return available
+
+
+def new_coder(coding, config):
+    cls, level_key = coders()[coding]
+    return cls(config[level_key])
+
+
+def compressed(chunks, coder, flush_each=False):
+    """Yield `chunks` compressed with `coder`, one output chunk per input."""
+
+    for chunk in chunks:
+        data = coder.compress(chunk)
+
+        if flush_each:
+            data += coder.flush()
+
+        if data:
+            yield data
+
+    yield coder.finish()
+
+
+def compressible(response):
+    if response.mimetype not in COMPRESSIBLE:
+        return False
+
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+
+    if "Content-Encoding" in response.headers:
+        return False
+
+    return "no-transform" not in response.headers.get("Cache-Control", "")
+
+
+def compress_response(response):
+    """Compress `response` for the current request, if worthwhile."""
+
+    config = current_app.config
+
+    if not config.get("COMPRESS_ENABLED") or not compressible(response):
+        return response
+
+    # Caches must keep the compressed and plain versions apart.
+    response.vary.add("Accept-Encoding")
+
+    coding = request.accept_encodings.best_match(list(coders()))
+
+    if coding is None or request.method == "HEAD":
+        return response
+
+    if not response.is_streamed:
+        data = response.get_data()
+
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        coder = new_coder(coding, config)
+        response.set_data(coder.compress(data) + coder.finish())
+    else:
+        # File responses only need to be compact; generated ones also need
+        # every chunk to go out when it is produced.
+        flush_each = not response.direct_passthrough
+
+        if hasattr(response.response, "close"):
+            response.call_on_close(response.response.close)
+
+        response.response = compressed(response.iter_encoded(),
+                                       new_coder(coding, config), flush_each)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+
+    response.headers["Content-Encoding"] = coding
+
+    etag, weak = response.get_etag()
+
+    if etag and not weak:
+        # Byte-for-byte different from the uncompressed representation.
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def init_compression(app):
+    # after_request hooks run last-registered first; go to the front of the
+    # list so every other hook (the debug toolbar rewrites HTML) sees the
+    # uncompressed body.
+    app.after_request_funcs.setdefault(None, []).insert(0, compress_response)
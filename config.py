@@ -0,0 +1,295 @@
+"""Configuration profiles for the Warbler app factory.
+
+Environment variables are read when a profile is instantiated (i.e. inside
+``create_app``), never at import time.
+
+Engine/pool settings (all optional):
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT   -- pool sizing (seconds)
+    DB_POOL_RECYCLE                                   -- max connection age
+    DB_POOL_PRE_PING                                  -- "1"/"0"
+
+Read replicas (see replicas.py):
+
+    REPLICA_DATABASE_URLS     -- comma-separated replica URLs
+    READ_YOUR_WRITES_SECONDS  -- how long a writer stays on the primary
+
+Message/like shards (see sharding.py):
+
+    SHARD_DATABASE_URLS       -- comma-separated shard URLs
+
+Follow graph snapshot (see followgraph.py):
+
+    FOLLOW_GRAPH_PATH         -- snapshot file shared by all workers
+
+Trending messages (see trending.py):
+
+    TRENDING_CHECKPOINT_PATH  -- where like-count sketches are saved (as <path>.<pid>)
+    TRENDING_EXACT            -- "1" to count exactly instead of sketching
+
+Message partitions (see partitions.py):
+
+    PARTITION_ARCHIVE_TABLESPACE  -- tablespace for archived months
+
+Page cache (see cache.py):
+
+    CACHE_PATH                -- SQLite file shared by all workers
+
+Group commit of single posts (see ingest.py):
+
+    INGEST_GROUP_COMMIT       -- "1" for threaded or async workers; a sync
+                                 worker serves one post at a time, so it
+                                 would only wait without ever coalescing
+
+Live timeline (see pubsub.py):
+
+    STREAM_ENABLED            -- "1" to serve /stream; see wsgi.py for workers
+
+Slow-query log (see slowlog.py):
+
+    SLOW_QUERY_LOG_PATH       -- rotating log file; "{pid}" is replaced
+
+Sampling profiler (see profiler.py):
+
+    PROFILER_TOKEN            -- X-Profile header value; unset turns it off
+    PROFILER_OUTPUT_DIR       -- where runs are written (default: temp dir)
+"""
+
+import os
+
+from sqlalchemy.engine import make_url
+
+
+def env_flag(name, default=False):
+    """Read a boolean flag such as ``DB_POOL_PRE_PING=1`` from the environment."""
+
+    value = os.environ.get(name)
+
+    if value is None:
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def engine_options(database_url, pool_size=5, max_overflow=10,
+                   pool_timeout=30, pool_recycle=1800, pool_pre_ping=True):
+    """Build ``SQLALCHEMY_ENGINE_OPTIONS`` for `database_url`.
+
+    Each value can be overridden with the matching ``DB_*`` variable. SQLite
+    uses a single-connection pool, so it only gets ``pool_pre_ping``.
+    """
+
+    options = {
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", pool_pre_ping),
+    }
+
+    if make_url(database_url).get_backend_name() == "sqlite":
+        return options
+
+    options.update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", pool_size)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", max_overflow)),
+        pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", pool_timeout)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", pool_recycle)),
+    )
+    return options
+
+
+def url_list(name):
+    """Read a comma-separated list of database URLs from the environment."""
+
+    return [
+        url.strip()
+        for url in os.environ.get(name, "").split(",")
+        if url.strip()
+    ]
+
+
+def binds(prefix, urls):
+    """Build ``SQLALCHEMY_BINDS`` entries named ``<prefix>_0``, ``<prefix>_1``..."""
+
+    return {
+        f"{prefix}_{i}": {"url": url, **engine_options(url)}
+        for i, url in enumerate(urls)
+    }
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_ECHO = False
+    BCRYPT_LOG_ROUNDS = 12
+
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Compile every template while the app is created, so that with
+    # ``gunicorn --preload`` workers fork with a warm Jinja cache.
+    WARM_UP_TEMPLATES = False
+
+    READ_YOUR_WRITES_SECONDS = 5
+    SHARD_MAP_REFRESH_SECONDS = 5
+
+    # Live timeline (see pubsub.py); needs threaded or async workers
+    STREAM_ENABLED = False
+    STREAM_MAX_SECONDS = 5 * 60
+    STREAM_HEARTBEAT_SECONDS = 15
+    STREAM_HISTORY = 1000
+    STREAM_QUEUE_SIZE = 100
+
+    # Trending (see trending.py)
+    TRENDING_EXACT = False
+    TRENDING_SKETCH_WIDTH = 2048
+    TRENDING_SKETCH_DEPTH = 4
+    TRENDING_CANDIDATES = 1000
+    TRENDING_CACHE_SECONDS = 10
+    # Also how far behind other workers' counts on /trending can be.
+    TRENDING_CHECKPOINT_SECONDS = 15
+
+    # Message search: how fast relevance decays with age (see search.py)
+    SEARCH_HALF_LIFE_SECONDS = 24 * 60 * 60
+    SEARCH_PREFIX_TERMS = 100
+
+    # Username/email availability Bloom filter (see availability.py)
+    AVAILABILITY_PRELOAD = False
+    AVAILABILITY_ERROR_RATE = 0.01
+    AVAILABILITY_SYNC_SECONDS = 2
+    AVAILABILITY_REBUILD_SECONDS = 60 * 60
+    AVAILABILITY_BACKGROUND_BUILD = True
+
+    # Monthly partitions of messages/likes (see partitions.py): months older
+    # than MESSAGES_HOT_DAYS are archived; FEED_HOT_ONLY limits the feed to
+    # the hot ones.
+    MESSAGES_HOT_DAYS = 180
+    PARTITION_MONTHS_AHEAD = 3
+    FEED_HOT_ONLY = False
+
+    # Report batch-loader counters on every response (see loaders.py)
+    LOADER_STATS_HEADER = False
+
+    # Profile/message page cache (see cache.py)
+    CACHE_ENABLED = True
+    CACHE_L1_SIZE = 1000
+    CACHE_TTL_SECONDS = 60
+    CACHE_LEASE_SECONDS = 5
+    CACHE_EARLY_REFRESH_BETA = 1.0
+
+    # Bulk posting and group commit of single posts (see ingest.py)
+    INGEST_MAX_BATCH = 5000
+    INGEST_MAX_BYTES = 5 * 1024 * 1024
+    INGEST_GROUP_COMMIT = False
+    INGEST_GROUP_COMMIT_MAX = 100
+    INGEST_GROUP_COMMIT_WAIT_MS = 2
+
+    # gzip/brotli response compression (see compression.py)
+    COMPRESS_ENABLED = True
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_LEVEL = 4
+    COMPRESS_MIN_SIZE = 500
+
+    # Slow-query log with EXPLAIN capture (see slowlog.py); None turns it off
+    SLOW_QUERY_MS = 250
+    SLOW_QUERY_EXPLAIN = True
+    SLOW_QUERY_ANALYZE_RATE = 0.0
+    SLOW_QUERY_LOG_INTERVAL_SECONDS = 60
+    SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+    SLOW_QUERY_LOG_BACKUPS = 5
+
+    # On-demand sampling profiler (see profiler.py)
+    PROFILER_INTERVAL_MS = 10
+    PROFILER_REQUEST_INTERVAL_MS = 1
+    PROFILER_MAX_SECONDS = 60
+
+    # Coalesced like/follow notifications (see notifications.py)
+    NOTIFICATIONS_WINDOW_SECONDS = 24 * 60 * 60
+    NOTIFICATIONS_BUFFERED = True
+    NOTIFICATIONS_FLUSH_SIZE = 500
+    NOTIFICATIONS_FLUSH_SECONDS = 2
+
+    def __init__(self):
+        self.SQLALCHEMY_DATABASE_URI = os.environ["DATABASE_URL"]
+        self.SECRET_KEY = os.environ["SECRET_KEY"]
+        self.BCRYPT_LOG_ROUNDS = int(
+            os.environ.get("BCRYPT_LOG_ROUNDS", self.BCRYPT_LOG_ROUNDS))
+        self.SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+            self.SQLALCHEMY_DATABASE_URI)
+
+        replicas = binds("replica", url_list("REPLICA_DATABASE_URLS"))
+        shards = binds("shard", url_list("SHARD_DATABASE_URLS"))
+
+        self.SQLALCHEMY_BINDS = {**replicas, **shards}
+        self.REPLICA_BINDS = list(replicas)
+        self.SHARD_BINDS = list(shards)
+        self.FOLLOW_GRAPH_PATH = os.environ.get("FOLLOW_GRAPH_PATH")
+        self.TRENDING_CHECKPOINT_PATH = os.environ.get("TRENDING_CHECKPOINT_PATH")
+        self.TRENDING_EXACT = env_flag("TRENDING_EXACT", self.TRENDING_EXACT)
+        self.PARTITION_ARCHIVE_TABLESPACE = os.environ.get(
+            "PARTITION_ARCHIVE_TABLESPACE")
+        self.READ_YOUR_WRITES_SECONDS = float(os.environ.get(
+            "READ_YOUR_WRITES_SECONDS", self.READ_YOUR_WRITES_SECONDS))
+        self.CACHE_PATH = os.environ.get("CACHE_PATH")
+        self.STREAM_ENABLED = env_flag("STREAM_ENABLED", self.STREAM_ENABLED)
+        self.INGEST_GROUP_COMMIT = env_flag(
+            "INGEST_GROUP_COMMIT", self.INGEST_GROUP_COMMIT)
+        self.SLOW_QUERY_LOG_PATH = os.environ.get("SLOW_QUERY_LOG_PATH")
+        self.PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+        self.PROFILER_OUTPUT_DIR = os.environ.get("PROFILER_OUTPUT_DIR")
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar on, templates reloaded on change."""
+
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+    TEMPLATES_AUTO_RELOAD = True
+    LOADER_STATS_HEADER = True
+
+
+class TestingConfig(Config):
+    """Test runs: cheap bcrypt, no CSRF, no toolbar."""
+
+    TESTING = True
+    BCRYPT_LOG_ROUNDS = 4
+    WTF_CSRF_ENABLED = False
+    TRENDING_EXACT = True
+    TRENDING_CACHE_SECONDS = 0
+    # Tests write rows directly, without the handlers that touch() versions.
+    CACHE_ENABLED = False
+    # A slow CI machine would fill the test output with query plans.
+    SLOW_QUERY_MS = None
+    # The writer thread can't see a test's uncommitted transaction.
+    NOTIFICATIONS_BUFFERED = False
+    # Nor can the build thread.
+    AVAILABILITY_BACKGROUND_BUILD = False
+
+    def __init__(self):
+        os.environ.setdefault("SECRET_KEY", "warbler-test-secret")
+        super().__init__()
+
+
+class ProductionConfig(Config):
+    """Gunicorn workers: no toolbar, warm template cache, pinged pool."""
+
+    TEMPLATES_AUTO_RELOAD = False
+    WARM_UP_TEMPLATES = True
+    AVAILABILITY_PRELOAD = True
+    FEED_HOT_ONLY = True
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """Instantiate the profile called `name` (default: ``$WARBLER_ENV``)."""
+
+    name = name or os.environ.get("WARBLER_ENV", "development")
+
+    try:
+        return CONFIGS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown config profile: {name!r}") from None
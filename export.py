@@ -0,0 +1,214 @@
+"""Personal data export: a user's profile, messages, likes and follows.
+
+``/users/export`` streams the logged-in user's data. ``flask export all``
+writes every user's, in parallel processes, to one file per shard of user
+ids.
+
+Two formats:
+
+- ndjson: one JSON object per line, each with a "type".
+- csv: one row per record, with a "type" column and the union of every
+  type's fields (blank where a type doesn't have one).
+
+Each user's records start with their "profile", so a file holding many
+users splits at those.
+
+Every query runs with ``yield_per``, which on Postgres is a server-side
+cursor. Rows arrive in batches and are encoded as they come, so memory stays
+flat however many rows a user has, and the first bytes are sent before the
+last row is read.
+"""
+
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, select
+
+from models import User, Message, Like, Follow
+
+BATCH_SIZE = 1000
+CHUNK_BYTES = 64 * 1024
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+CSV_FIELDS = ["type", "id", "username", "email", "image_url",
+              "header_image_url", "bio", "location", "text", "timestamp",
+              "message_id", "liked_at", "user_id"]
+
+
+def sections(user_id):
+    """(type, statement) for each part of `user_id`'s data, in export order."""
+
+    return [
+        ("profile", select(User.id, User.username, User.email, User.image_url,
+                           User.header_image_url, User.bio, User.location)
+         .where(User.id == user_id)),
+        ("message", select(Message.id, Message.text, Message.timestamp)
+         .where(Message.user_id == user_id)
+         .order_by(Message.id)),
+        ("like", select(Like.message_id, Like.liked_at)
+         .where(Like.user_id == user_id)
+         .order_by(Like.message_id)),
+        ("following", select(User.id.label("user_id"), User.username)
+         .join(Follow, Follow.user_being_followed_id == User.id)
+         .where(Follow.user_following_id == user_id)
+         .order_by(User.id)),
+        ("follower", select(User.id.label("user_id"), User.username)
+         .join(Follow, Follow.user_following_id == User.id)
+         .where(Follow.user_being_followed_id == user_id)
+         .order_by(User.id)),
+    ]
+
+
+def records(execute, user_id, batch_size=BATCH_SIZE):
+    """Yield a dict for each record of `user_id`'s data.
+
+    `execute` runs a statement: ``db.session.execute`` or a connection's.
+    """
+
+    for kind, stmt in sections(user_id):
+        for row in execute(stmt.execution_options(yield_per=batch_size)):
+            yield {"type": kind, **row._asdict()}
+
+
+def _plain(record):
+    return {name: value.isoformat() if isinstance(value, datetime) else value
+            for name, value in record.items()}
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(_plain(record)) + "\n"
+
+
+def _csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(_plain(record))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def encode(records, fmt, chunk_bytes=CHUNK_BYTES):
+    """Yield `records` encoded as `fmt`, in chunks of about `chunk_bytes`.
+
+    The first line is sent by itself, so the download starts at once.
+    """
+
+    lines = _ndjson_lines(records) if fmt == "ndjson" else _csv_lines(records)
+    chunk = []
+    size = 0
+    first = True
+
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+
+        if first or size >= chunk_bytes:
+            yield "".join(chunk)
+            chunk, size, first = [], 0, False
+
+    if chunk:
+        yield "".join(chunk)
+
+
+def export_user(execute, user_id, fmt, batch_size=BATCH_SIZE):
+    """`user_id`'s data as `fmt` chunks (see ``encode``)."""
+
+    return encode(records(execute, user_id, batch_size), fmt)
+
+
+##############################################################################
+# Offline export of every user
+
+
+export_cli = AppGroup("export", help="Export user data.")
+
+
+def init_export(app):
+    app.cli.add_command(export_cli)
+
+
+def export_shard(database_url, path, shard, shards, fmt, batch_size=BATCH_SIZE):
+    """Export each user whose id is `shard` mod `shards` to `path`.
+
+    Runs in its own process, with its own engine. User ids are streamed on
+    one connection and each user's data read on another. Returns how many
+    users were written.
+    """
+
+    engine = create_engine(database_url)
+    exported = 0
+
+    def all_records(reader, conn):
+        nonlocal exported
+
+        user_ids = reader.execute(
+            select(User.id)
+            .where(User.id % shards == shard)
+            .order_by(User.id)
+            .execution_options(yield_per=batch_size))
+
+        for user_id in user_ids.scalars():
+            exported += 1
+            yield from records(conn.execute, user_id, batch_size)
+
+    try:
+        with engine.connect() as reader, engine.connect() as conn:
+            with open(path, "w", newline="") as out:
+                for chunk in encode(all_records(reader, conn), fmt):
+                    out.write(chunk)
+    finally:
+        engine.dispose()
+
+    return exported
+
+
+def export_all(database_url, out_dir, fmt, shards, batch_size=BATCH_SIZE,
+               echo=print):
+    """Export every user into `out_dir`, one file and process per shard."""
+
+    os.makedirs(out_dir, exist_ok=True)
+    total = 0
+
+    with ProcessPoolExecutor(shards) as pool:
+        futures = {
+            pool.submit(export_shard, database_url,
+                        os.path.join(out_dir, f"users-{shard}.{fmt}"),
+                        shard, shards, fmt, batch_size): shard
+            for shard in range(shards)
+        }
+
+        for future in as_completed(futures):
+            total += future.result()
+            echo(f"shard {futures[future]}: {future.result()} users")
+
+    return total
+
+
+@export_cli.command("all")
+@click.option("--out", "out_dir", default="export", type=click.Path(file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="ndjson")
+@click.option("--shards", default=os.cpu_count() or 1)
+@click.option("--batch-size", default=BATCH_SIZE)
+@click.option("--database-url", help="Read from here instead (e.g. a replica).")
+def export_all_command(out_dir, fmt, shards, batch_size, database_url):
+    """Export every user's data, in parallel, to one file per shard."""
+
+    url = database_url or current_app.config["SQLALCHEMY_DATABASE_URI"]
+    total = export_all(url, out_dir, fmt, shards, batch_size, echo=click.echo)
+    click.echo(f"exported {total} users to {out_dir}")
@@ -0,0 +1,446 @@
+"""Shared, memory-mapped snapshot of the follow graph.
+
+The snapshot stores the whole ``follows`` table in CSR form, in both
+directions, as int32 arrays:
+
+    header | following_offsets | following | follower_offsets | followers
+
+``following[following_offsets[u]:following_offsets[u + 1]]`` is the sorted
+list of ids user ``u`` follows (and likewise for followers), so a follow
+check is a binary search and a count is one subtraction. Every worker maps
+the same file read-only, so the page cache holds a single copy.
+
+Follows and unfollows made after the snapshot are appended to a small
+binary log next to it (``<path>.log``), which readers replay as an overlay.
+Each build starts a new log: the old one moves to ``<path>.log.old`` (and
+the one before that is dropped), since the new snapshot covers it. The
+snapshot header records which log file it was built against.
+
+Rebuild the snapshot periodically with ``flask graph build --every 300``.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+MAGIC = b"WFG2"
+HEADER = struct.Struct("<4siiqi")   # magic, max id, edges, log inode, pad
+LOG_RECORD = struct.Struct("<bii")  # +1/-1, follower id, followed id
+
+FOLLOW = 1
+UNFOLLOW = -1
+
+
+##############################################################################
+# Building
+
+
+def build_snapshot(connection, path):
+    """Write a snapshot of the ``follows`` table to `path` atomically.
+
+    The log is rotated *before* reading the table. Records are written
+    after their follow commits, so everything in the old log is in the
+    snapshot, and any follow that commits during the build is replayed from
+    the new log (replaying an edge that is already in the snapshot is
+    harmless).
+    """
+
+    log_path = f"{path}.log"
+
+    if os.path.exists(log_path):
+        os.replace(log_path, f"{log_path}.old")
+
+    fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    try:
+        log_inode = os.fstat(fd).st_ino
+    finally:
+        os.close(fd)
+
+    max_id = connection.execute(
+        text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar()
+
+    # Edges sorted by follower, then followed: that is already CSR order for
+    # the "following" direction.
+    following_offsets = array("i", [0]) * (max_id + 2)
+    follower_counts = array("i", [0]) * (max_id + 2)
+    following = array("i")
+    followed_by = array("i")
+
+    rows = connection.execute(text(
+        "SELECT user_following_id, user_being_followed_id FROM follows "
+        "ORDER BY user_following_id, user_being_followed_id"
+    ))
+
+    for follower, followed in rows:
+        following_offsets[follower + 1] += 1
+        follower_counts[followed + 1] += 1
+        following.append(followed)
+        followed_by.append(follower)
+
+    for i in range(1, max_id + 2):
+        following_offsets[i] += following_offsets[i - 1]
+        follower_counts[i] += follower_counts[i - 1]
+
+    # Counting sort into the reverse ("followers") direction. Followers come
+    # out sorted because the edges were read in follower order.
+    follower_offsets = array("i", follower_counts)
+    followers = array("i", [0]) * len(following)
+    cursor = array("i", follower_counts)
+
+    for followed, follower in zip(following, followed_by):
+        followers[cursor[followed]] = follower
+        cursor[followed] += 1
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, max_id, len(following), log_inode, 0))
+        for section in (following_offsets, following, follower_offsets, followers):
+            section.tofile(f)
+
+    os.replace(tmp_path, path)
+
+    return len(following)
+
+
+##############################################################################
+# Reading
+
+
+class FollowGraph:
+    """Read-only view of a snapshot plus the follow log written since.
+
+    Safe to share between threads: a lock covers every read, so none sees
+    a snapshot being swapped or closed under it.
+    """
+
+    def __init__(self, path, check_seconds=1.0):
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.check_seconds = check_seconds
+
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._stat = None
+        self._checked_at = 0
+        self._log = None
+        self._log_pos = 0
+        self._added = {}      # follower -> {followed: bool}, for the overlay
+        self._reverse = {}    # followed -> {follower: bool}
+
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, max_id, edges, log_inode, _ = HEADER.unpack_from(mapped)
+
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError(f"{self.path} is not a follow graph snapshot")
+
+        self._close()
+
+        ints = memoryview(mapped)[HEADER.size:].cast("i")
+        n = max_id + 2
+
+        self._mmap = mapped
+        self._ints = ints
+        self._following_offsets = ints[:n]
+        self._following = ints[n:n + edges]
+        self._follower_offsets = ints[n + edges:2 * n + edges]
+        self._followers = ints[2 * n + edges:]
+        self.max_id = max_id
+        self.edge_count = edges
+        self._stat = (stat.st_ino, stat.st_mtime_ns)
+
+        self._added = {}
+        self._reverse = {}
+        self._open_log(log_inode)
+
+    def _open_log(self, inode):
+        """Replay from the start of the log with `inode`: the current one,
+        or the rotated one if a newer build has started since. If neither,
+        wait for the current log to appear."""
+
+        self._close_log()
+
+        for log_path in (self.log_path, f"{self.log_path}.old"):
+            try:
+                log = open(log_path, "rb")
+            except FileNotFoundError:
+                continue
+
+            if os.fstat(log.fileno()).st_ino == inode:
+                self._log = log
+                return
+
+            log.close()
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+
+        self._log = None
+        self._log_pos = 0
+
+    def _close(self):
+        self._close_log()
+
+        if self._mmap is None:
+            return
+
+        for view in (self._following_offsets, self._following,
+                     self._follower_offsets, self._followers, self._ints):
+            view.release()
+
+        self._mmap.close()
+        self._mmap = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def refresh(self):
+        """Pick up a rebuilt snapshot and replay new log records."""
+
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        now = time.monotonic()
+
+        if now - self._checked_at >= self.check_seconds:
+            self._checked_at = now
+            stat = os.stat(self.path)
+
+            if (stat.st_ino, stat.st_mtime_ns) != self._stat:
+                self._open()
+
+        self._replay()
+
+        # A build has started a new log: finish the old one (above), then
+        # move on to the new one.
+        try:
+            current = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            return
+
+        if self._log is None or os.fstat(self._log.fileno()).st_ino != current:
+            self._close_log()
+            self._log = open(self.log_path, "rb")
+            self._replay()
+
+    def _replay(self):
+        if self._log is None:
+            return
+
+        self._log.seek(self._log_pos)
+        data = self._log.read()
+        usable = len(data) - len(data) % LOG_RECORD.size
+
+        for op, follower, followed in LOG_RECORD.iter_unpack(data[:usable]):
+            self._added.setdefault(follower, {})[followed] = op == FOLLOW
+            self._reverse.setdefault(followed, {})[follower] = op == FOLLOW
+
+        self._log_pos += usable
+
+    def _slice(self, offsets, neighbors, user_id):
+        if user_id > self.max_id:
+            return neighbors[0:0]
+
+        return neighbors[offsets[user_id]:offsets[user_id + 1]]
+
+    @staticmethod
+    def _contains(ids, other_id):
+        i = bisect.bisect_left(ids, other_id)
+        return i < len(ids) and ids[i] == other_id
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        with self._lock:
+            self._refresh()
+            overlay = self._added.get(user_id, {})
+
+            if other_id in overlay:
+                return overlay[other_id]
+
+            return self._contains(
+                self._slice(self._following_offsets, self._following, user_id),
+                other_id)
+
+    def following_ids(self, user_id):
+        """Ids `user_id` follows, in ascending order."""
+
+        with self._lock:
+            self._refresh()
+            return self._merge(
+                self._slice(self._following_offsets, self._following, user_id),
+                self._added.get(user_id))
+
+    def follower_ids(self, user_id):
+        """Ids following `user_id`, in ascending order."""
+
+        with self._lock:
+            self._refresh()
+            return self._merge(
+                self._slice(self._follower_offsets, self._followers, user_id),
+                self._reverse.get(user_id))
+
+    def following_count(self, user_id):
+        with self._lock:
+            self._refresh()
+            return self._count(
+                self._slice(self._following_offsets, self._following, user_id),
+                self._added.get(user_id))
+
+    def follower_count(self, user_id):
+        with self._lock:
+            self._refresh()
+            return self._count(
+                self._slice(self._follower_offsets, self._followers, user_id),
+                self._reverse.get(user_id))
+
+    def _count(self, ids, overlay):
+        count = len(ids)
+
+        for other_id, present in (overlay or {}).items():
+            count += present - self._contains(ids, other_id)
+
+        return count
+
+    @staticmethod
+    def _merge(ids, overlay):
+        if not overlay:
+            return ids.tolist()
+
+        result = set(ids.tolist())
+
+        for other_id, present in overlay.items():
+            if present:
+                result.add(other_id)
+            else:
+                result.discard(other_id)
+
+        return sorted(result)
+
+
+def record_follow(path, follower_id, followed_id, op=FOLLOW):
+    """Append a follow/unfollow to the log behind the snapshot at `path`."""
+
+    record_follows(path, [(op, follower_id, followed_id)])
+
+
+def record_follows(path, records):
+    """Append ``(op, follower id, followed id)`` records to the log behind
+    the snapshot at `path`.
+
+    One ``O_APPEND`` write, so records from concurrent workers never
+    interleave.
+    """
+
+    data = b"".join(LOG_RECORD.pack(*record) for record in records)
+
+    if not data:
+        return
+
+    fd = os.open(f"{path}.log", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+##############################################################################
+# Flask integration
+
+
+def init_follow_graph(app):
+    """Map the snapshot at ``FOLLOW_GRAPH_PATH``, if configured and built."""
+
+    app.cli.add_command(graph_cli)
+
+    path = app.config.get("FOLLOW_GRAPH_PATH")
+
+    if path and os.path.exists(path):
+        try:
+            app.extensions["follow_graph"] = FollowGraph(path)
+        except ValueError as e:
+            # e.g. a snapshot in an older format: serve from the database
+            # until it is rebuilt.
+            app.logger.warning("not using the follow graph: %s", e)
+
+
+def current_follow_graph():
+    """The current app's FollowGraph, or None."""
+
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get("follow_graph")
+
+
+def log_follow(follower_id, followed_id, op=FOLLOW):
+    """Record a committed follow/unfollow for the snapshot's overlay."""
+
+    path = current_app.config.get("FOLLOW_GRAPH_PATH")
+
+    if path:
+        record_follow(path, follower_id, followed_id, op)
+
+
+def log_deleted_user(user_id, following_ids, follower_ids):
+    """Record the follows removed (by cascade) with deleted user `user_id`."""
+
+    path = current_app.config.get("FOLLOW_GRAPH_PATH")
+
+    if path:
+        record_follows(path, [
+            *((UNFOLLOW, user_id, other_id) for other_id in following_ids),
+            *((UNFOLLOW, other_id, user_id) for other_id in follower_ids),
+        ])
+
+
+graph_cli = AppGroup("graph", help="Manage the follow graph snapshot.")
+
+
+@graph_cli.command("build")
+@click.option("--every", type=int, help="Rebuild every N seconds.")
+def build_command(every):
+    """Build the follow graph snapshot at FOLLOW_GRAPH_PATH."""
+
+    from models import db
+
+    path = current_app.config.get("FOLLOW_GRAPH_PATH")
+
+    if not path:
+        raise click.ClickException("FOLLOW_GRAPH_PATH is not configured.")
+
+    while True:
+        start = time.perf_counter()
+
+        with db.engine.connect() as conn:
+            edges = build_snapshot(conn, path)
+
+        click.echo(f"{edges} follows -> {path} "
+                   f"({os.path.getsize(path) / 1e6:.1f} MB, "
+                   f"{time.perf_counter() - start:.2f}s)")
+
+        if not every:
+            return
+
+        time.sleep(every)
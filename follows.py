@@ -0,0 +1,74 @@
+"""Paginated followers/following lists.
+
+Each page is one query on ``follows``: the listed user's edges are read in
+id order off an index (the primary key for followers,
+``ix_follows_user_following_id`` for following), starting after the cursor,
+and every row carries two EXISTS flags, both primary key lookups:
+
+- ``viewer_follows``: the logged-in viewer follows this user
+- ``follows_viewer``: this user follows the viewer
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import and_, exists, select
+from sqlalchemy.orm import aliased
+
+from models import db, Follow, User
+from streaming import Page
+
+PAGE_SIZE = 60
+
+FOLLOWERS = "followers"
+FOLLOWING = "following"
+
+FollowCard = namedtuple("FollowCard", "user viewer_follows follows_viewer")
+
+
+def _edge_exists(follower_id, followed_id):
+    edge = aliased(Follow)
+
+    return exists().where(and_(edge.user_following_id == follower_id,
+                               edge.user_being_followed_id == followed_id))
+
+
+def lazy_follow_page(user_id, direction, viewer_id, after=0, limit=PAGE_SIZE):
+    """``follow_page()`` as a ``Page`` of FollowCards, read while it is
+    iterated (for ``stream_page()``)."""
+
+    if direction == FOLLOWERS:
+        owner, other = Follow.user_being_followed_id, Follow.user_following_id
+    else:
+        owner, other = Follow.user_following_id, Follow.user_being_followed_id
+
+    stmt = (
+        select(
+            User,
+            _edge_exists(viewer_id, User.id).label("viewer_follows"),
+            _edge_exists(User.id, viewer_id).label("follows_viewer"),
+        )
+        .select_from(Follow)
+        .join(User, User.id == other)
+        .where(owner == user_id, other > after)
+        .order_by(other)
+        .limit(limit + 1)
+        .execution_options(yield_per=limit + 1)
+    )
+
+    result = db.session.execute(stmt)
+
+    return Page((FollowCard(*row) for row in result), limit,
+                lambda card: card.user.id)
+
+
+def follow_page(user_id, direction, viewer_id, after=0, limit=PAGE_SIZE):
+    """A page of `user_id`'s followers or followed users, in id order.
+
+    Returns ([FollowCard, ...], next_cursor); pass the cursor back as
+    `after` for the next page. It is None on the last page.
+    """
+
+    page = lazy_follow_page(user_id, direction, viewer_id, after, limit)
+    cards = list(page)
+
+    return cards, page.next_cursor
@@ -0,0 +1,373 @@
+"""Bulk message ingest and group commit.
+
+Posting through ``add_message()`` costs a request, a flush, index writes and
+a commit per message. This module has two faster paths that share one
+writer, ``write_messages()``. It inserts a batch of messages, their search
+postings and their tags/mentions with one multi-row statement per table.
+
+- ``POST /messages/bulk`` and ``flask messages ingest`` take NDJSON, one
+  ``{"text": ..., "timestamp": ...}`` object per line (``timestamp`` is
+  optional, ISO 8601). The route takes at most ``INGEST_MAX_BATCH`` lines
+  and ``INGEST_MAX_BYTES``.
+- ``GroupCommitter`` coalesces concurrent single posts. Each request hands
+  its message to a writer thread and waits. The writer takes whatever
+  has queued up (waiting at most ``INGEST_GROUP_COMMIT_WAIT_MS`` for more,
+  and taking at most ``INGEST_GROUP_COMMIT_MAX``) and commits it all in one
+  transaction. Under load one commit serves many requests, and no request
+  waits longer than the budget plus one commit. It only pays off when one
+  process handles several posts at once (threaded or async workers), so it
+  is off unless ``INGEST_GROUP_COMMIT`` is set. A post the writer hasn't
+  committed within the timeout raises ``CommitPending``; it may still commit,
+  so the caller registers what to do then with ``Pending.then()`` rather
+  than report a failure (and invite a duplicate retry).
+
+Core inserts bypass the ORM events, so callers run ``after_commit()`` to
+mirror the rows to the shards and invalidate cached profiles.
+
+See ``bench_ingest.py`` for throughput against the per-request path.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import insert, select
+
+from cache import touch
+from models import db, User, Message, MessageTerm
+from search import postings
+from sharding import get_router
+from tags import index_rows, write_rows
+
+MAX_LENGTH = Message.text.type.length
+CHUNK_SIZE = 1000
+
+
+class InvalidMessage(ValueError):
+    """A line of a batch that can't be posted."""
+
+
+class CommitPending(TimeoutError):
+    """The writer hasn't committed a message in time; it still may."""
+
+    def __init__(self, pending):
+        super().__init__("group commit timed out")
+        self.pending = pending
+
+
+##############################################################################
+# Parsing and writing
+
+
+def parse_line(line, now=None):
+    """{"text", "timestamp"} for one NDJSON `line`, or raise InvalidMessage."""
+
+    now = now or datetime.utcnow()
+
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise InvalidMessage("not JSON") from None
+
+    if not isinstance(data, dict):
+        raise InvalidMessage("not an object")
+
+    text = data.get("text")
+
+    if not isinstance(text, str) or not text.strip():
+        raise InvalidMessage("text is required")
+
+    if len(text) > MAX_LENGTH:
+        raise InvalidMessage(f"text is longer than {MAX_LENGTH} characters")
+
+    timestamp = now
+
+    if data.get("timestamp") is not None:
+        try:
+            timestamp = datetime.fromisoformat(data["timestamp"])
+        except (TypeError, ValueError):
+            raise InvalidMessage("timestamp is not ISO 8601") from None
+
+        if timestamp.tzinfo is not None or timestamp > now:
+            raise InvalidMessage("timestamp must be naive UTC and not in the future")
+
+    return {"text": text, "timestamp": timestamp}
+
+
+def parse_batch(lines):
+    """(messages, errors) for NDJSON `lines`; errors are (line number, reason).
+
+    Blank lines are skipped.
+    """
+
+    messages = []
+    errors = []
+    now = datetime.utcnow()
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            messages.append(parse_line(line, now))
+        except InvalidMessage as error:
+            errors.append((number, str(error)))
+
+    return messages, errors
+
+
+def write_messages(conn, user_id, messages, chunk_size=CHUNK_SIZE):
+    """Insert `messages` for `user_id` on `conn`, with their index rows.
+
+    Returns the inserted (id, text, timestamp, user_id) rows, in order.
+    """
+
+    inserted = []
+
+    for start in range(0, len(messages), chunk_size):
+        rows = conn.execute(
+            insert(Message).returning(
+                Message.id, Message.text, Message.timestamp, Message.user_id,
+                sort_by_parameter_order=True),
+            [{"user_id": user_id, **message}
+             for message in messages[start:start + chunk_size]],
+        ).all()
+
+        terms = [posting for row in rows for posting in postings(row)]
+
+        if terms:
+            conn.execute(insert(MessageTerm), terms)
+
+        write_rows(conn, *index_rows(conn, rows))
+        inserted.extend(rows)
+
+    return inserted
+
+
+def after_commit(rows):
+    """Mirror committed `rows` to the shards and invalidate their authors'
+    cached profiles (the ORM events do this for ``add_message()``)."""
+
+    router = get_router()
+
+    if router:
+        router.apply([("add_message", row.user_id, row._asdict()) for row in rows])
+
+    touch(*{f"user:{row.user_id}" for row in rows})
+
+
+##############################################################################
+# Group commit
+
+
+class Pending:
+    """One message waiting for the writer thread."""
+
+    def __init__(self, user_id, message):
+        self.user_id = user_id
+        self.message = message
+        self.row = None
+        self.error = None
+        self.done = threading.Event()
+        self._callback = None
+        self._lock = threading.Lock()
+
+    def wait(self, timeout):
+        if not self.done.wait(timeout):
+            raise CommitPending(self)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.row
+
+    def then(self, callback):
+        """Call `callback(row, error)` once the writer is done with this
+        message: on the writer thread, or right away if it already is."""
+
+        with self._lock:
+            if not self.done.is_set():
+                self._callback = callback
+                return
+
+        callback(self.row, self.error)
+
+    def finish(self, row=None, error=None):
+        with self._lock:
+            self.row = row
+            self.error = error
+            self.done.set()
+            callback = self._callback
+
+        if callback:
+            callback(row, error)
+
+
+class GroupCommitter:
+    """Commits messages from concurrent requests together."""
+
+    def __init__(self, engine, max_batch=100, max_wait=0.002, timeout=10):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.stats = Counter()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, user_id, message):
+        """Queue `message` and return its row once committed.
+
+        Raises ``CommitPending`` if that takes longer than ``timeout``.
+        """
+
+        self._start()
+        pending = Pending(user_id, message)
+        self._queue.put(pending)
+
+        return pending.wait(self.timeout)
+
+    def _start(self):
+        # Threads don't survive fork, so each worker starts its own.
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="group-commit",
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.engine.begin() as conn:
+                rows = []
+
+                for user_id in sorted({p.user_id for p in batch}):
+                    mine = [p for p in batch if p.user_id == user_id]
+                    rows.extend(zip(mine, write_messages(
+                        conn, user_id, [p.message for p in mine])))
+
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].finish(error=error)
+                return
+
+            # Don't let one bad message fail its neighbours.
+            self.stats["split_batches"] += 1
+
+            for pending in batch:
+                self._commit([pending])
+
+            return
+
+        self.stats["commits"] += 1
+        self.stats["messages"] += len(batch)
+
+        for pending, row in rows:
+            pending.finish(row)
+
+
+def current_committer():
+    """The current app's GroupCommitter, or None when group commit is off."""
+
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get("group_commit")
+
+
+##############################################################################
+# App setup and CLI
+
+
+messages_cli = AppGroup("messages", help="Bulk message operations.")
+
+
+def init_ingest(app):
+    if app.config.get("INGEST_GROUP_COMMIT"):
+        with app.app_context():
+            engine = db.engine
+
+        app.extensions["group_commit"] = GroupCommitter(
+            engine,
+            max_batch=app.config.get("INGEST_GROUP_COMMIT_MAX", 100),
+            max_wait=app.config.get("INGEST_GROUP_COMMIT_WAIT_MS", 2) / 1000,
+        )
+
+    app.cli.add_command(messages_cli)
+
+
+def ingest(engine, user_id, lines, batch_size=CHUNK_SIZE, echo=print):
+    """Post every valid line of `lines` as `user_id`, `batch_size` per commit.
+
+    Invalid lines are reported and skipped. Returns (posted, skipped).
+    """
+
+    posted = skipped = 0
+    batch = []
+
+    def flush():
+        nonlocal posted
+
+        with engine.begin() as conn:
+            rows = write_messages(conn, user_id, batch)
+
+        after_commit(rows)
+        posted += len(rows)
+        batch.clear()
+        echo(f"posted {posted} messages")
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            batch.append(parse_line(line))
+        except InvalidMessage as error:
+            skipped += 1
+            echo(f"line {number}: {error}")
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return posted, skipped
+
+
+@messages_cli.command("ingest")
+@click.argument("username")
+@click.argument("source", type=click.File("r"), default="-")
+@click.option("--batch-size", default=CHUNK_SIZE)
+def ingest_command(username, source, batch_size):
+    """Post NDJSON messages from SOURCE (default stdin) as USERNAME."""
+
+    user_id = db.session.execute(
+        select(User.id).where(User.username == username)).scalar()
+
+    if user_id is None:
+        raise click.ClickException(f"No user {username!r}.")
+
+    posted, skipped = ingest(db.engine, user_id, source, batch_size, echo=click.echo)
+    click.echo(f"done: {posted} posted, {skipped} skipped")
@@ -0,0 +1,109 @@
+"""Each user's likes page, newest like first.
+
+Pages are read off ``ix_likes_user_id_liked_at`` (user_id, liked_at,
+message_id) after a (liked_at, message_id) cursor, so a page costs the same
+however many likes the user has. Messages and their authors come back in the
+same query, as view objects (see views.py).
+
+Likes recorded before ``likes.liked_at`` existed have no time and are left
+off the page until ``flask likes backfill`` gives them one.
+"""
+
+from itertools import tee
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, tuple_, update
+
+from models import db, Like, Message, User
+from partitions import in_batch, like_batches
+from streaming import Page
+from tags import encode_cursor
+from views import MESSAGE_COLUMNS, iter_message_views
+
+PAGE_SIZE = 50
+
+
+def lazy_likes_page(user_id, before=None, limit=PAGE_SIZE):
+    """``likes_page()`` as a ``Page`` of (liked_at, message), read while it
+    is iterated (for ``stream_page()``)."""
+
+    stmt = (
+        select(*MESSAGE_COLUMNS, Like.liked_at)
+        .select_from(Like)
+        .join(Message, Message.id == Like.message_id)
+        .join(User, User.id == Message.user_id)
+        .where(Like.user_id == user_id, Like.liked_at.is_not(None))
+        .order_by(Like.liked_at.desc(), Like.message_id.desc())
+        .limit(limit + 1)
+        .execution_options(yield_per=limit + 1)
+    )
+
+    if before:
+        stmt = stmt.where(tuple_(Like.liked_at, Like.message_id) < tuple_(*before))
+
+    times, rows = tee(db.session.execute(stmt))
+    likes = zip((row.liked_at for row in times), iter_message_views(rows))
+
+    return Page(likes, limit,
+                lambda like: encode_cursor(like[0], like[1].id))
+
+
+def likes_page(user_id, before=None, limit=PAGE_SIZE):
+    """([(liked_at, message), ...], next_cursor) for `user_id`'s likes.
+
+    `before` is a decoded (liked_at, message id) cursor.
+    """
+
+    page = lazy_likes_page(user_id, before, limit)
+    likes = list(page)
+
+    return likes, page.next_cursor
+
+
+##############################################################################
+# Backfill
+
+
+likes_cli = AppGroup("likes", help="Maintain likes.")
+
+
+def init_likes(app):
+    app.cli.add_command(likes_cli)
+
+
+def backfill(engine, batch_size=10000, echo=print):
+    """Give likes without a ``liked_at`` their message's timestamp.
+
+    The real time is lost; a like can't predate its message, so that is the
+    closest honest value (and keeps such likes below every newer one). It is
+    copied from the like's own ``message_timestamp``, so messages aren't
+    read. Works through primary-key ranges of `batch_size` likes, committing
+    each, so it can be stopped and re-run at any point.
+    """
+
+    missing = Like.liked_at.is_(None) & Like.message_timestamp.is_not(None)
+    total = 0
+
+    for after, upto in like_batches(engine, missing, batch_size):
+        with engine.begin() as conn:
+            total += conn.execute(
+                update(Like)
+                .where(missing, *in_batch(after, upto))
+                .values(liked_at=Like.message_timestamp)
+            ).rowcount
+
+        echo(f"up to {upto or 'the end'}: {total} likes filled")
+
+    return total
+
+
+@likes_cli.command("backfill")
+@click.option("--batch-size", default=10000)
+def backfill_command(batch_size):
+    """Fill in liked_at for likes recorded before it existed.
+
+    Run ``flask partitions add-like-timestamps`` first.
+    """
+
+    backfill(db.engine, batch_size, echo=click.echo)
@@ -0,0 +1,197 @@
+"""Request-scoped batch loading of users and messages (a "DataLoader").
+
+Within a request, rows are asked for by id from many places: ``g.user``,
+``msg.user`` in a template loop, ``like.users``, ``User.query.get_or_404``.
+Each lazy relationship access is a separate ``SELECT ... WHERE id = ?``.
+
+Here every id that will probably be needed is queued instead. Loading a
+``Message`` or ``Like`` queues its ``user_id``, and code can queue more with
+``want()``. Just before a template renders (and on any ``load()`` miss) the
+queue is fetched with one ``IN`` query per model. The rows land in the
+session's identity map, so ``msg.user`` is then answered without SQL, and
+they are held for the rest of the request.
+
+Templates can call ``load_user(id)`` and ``load_message(id)``; Python code
+uses ``load(Model, id)``, ``load_many(Model, ids)`` and ``want(Model, ids)``.
+
+Per-request counters are kept in ``g.loader_stats`` and app-wide totals in
+``app.extensions["loader_stats"]``. With ``LOADER_STATS_HEADER`` each
+response reports them in an ``X-Loader-Stats`` header.
+"""
+
+from collections import Counter
+from itertools import islice
+
+from flask import abort, before_render_template, current_app, g, has_request_context
+from sqlalchemy import event, select
+from sqlalchemy.orm.util import identity_key
+
+from models import db, User, Message, Like
+
+BATCH_SIZE = 500
+
+# Model -> [(foreign key attribute, model it points to)], queued on load.
+PREFETCH = {
+    Message: [("user_id", User)],
+    Like: [("user_id", User)],
+}
+
+
+class BatchLoader:
+    """Collects ids of one model and fetches them together, memoized."""
+
+    def __init__(self, model, stats):
+        self.model = model
+        self.stats = stats
+        self.pending = set()
+        self.cache = {}
+
+    def want(self, ids):
+        """Queue `ids` for the next fetch."""
+
+        self.pending.update(i for i in ids if i is not None and i not in self.cache)
+
+    def dispatch(self):
+        """Fetch everything queued, in as few queries as possible."""
+
+        pending, self.pending = self.pending - self.cache.keys(), set()
+        session = db.session
+
+        for ident in list(pending):
+            key = identity_key(self.model, ident)
+
+            # Already loaded by some other query: just remember it.
+            if key in session.identity_map:
+                self.cache[ident] = session.identity_map[key]
+                pending.discard(ident)
+                self.stats["in_session"] += 1
+
+        ids = iter(sorted(pending))
+
+        while batch := list(islice(ids, BATCH_SIZE)):
+            found = session.execute(
+                select(self.model).where(self.model.id.in_(batch))).scalars()
+            self.cache.update((row.id, row) for row in found)
+            self.stats["queries"] += 1
+            self.stats["fetched"] += len(batch)
+
+        for ident in pending:
+            self.cache.setdefault(ident, None)
+
+    def load(self, ident):
+        """The row with id `ident` (or None), fetched with anything queued."""
+
+        if ident in self.cache:
+            self.stats["memo_hits"] += 1
+        else:
+            self.pending.add(ident)
+            self.dispatch()
+
+        return self.cache[ident]
+
+    def load_many(self, ids):
+        ids = list(ids)
+        self.want(ids)
+
+        if self.pending:
+            self.dispatch()
+
+        return [self.cache[ident] for ident in ids]
+
+
+##############################################################################
+# Per-request access
+
+
+def _loader(model):
+    loaders = g.setdefault("_loaders", {})
+
+    if model not in loaders:
+        loaders[model] = BatchLoader(model, g.setdefault("loader_stats", Counter()))
+
+    return loaders[model]
+
+
+def want(model, ids):
+    _loader(model).want(ids)
+
+
+def load(model, ident):
+    return _loader(model).load(ident)
+
+
+def load_many(model, ids):
+    return _loader(model).load_many(ids)
+
+
+def load_or_404(model, ident):
+    row = load(model, ident)
+
+    if row is None:
+        abort(404)
+
+    return row
+
+
+def dispatch_all(*args, **kwargs):
+    """Fetch every queued id (connected to ``before_render_template``).
+
+    Loading rows can queue more ids (a message queues its author), so this
+    repeats until nothing is pending.
+    """
+
+    loaders = g.get("_loaders", {})
+
+    while busy := [loader for loader in list(loaders.values()) if loader.pending]:
+        for loader in busy:
+            loader.dispatch()
+
+
+def saved(stats):
+    """Round-trips avoided: one per row fetched in a batch, less the
+    batches themselves, plus one per repeat lookup."""
+
+    return max(stats["fetched"] - stats["queries"], 0) + stats["memo_hits"]
+
+
+@event.listens_for(db.Model, "load", propagate=True)
+def _queue_related(target, context):
+    if not has_request_context():
+        return
+
+    for attribute, model in PREFETCH.get(type(target), ()):
+        _loader(model).want([getattr(target, attribute)])
+
+
+##############################################################################
+# App setup
+
+
+def init_loaders(app):
+    app.extensions["loader_stats"] = Counter()
+    app.jinja_env.globals.update(
+        load_user=lambda ident: load(User, ident),
+        load_message=lambda ident: load(Message, ident),
+    )
+    before_render_template.connect(dispatch_all, app)
+    app.before_request(_reset)
+    app.after_request(_report)
+
+
+def _reset():
+    g._loaders = {}
+    g.loader_stats = Counter()
+
+
+def _report(response):
+    stats = g.get("loader_stats")
+
+    if stats:
+        current_app.extensions["loader_stats"].update(stats)
+
+        if current_app.config.get("LOADER_STATS_HEADER"):
+            response.headers["X-Loader-Stats"] = (
+                f"queries={stats['queries']} fetched={stats['fetched']} "
+                f"saved={saved(stats)}")
+
+    return response
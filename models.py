@@ -1,12 +1,42 @@
 """SQLAlchemy models for Warbler."""
 
+import os
+import weakref
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BaseSession
+from sqlalchemy.dialects import postgresql, sqlite
+
+from followgraph import current_follow_graph
+
+
+class Session(BaseSession):
+    """Session that honours an explicit ``bind`` and read-replica routing.
+
+    Flask-SQLAlchemy always picks the engine from the model's bind key, so a
+    session configured with ``bind=connection`` would otherwise be ignored.
+    The tests use this to run every test inside one outer transaction.
+
+    When ``info["replica"]`` names a bind (set per request by replicas.py),
+    queries read from that engine; flushes always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            return self.bind
+
+        replica = self.info.get("replica")
+
+        if bind is None and replica and not self._flushing:
+            return self._db.engines[replica]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": Session})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -35,6 +65,12 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who X follows".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -143,16 +179,86 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        graph = current_follow_graph()
+
+        if graph:
+            return graph.is_following(other_user.id, self.id)
+
+        # By id, so view objects (see views.py) can be passed too.
+        return any(user.id == other_user.id for user in self.followers)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        graph = current_follow_graph()
+
+        if graph:
+            return graph.is_following(self.id, other_user.id)
+
+        return any(user.id == other_user.id for user in self.following)
+
+    def following_ids(self):
+        """Ids of the users this user follows."""
+
+        graph = current_follow_graph()
+
+        if graph:
+            return graph.following_ids(self.id)
+
+        if self._loaded("following"):
+            return [user.id for user in self.following]
+
+        return [
+            follow.user_being_followed_id
+            for follow in Follow.query.filter_by(user_following_id=self.id)
+        ]
+
+    @property
+    def following_count(self):
+        graph = current_follow_graph()
+
+        if graph:
+            return graph.following_count(self.id)
+
+        if self._loaded("following"):
+            return len(self.following)
+
+        return Follow.query.filter_by(user_following_id=self.id).count()
+
+    @property
+    def followers_count(self):
+        graph = current_follow_graph()
+
+        if graph:
+            return graph.follower_count(self.id)
+
+        if self._loaded("followers"):
+            return len(self.followers)
+
+        return Follow.query.filter_by(user_being_followed_id=self.id).count()
+
+    @property
+    def messages_count(self):
+        if self._loaded("messages"):
+            return len(self.messages)
+
+        return Message.query.filter_by(user_id=self.id).count()
+
+    @property
+    def likes_count(self):
+        if self._loaded("likes"):
+            return len(self.likes)
+
+        return Like.query.filter_by(user_id=self.id).count()
+
+    def _loaded(self, relationship):
+        """Is `relationship` already in memory (e.g. eager-loaded)?
+
+        Then counts and id lists come from it rather than a query, which
+        matters under ``async_app`` where nothing may lazy-load.
+        """
+
+        return relationship not in db.inspect(self).unloaded
 
 
 class Message(db.Model):
@@ -185,6 +291,44 @@ class Message(db.Model):
     liked_by = db.relationship('User', secondary="likes", backref='liked_messages')
 
 
+class MessageTerm(db.Model):
+    """One posting in the message search index (see search.py).
+
+    The message's timestamp is copied in so a term's postings can be read
+    newest-first straight off the index.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.String(40),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # Space-separated word positions of `term` in the message, for phrases.
+    positions = db.Column(
+        db.String(200),
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_terms_term_timestamp',
+                 'term', 'timestamp', 'message_id'),
+        # For scoring, prefix filters and unindexing, which go by message.
+        db.Index('ix_message_terms_message_id_term', 'message_id', 'term'),
+    )
+
 
 class Like(db.Model):
     """An individual like ("warble")."""
@@ -203,15 +347,300 @@ class Like(db.Model):
         primary_key=True
     )
 
+    # Copy of the message's timestamp: likes are partitioned by it, so they
+    # live in the same month as their message (see partitions.py). Older
+    # databases get it from ``flask partitions add-like-timestamps``.
+    message_timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # When the like happened. Null only for likes from before this column
+    # existed, until ``flask likes backfill`` fills them (see likes.py).
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=True,
+        default=datetime.utcnow,
+    )
+
     users = db.relationship('User', backref='likes')
 
+    __table_args__ = (
+        db.Index('ix_likes_user_id_liked_at', 'user_id', 'liked_at', 'message_id'),
+    )
+
+
+class Tag(db.Model):
+    """A hashtag; messages refer to it by id (see tags.py)."""
+
+    __tablename__ = 'tags'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.String(40),
+        nullable=False,
+        unique=True,
+    )
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message. Keyed for newest-first tag timelines."""
+
+    __tablename__ = 'message_tags'
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message. Keyed for newest-first feeds."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+
+class Recommendation(db.Model):
+    """A suggested account for a user to follow ("who to follow").
+
+    Computed in batch by recommendations.py; `rank` 0 is the best match.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    candidate = db.relationship('User', foreign_keys=[candidate_id])
+
+    __table_args__ = (
+        db.Index('ix_recommendations_user_id_rank', 'user_id', 'rank'),
+    )
+
+    @classmethod
+    def for_user_query(cls, user_id, limit=5):
+        """Select the top `limit` suggestions for `user_id`, with the
+        candidate loaded."""
+
+        return (db.select(cls)
+                .filter_by(user_id=user_id)
+                .order_by(cls.rank)
+                .options(db.joinedload(cls.candidate))
+                .limit(limit))
+
+    @classmethod
+    def for_user(cls, user_id, limit=5):
+        """Top `limit` suggestions for `user_id`, with the candidate loaded."""
+
+        return db.session.scalars(cls.for_user_query(user_id, limit)).all()
+
+
+class StaleRecommendation(db.Model):
+    """A user whose follows or likes changed since recommendations were built.
+
+    ``flask recommendations build --incremental`` refreshes these users
+    (and their followers) and then clears the table.
+    """
+
+    __tablename__ = 'stale_recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    @classmethod
+    def mark(cls, user_id):
+        """Flag `user_id` for the next incremental refresh (in this session).
+
+        Ignores a flag that's already there, so two concurrent likes or
+        follows by the same user can't conflict.
+        """
+
+        conn = db.session.connection()
+        dialect = {"postgresql": postgresql, "sqlite": sqlite}[conn.dialect.name]
+        conn.execute(dialect.insert(cls.__table__)
+                     .values(user_id=user_id)
+                     .on_conflict_do_nothing())
+
+
+class Notification(db.Model):
+    """Likes of one message, or follows of one user, in one time window,
+    coalesced into a single row: "@actor and `actor_count - 1` others ..."
+
+    Written in batches by notifications.py; `target_id` is the message for
+    likes and the recipient themselves for follows.
+    """
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    target_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    window_start = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    # The most recent actor.
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='SET NULL'),
+        nullable=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('recipient_id', 'kind', 'target_id', 'window_start',
+                            name='uq_notifications_window'),
+        db.Index('ix_notifications_recipient_id_updated_at',
+                 'recipient_id', 'updated_at', 'id'),
+    )
+
+
+class NotificationCounter(db.Model):
+    """A user's unread notification count, kept as notifications are written
+    so the nav bar never counts rows."""
+
+    __tablename__ = 'notification_counters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # When the user last opened their notifications.
+    seen_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app factory. No app context is pushed;
+    use ``with app.app_context():`` for work outside of a request.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+    _connected_apps.add(app)
+
+
+# Apps whose pools must be reset in a forked child (e.g. gunicorn --preload).
+_connected_apps = weakref.WeakSet()
+
+
+def dispose_engines_after_fork(apps=None):
+    """Forget pooled connections inherited from the parent process.
+
+    ``close=False`` leaves the parent's sockets alone; the child simply
+    starts with an empty pool and opens its own connections. Defaults to
+    every app passed to ``connect_db``.
+    """
+
+    for app in list(_connected_apps if apps is None else apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=dispose_engines_after_fork)
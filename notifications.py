@@ -0,0 +1,391 @@
+"""Coalesced notifications for likes and follows.
+
+``like_message()`` and ``start_following()`` call ``notify()`` after they
+commit. Events are coalesced per (recipient, kind, target, window), where
+windows are ``NOTIFICATIONS_WINDOW_SECONDS`` long. A viral message
+therefore gets one row per window, "@last_liker and 240 others liked your
+warble", not one row per like.
+
+Coalescing happens twice:
+
+- In memory. A ``NotificationBuffer`` folds events into one entry per key,
+  so it grows with distinct keys, not events. A writer thread flushes it
+  every ``NOTIFICATIONS_FLUSH_SECONDS``, or sooner once
+  ``NOTIFICATIONS_FLUSH_SIZE`` keys are waiting.
+- In the database. ``write_notifications()`` upserts every key with one
+  statement, adding to ``actor_count`` when the row already exists.
+
+The same write keeps each recipient's unread count in
+``notification_counters``. The count goes up when a notification is new,
+or when one the user has already seen gets fresh activity. The nav bar
+reads that one row, and opening ``/notifications`` zeroes it. Two workers
+flushing the same new key at once can count it twice;
+``flask notifications recount`` rebuilds the counters from the rows.
+
+Buffered events are lost if a worker dies before flushing them, which is
+at most a few seconds' worth. Unlikes and unfollows don't retract
+anything. With ``NOTIFICATIONS_BUFFERED`` off (as in tests), ``notify()``
+writes straight away on the request's session.
+"""
+
+import atexit
+import os
+import threading
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased
+
+from models import db, Message, Notification, NotificationCounter, User
+from replicas import use_primary
+from tags import encode_cursor
+
+LIKE = "like"
+FOLLOW = "follow"
+
+PAGE_SIZE = 50
+CHUNK_SIZE = 500
+
+EPOCH = datetime(1970, 1, 1)
+
+KEY_COLUMNS = ("recipient_id", "kind", "target_id", "window_start")
+
+NotificationView = namedtuple(
+    "NotificationView",
+    "id kind target_id actor_count updated_at actor_id actor_username "
+    "actor_image_url message_text unread")
+
+
+def window_start(at, seconds):
+    """Start of the `seconds`-long window that `at` falls in."""
+
+    offset = (at - EPOCH) // timedelta(seconds=seconds) * seconds
+
+    return EPOCH + timedelta(seconds=offset)
+
+
+def coalesce(pending, kind, recipient_id, target_id, actor_id, at, window):
+    """Fold one event into `pending` {key: (actor count, last actor, last at)}."""
+
+    key = (recipient_id, kind, target_id, window_start(at, window))
+    count = pending[key][0] if key in pending else 0
+    pending[key] = (count + 1, actor_id, at)
+
+
+def upsert(conn, table):
+    dialect = {"postgresql": postgresql, "sqlite": sqlite}[conn.dialect.name]
+    return dialect.insert(table)
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = iter(items)
+
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+##############################################################################
+# Writing
+
+
+def write_notifications(conn, pending):
+    """Upsert coalesced `pending` entries and bump the recipients' unread
+    counters, on `conn` (the caller commits)."""
+
+    table = Notification.__table__
+    key = tuple_(*(table.c[name] for name in KEY_COLUMNS))
+    existing = {}
+
+    for chunk in chunks(pending):
+        existing.update(
+            (tuple(row[:4]), row.updated_at)
+            for row in conn.execute(
+                select(*(table.c[name] for name in KEY_COLUMNS), table.c.updated_at)
+                .where(key.in_(chunk))))
+
+    recipients = sorted({recipient for recipient, *_ in pending})
+    seen = dict(conn.execute(
+        select(NotificationCounter.user_id, NotificationCounter.seen_at)
+        .where(NotificationCounter.user_id.in_(recipients))).all())
+
+    stmt = upsert(conn, table)
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=list(KEY_COLUMNS),
+            set_={
+                "actor_count": table.c.actor_count + stmt.excluded.actor_count,
+                "actor_id": stmt.excluded.actor_id,
+                "updated_at": stmt.excluded.updated_at,
+            }),
+        [{**dict(zip(KEY_COLUMNS, k)), "actor_count": count, "actor_id": actor_id,
+          "updated_at": at}
+         for k, (count, actor_id, at) in pending.items()])
+
+    # New rows, and rows the recipient had already seen, become unread.
+    unread = Counter(
+        k[0] for k in pending
+        if k not in existing or (seen.get(k[0]) and existing[k] <= seen[k[0]]))
+
+    if unread:
+        counters = NotificationCounter.__table__
+        stmt = upsert(conn, counters)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={"unread": counters.c.unread + stmt.excluded.unread}),
+            [{"user_id": user_id, "unread": count} for user_id, count in unread.items()])
+
+
+class NotificationBuffer:
+    """Coalesces events in memory; a writer thread flushes them in batches."""
+
+    def __init__(self, engine, window, max_pending=500, max_wait=2.0):
+        self.engine = engine
+        self.window = window
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.stats = Counter()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def add(self, kind, recipient_id, target_id, actor_id, at):
+        self._start()
+
+        with self._lock:
+            coalesce(self._pending, kind, recipient_id, target_id, actor_id, at,
+                     self.window)
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything pending now. Returns the number of keys written."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        try:
+            with self.engine.begin() as conn:
+                write_notifications(conn, pending)
+        except Exception:
+            # Put them back (merged with anything newer) for the next flush.
+            self.stats["errors"] += 1
+
+            with self._lock:
+                for k, (count, actor_id, at) in pending.items():
+                    if k in self._pending:
+                        newer, actor_id, at = self._pending[k]
+                        count += newer
+
+                    self._pending[k] = (count, actor_id, at)
+
+            raise
+
+        self.stats["flushes"] += 1
+        self.stats["keys"] += len(pending)
+        self.stats["events"] += sum(count for count, _, _ in pending.values())
+
+        return len(pending)
+
+    def _start(self):
+        # Threads don't survive fork, so each worker starts its own.
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="notifications",
+                                 daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_wait)
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                pass  # kept for the next round; counted in stats
+
+
+def current_buffer():
+    """The current app's NotificationBuffer, or None when writes aren't buffered."""
+
+    return current_app.extensions.get("notifications")
+
+
+def notify(kind, recipient_id, target_id, actor_id):
+    """Record that `actor_id` liked message `target_id` / followed
+    `recipient_id`. Call after the like or follow has committed."""
+
+    if recipient_id == actor_id:
+        return
+
+    at = datetime.utcnow()
+    buffer = current_buffer()
+
+    if buffer is not None:
+        buffer.add(kind, recipient_id, target_id, actor_id, at)
+        return
+
+    pending = {}
+    coalesce(pending, kind, recipient_id, target_id, actor_id, at,
+             current_app.config.get("NOTIFICATIONS_WINDOW_SECONDS", 24 * 60 * 60))
+    write_notifications(db.session.connection(), pending)
+    db.session.commit()
+
+
+##############################################################################
+# Reading
+
+
+def unread_count(user_id):
+    """`user_id`'s unread notifications, from their counter row."""
+
+    return db.session.execute(unread_count_query(user_id)).scalar() or 0
+
+
+def unread_count_query(user_id):
+    """Select `user_id`'s unread count (None if they have no counter row)."""
+
+    return (select(NotificationCounter.unread)
+            .where(NotificationCounter.user_id == user_id))
+
+
+def unread_context():
+    """``unread_notifications`` for the nav badge, looked up before the page
+    renders. Async views set ``g.unread_notifications`` themselves, from
+    their own session."""
+
+    if not g.get("user"):
+        return {"unread_notifications": 0}
+
+    if "unread_notifications" not in g:
+        g.unread_notifications = unread_count(g.user.id)
+
+    return {"unread_notifications": g.unread_notifications}
+
+
+def mark_seen(user_id):
+    """Zero `user_id`'s unread count. Returns when they last looked before
+    now (None if never). Commits, on the primary even in a GET request."""
+
+    use_primary()
+    previous = db.session.execute(
+        select(NotificationCounter.seen_at)
+        .where(NotificationCounter.user_id == user_id)).scalar()
+
+    counters = NotificationCounter.__table__
+    stmt = upsert(db.session.connection(), counters).values(
+        user_id=user_id, unread=0, seen_at=datetime.utcnow())
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"unread": 0, "seen_at": stmt.excluded.seen_at}))
+    db.session.commit()
+
+    return previous
+
+
+def notifications_page(user_id, before=None, seen_at=None, limit=PAGE_SIZE):
+    """([NotificationView, ...], next_cursor) for `user_id`, most recently
+    active first.
+
+    `before` is a decoded (updated_at, id) cursor; rows active after
+    `seen_at` are flagged unread.
+    """
+
+    actor = aliased(User)
+    stmt = (
+        select(Notification.id, Notification.kind, Notification.target_id,
+               Notification.actor_count, Notification.updated_at,
+               Notification.actor_id, actor.username, actor.image_url,
+               Message.text)
+        .outerjoin(actor, actor.id == Notification.actor_id)
+        .outerjoin(Message, and_(Notification.kind == LIKE,
+                                 Message.id == Notification.target_id))
+        .where(Notification.recipient_id == user_id)
+        .order_by(Notification.updated_at.desc(), Notification.id.desc())
+        .limit(limit + 1)
+    )
+
+    if before:
+        stmt = stmt.where(
+            tuple_(Notification.updated_at, Notification.id) < tuple_(*before))
+
+    rows = db.session.execute(stmt).all()
+    page = [NotificationView(*row, unread=seen_at is None or row.updated_at > seen_at)
+            for row in rows[:limit]]
+
+    if len(rows) > limit:
+        return page, encode_cursor(page[-1].updated_at, page[-1].id)
+
+    return page, None
+
+
+##############################################################################
+# App setup and CLI
+
+
+notifications_cli = AppGroup("notifications", help="Maintain notifications.")
+
+
+def init_notifications(app):
+    if app.config.get("NOTIFICATIONS_BUFFERED"):
+        with app.app_context():
+            engine = db.engine
+
+        buffer = NotificationBuffer(
+            engine,
+            window=app.config.get("NOTIFICATIONS_WINDOW_SECONDS", 24 * 60 * 60),
+            max_pending=app.config.get("NOTIFICATIONS_FLUSH_SIZE", 500),
+            max_wait=app.config.get("NOTIFICATIONS_FLUSH_SECONDS", 2),
+        )
+        app.extensions["notifications"] = buffer
+        atexit.register(buffer.flush)
+
+    app.context_processor(unread_context)
+    app.cli.add_command(notifications_cli)
+
+
+def recount(conn):
+    """Rebuild every unread counter from the notification rows."""
+
+    seen_at = (select(NotificationCounter.seen_at)
+               .where(NotificationCounter.user_id == Notification.recipient_id)
+               .scalar_subquery())
+    counts = conn.execute(
+        select(Notification.recipient_id, func.count())
+        .where((seen_at.is_(None)) | (Notification.updated_at > seen_at))
+        .group_by(Notification.recipient_id)).all()
+
+    counters = NotificationCounter.__table__
+    conn.execute(counters.update().values(unread=0))
+
+    if counts:
+        stmt = upsert(conn, counters)
+        conn.execute(
+            stmt.on_conflict_do_update(index_elements=["user_id"],
+                                       set_={"unread": stmt.excluded.unread}),
+            [{"user_id": user_id, "unread": count} for user_id, count in counts])
+
+    return len(counts)
+
+
+@notifications_cli.command("recount")
+def recount_command():
+    """Rebuild unread notification counters from the notifications."""
+
+    with db.engine.begin() as conn:
+        users = recount(conn)
+
+    click.echo(f"{users} users have unread notifications")
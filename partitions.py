@@ -0,0 +1,566 @@
+"""Monthly range partitioning of messages and likes, with a cold tier.
+
+PostgreSQL only. ``flask partitions convert`` rebuilds ``messages`` as a table
+partitioned by ``timestamp`` and ``likes`` as one partitioned by
+``message_timestamp`` (the liked message's timestamp), one partition per
+calendar month:
+
+    messages_p2023_05, likes_p2023_05, ..., messages_default, likes_default
+
+A like always lands in the same month as its message, so the two tables are
+tiered together. Postgres needs the partition key in every unique key, so
+the primary key of messages becomes (id, timestamp). Tables that reference
+a message (likes, message_terms, message_tags, mentions) carry its timestamp
+and get composite foreign keys. The ORM keeps treating ``Message.id`` as the
+identity; lookups by id alone probe each partition's primary key index.
+
+``flask partitions maintain`` (run it daily from cron) does two things:
+
+- creates partitions ``PARTITION_MONTHS_AHEAD`` months ahead. The default
+  partitions only catch stragglers, so inserts never fail.
+- moves months older than ``MESSAGES_HOT_DAYS`` to the archive tier. The
+  partition is rewritten in feed order (CLUSTER) with fillfactor 100, frozen,
+  and optionally moved to ``PARTITION_ARCHIVE_TABLESPACE`` (cheaper disk).
+  It stays attached, so every ``Message`` query still sees it, and
+  autovacuum has nothing left to do there.
+
+With ``FEED_HOT_ONLY`` the homepage feed only looks back ``MESSAGES_HOT_DAYS``
+days, so the planner prunes it to the hot partitions.
+
+On SQLite (development, tests) none of this applies and the tables stay
+plain.
+
+A database created before ``likes.message_timestamp`` existed needs it before
+this version is deployed: ``flask partitions add-like-timestamps`` adds the
+column (nullable), fills it from messages a batch at a time, and only once
+no nulls are left makes it NOT NULL. It can be stopped and re-run at any
+point. (``convert`` copies the timestamps from messages itself.)
+"""
+
+import re
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import (
+    Column, Date, DateTime, String, event, func, insert, select, text, tuple_,
+    update,
+)
+
+from models import db, Message, Like
+
+# Partitioned table -> its partition key.
+PARTITIONED = {
+    "messages": "timestamp",
+    "likes": "message_timestamp",
+}
+
+# Tables with a foreign key to messages(id), and their copy of its timestamp.
+DEPENDENTS = {
+    "message_terms": "timestamp",
+    "message_tags": "timestamp",
+    "mentions": "timestamp",
+}
+
+# Index each archived partition is clustered on: the one its reads use.
+CLUSTER_ON = {
+    "messages": "ix_messages_user_id_timestamp",
+    "likes": "likes_pkey",
+}
+
+HOT = "hot"
+ARCHIVE = "archive"
+
+# Which months have been moved to the archive tier.
+message_partitions = db.Table(
+    "message_partitions",
+    Column("month", Date, primary_key=True),
+    Column("tier", String(10), nullable=False),
+    Column("tiered_at", DateTime, nullable=True),
+)
+
+
+##############################################################################
+# Months
+
+
+def month_start(moment):
+    """First day of `moment`'s month."""
+
+    return date(moment.year, moment.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def months(first, last):
+    """Every month from `first` to `last`, inclusive."""
+
+    month = month_start(first)
+
+    while month <= last:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y_%m}"
+
+
+def partition_month(table, name):
+    """The month of partition `name` of `table`; None for the default one."""
+
+    match = re.fullmatch(rf"{table}_p(\d{{4}})_(\d{{2}})", name)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+def hot_cutoff(now=None, hot_days=None):
+    """Messages older than this are cold."""
+
+    if hot_days is None:
+        hot_days = current_app.config.get("MESSAGES_HOT_DAYS", 180)
+
+    return (now or datetime.utcnow()) - timedelta(days=hot_days)
+
+
+def feed_cutoff():
+    """Oldest timestamp the homepage feed reads, or None for no limit."""
+
+    if current_app.config.get("FEED_HOT_ONLY"):
+        return hot_cutoff()
+
+
+def due_for_archive(hot_months, now, hot_days):
+    """The months in `hot_months` that ended before the hot cutoff."""
+
+    cutoff = month_start(hot_cutoff(now, hot_days))
+    return [month for month in hot_months if add_months(month, 1) <= cutoff]
+
+
+@event.listens_for(Like, "before_insert")
+def _fill_message_timestamp(mapper, connection, like):
+    """Likes need their message's timestamp (the partition key)."""
+
+    if like.message_timestamp is None:
+        like.message_timestamp = connection.execute(
+            select(Message.timestamp).where(Message.id == like.message_id)
+        ).scalar()
+
+
+##############################################################################
+# DDL
+
+
+def create_partition_sql(table, month):
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} "
+        f"PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+    )
+
+
+def require_postgres(engine):
+    if engine.dialect.name != "postgresql":
+        raise click.ClickException("Partitioning needs PostgreSQL.")
+
+
+def is_partitioned(conn, table="messages"):
+    kind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {"table": table},
+    ).scalar()
+
+    return kind == "p"
+
+
+def partitions(conn, table):
+    """{month: partition name} for `table`'s monthly partitions."""
+
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"
+    ), {"table": table}).scalars()
+
+    found = {partition_month(table, name): name for name in names}
+    found.pop(None, None)
+
+    return found
+
+
+def ensure_partitions(conn, now=None, ahead=3):
+    """Create every monthly partition up to `ahead` months from `now`.
+
+    Returns the names created.
+    """
+
+    now = now or datetime.utcnow()
+    created = []
+
+    for table in PARTITIONED:
+        existing = partitions(conn, table)
+        first = min(existing, default=month_start(now))
+
+        for month in months(first, add_months(month_start(now), ahead)):
+            if month not in existing:
+                conn.execute(text(create_partition_sql(table, month)))
+                created.append(partition_name(table, month))
+
+    return created
+
+
+def convert(conn, now=None, ahead=3):
+    """Rebuild plain messages and likes tables as partitioned ones.
+
+    Runs in the caller's transaction; the tables are locked throughout.
+    """
+
+    now = now or datetime.utcnow()
+
+    conn.execute(text("LOCK TABLE messages, likes IN ACCESS EXCLUSIVE MODE"))
+
+    references = conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = to_regclass('messages')"
+    )).all()
+    unknown = {table for table, _ in references} - {"likes", *DEPENDENTS}
+
+    if unknown:
+        raise click.ClickException(
+            f"Unexpected foreign keys to messages from: {', '.join(sorted(unknown))}")
+
+    for table, constraint in references:
+        if table in DEPENDENTS:
+            conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {constraint}"))
+
+    for table in PARTITIONED:
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned"))
+        conn.execute(text(
+            f"ALTER INDEX {table}_pkey RENAME TO {table}_unpartitioned_pkey"))
+
+    conn.execute(text(
+        "CREATE TABLE messages ("
+        " LIKE messages_unpartitioned INCLUDING DEFAULTS,"
+        ' CONSTRAINT messages_pkey PRIMARY KEY (id, "timestamp"),'
+        " FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"
+        ') PARTITION BY RANGE ("timestamp")'
+    ))
+    conn.execute(text(
+        'CREATE INDEX ix_messages_user_id_timestamp ON messages (user_id, "timestamp")'))
+
+    conn.execute(text(
+        "CREATE TABLE likes ("
+        " user_id INTEGER NOT NULL,"
+        " message_id INTEGER NOT NULL,"
+        " message_timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+        " liked_at TIMESTAMP WITHOUT TIME ZONE,"
+        " CONSTRAINT likes_pkey PRIMARY KEY (user_id, message_id, message_timestamp),"
+        " FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,"
+        " FOREIGN KEY (message_id, message_timestamp)"
+        '  REFERENCES messages (id, "timestamp") ON DELETE CASCADE'
+        ") PARTITION BY RANGE (message_timestamp)"
+    ))
+    conn.execute(text("CREATE INDEX ix_likes_message_id ON likes (message_id)"))
+    conn.execute(text(
+        "CREATE INDEX ix_likes_user_id_liked_at ON likes (user_id, liked_at, message_id)"))
+
+    oldest = conn.execute(
+        text('SELECT MIN("timestamp") FROM messages_unpartitioned')).scalar()
+
+    for table in PARTITIONED:
+        for month in months(oldest or now, add_months(month_start(now), ahead)):
+            conn.execute(text(create_partition_sql(table, month)))
+
+        conn.execute(text(
+            f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+
+    conn.execute(text(
+        'INSERT INTO messages (id, text, "timestamp", user_id) '
+        'SELECT id, text, "timestamp", user_id FROM messages_unpartitioned'
+    ))
+    conn.execute(text(
+        "INSERT INTO likes (user_id, message_id, message_timestamp, liked_at) "
+        'SELECT l.user_id, l.message_id, m."timestamp", l.liked_at '
+        "FROM likes_unpartitioned l "
+        "JOIN messages_unpartitioned m ON m.id = l.message_id"
+    ))
+
+    sequence = conn.execute(text(
+        "SELECT pg_get_serial_sequence('messages_unpartitioned', 'id')")).scalar()
+
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY messages.id"))
+
+    conn.execute(text("DROP TABLE likes_unpartitioned, messages_unpartitioned"))
+
+    for table, timestamp in DEPENDENTS.items():
+        conn.execute(text(
+            f'ALTER TABLE {table} ADD FOREIGN KEY (message_id, "{timestamp}") '
+            f'REFERENCES messages (id, "timestamp") ON DELETE CASCADE'
+        ))
+
+
+##############################################################################
+# Archive tier
+
+
+def tiers(conn):
+    """{month: tier} recorded in ``message_partitions``."""
+
+    return dict(conn.execute(
+        select(message_partitions.c.month, message_partitions.c.tier)).all())
+
+
+def _partition_index(conn, partition, parent_index):
+    """Name of `partition`'s copy of the partitioned index `parent_index`."""
+
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_index x "
+        "JOIN pg_class c ON c.oid = x.indexrelid "
+        "JOIN pg_inherits h ON h.inhrelid = x.indexrelid "
+        "WHERE x.indrelid = to_regclass(:partition) "
+        "AND h.inhparent = to_regclass(:parent)"
+    ), {"partition": partition, "parent": parent_index}).scalar()
+
+
+def archive_month(engine, month, tablespace=None, echo=print):
+    """Compact one month's partitions and mark them archived.
+
+    CLUSTER and VACUUM can't run inside a transaction block, so this uses an
+    autocommit connection; each step is safe to repeat if interrupted.
+    """
+
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        for table in PARTITIONED:
+            name = partition_name(table, month)
+            index = _partition_index(conn, name, CLUSTER_ON[table])
+
+            conn.execute(text(f"ALTER TABLE {name} SET (fillfactor = 100)"))
+            conn.execute(text(f"CLUSTER {name} USING {index}"))
+
+            if tablespace:
+                conn.execute(text(f"ALTER TABLE {name} SET TABLESPACE {tablespace}"))
+                indexes = conn.execute(text(
+                    "SELECT indexname FROM pg_indexes WHERE tablename = :name"
+                ), {"name": name}).scalars().all()
+
+                for index_name in indexes:
+                    conn.execute(text(
+                        f"ALTER INDEX {index_name} SET TABLESPACE {tablespace}"))
+
+            conn.execute(text(f"VACUUM (FREEZE, ANALYZE) {name}"))
+            echo(f"archived {name}")
+
+        conn.execute(
+            message_partitions.delete().where(message_partitions.c.month == month))
+        conn.execute(insert(message_partitions), {
+            "month": month, "tier": ARCHIVE, "tiered_at": datetime.utcnow()})
+
+
+def maintain(engine, now=None, ahead=3, hot_days=180, tablespace=None,
+             echo=print):
+    """Create upcoming partitions, then archive months that have gone cold."""
+
+    now = now or datetime.utcnow()
+    require_postgres(engine)
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            raise click.ClickException(
+                "messages is not partitioned yet; run `flask partitions convert`.")
+
+        message_partitions.create(conn, checkfirst=True)
+
+        for name in ensure_partitions(conn, now, ahead):
+            echo(f"created {name}")
+
+        recorded = tiers(conn)
+        hot = [month for month in partitions(conn, "messages")
+               if recorded.get(month, HOT) == HOT]
+
+    for month in due_for_archive(sorted(hot), now, hot_days):
+        archive_month(engine, month, tablespace, echo)
+
+
+##############################################################################
+# Likes' message timestamps
+
+
+def like_batches(engine, condition, batch_size=10000):
+    """Split the likes matching `condition` into primary-key ranges of about
+    `batch_size` rows.
+
+    Yields (after, upto) keys: a batch is the likes with a (user_id,
+    message_id) above `after` (None: from the start) and up to `upto` (None:
+    to the end). Each range is found when the previous one has been used, so
+    rows the caller changed to no longer match are skipped.
+    """
+
+    key = tuple_(Like.user_id, Like.message_id)
+    after = None
+
+    while True:
+        stmt = (select(Like.user_id, Like.message_id)
+                .where(condition)
+                .order_by(Like.user_id, Like.message_id)
+                .offset(batch_size - 1)
+                .limit(1))
+
+        if after:
+            stmt = stmt.where(key > tuple_(*after))
+
+        with engine.connect() as conn:
+            upto = conn.execute(stmt).first()
+
+        yield after, upto and tuple(upto)
+
+        if upto is None:
+            return
+
+        after = tuple(upto)
+
+
+def in_batch(after, upto):
+    """WHERE clause for a batch from ``like_batches``."""
+
+    key = tuple_(Like.user_id, Like.message_id)
+    clauses = []
+
+    if after:
+        clauses.append(key > tuple_(*after))
+
+    if upto:
+        clauses.append(key <= tuple_(*upto))
+
+    return clauses
+
+
+def add_like_timestamps(engine, batch_size=10000, echo=print):
+    """Add, fill and then require ``likes.message_timestamp``.
+
+    Returns how many likes are still missing one (0 once it is NOT NULL).
+    """
+
+    with engine.begin() as conn:
+        columns = {column["name"] for column in db.inspect(conn).get_columns("likes")}
+
+        if "message_timestamp" not in columns:
+            conn.execute(text(
+                "ALTER TABLE likes ADD COLUMN message_timestamp TIMESTAMP"))
+            echo("added likes.message_timestamp")
+
+    missing = Like.message_timestamp.is_(None)
+    total = 0
+
+    for after, upto in like_batches(engine, missing, batch_size):
+        with engine.begin() as conn:
+            total += conn.execute(
+                update(Like)
+                .where(missing, Like.message_id == Message.id,
+                       *in_batch(after, upto))
+                .values(message_timestamp=Message.timestamp)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        echo(f"up to {upto or 'the end'}: {total} likes filled")
+
+    with engine.begin() as conn:
+        left = conn.execute(
+            select(func.count()).select_from(Like).where(missing)).scalar()
+
+        if left:
+            echo(f"{left} likes still have no message_timestamp; "
+                 "not making it NOT NULL")
+        elif conn.dialect.name == "postgresql":
+            conn.execute(text(
+                "ALTER TABLE likes ALTER COLUMN message_timestamp SET NOT NULL"))
+            echo("likes.message_timestamp is now NOT NULL")
+        else:
+            # SQLite can't add a constraint to an existing column; the
+            # before_insert hook fills it for every new like.
+            echo("every like has a message_timestamp")
+
+    return left
+
+
+##############################################################################
+# Command line
+
+
+partitions_cli = AppGroup(
+    "partitions", help="Manage time partitions of messages and likes.")
+
+
+def init_partitions(app):
+    app.cli.add_command(partitions_cli)
+
+
+@partitions_cli.command("convert")
+@click.option("--ahead", default=None, type=int,
+              help="Months of empty partitions to create in advance.")
+def convert_command(ahead):
+    """Partition the existing messages and likes tables by month."""
+
+    if ahead is None:
+        ahead = current_app.config.get("PARTITION_MONTHS_AHEAD", 3)
+
+    require_postgres(db.engine)
+
+    with db.engine.begin() as conn:
+        if is_partitioned(conn):
+            raise click.ClickException("messages is already partitioned.")
+
+        convert(conn, ahead=ahead)
+        message_partitions.create(conn, checkfirst=True)
+
+    click.echo("messages and likes are now partitioned by month")
+
+
+@partitions_cli.command("add-like-timestamps")
+@click.option("--batch-size", default=10000)
+def add_like_timestamps_command(batch_size):
+    """Add and fill likes.message_timestamp on an existing database."""
+
+    if add_like_timestamps(db.engine, batch_size, echo=click.echo):
+        raise click.ClickException("some likes could not be filled")
+
+
+@partitions_cli.command("maintain")
+def maintain_command():
+    """Create upcoming partitions and archive cold ones (run daily)."""
+
+    config = current_app.config
+
+    maintain(
+        db.engine,
+        ahead=config.get("PARTITION_MONTHS_AHEAD", 3),
+        hot_days=config.get("MESSAGES_HOT_DAYS", 180),
+        tablespace=config.get("PARTITION_ARCHIVE_TABLESPACE"),
+        echo=click.echo,
+    )
+
+
+@partitions_cli.command("status")
+def status_command():
+    """List partitions with their tier, rows and size."""
+
+    require_postgres(db.engine)
+
+    with db.engine.connect() as conn:
+        recorded = tiers(conn) if db.inspect(conn).has_table(
+            "message_partitions") else {}
+
+        for table in PARTITIONED:
+            for month, name in sorted(partitions(conn, table).items()):
+                rows, size = conn.execute(text(
+                    "SELECT reltuples::bigint, "
+                    "pg_size_pretty(pg_total_relation_size(oid)) "
+                    "FROM pg_class WHERE oid = to_regclass(:name)"
+                ), {"name": name}).one()
+
+                click.echo(f"{name:24} {recorded.get(month, HOT):8} "
+                           f"{rows:>12} rows {size:>10}")
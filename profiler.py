@@ -0,0 +1,220 @@
+"""On-demand sampling profiler.
+
+Two ways to look inside a running worker without restarting it or
+attaching anything. Both are for operators: they need the ``X-Profile``
+header to carry ``PROFILER_TOKEN``, and are off when no token is set.
+
+- ``POST /_profile?seconds=N`` starts a background thread in the worker
+  that handles it. Every ``PROFILER_INTERVAL_MS`` it samples the stack of
+  every thread that is serving a request. Each stack is tagged with its
+  Flask endpoint. After N seconds (at most ``PROFILER_MAX_SECONDS``) the
+  counts go to ``PROFILER_OUTPUT_DIR`` in collapsed-stack format, one
+  ``tag;outer;...;inner count`` line per stack::
+
+      warbler.homepage;app.homepage;views.feed;...;sqlite3.execute 42
+
+  ``flamegraph.pl`` and speedscope read this directly. Each run covers
+  only the worker that received the POST.
+
+- Any other request sent with the header is sampled on its own, every
+  ``PROFILER_REQUEST_INTERVAL_MS``. Sampling runs from before_request to
+  the last byte of the body, so template rendering is included. The
+  response is replaced with the collapsed stacks.
+
+Between requests the only cost is one dict entry per request. While a run
+is on, the sampler takes the GIL once per interval.
+"""
+
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, g, request
+
+HEADER = "X-Profile"
+
+# Thread ident -> endpoint, for every thread inside a request.
+_serving = {}
+
+
+def frame_name(frame):
+    # Compiled templates have no __name__; use the template's file name.
+    module = (frame.f_globals.get("__name__")
+              or os.path.basename(frame.f_code.co_filename))
+
+    return f"{module}.{frame.f_code.co_qualname}"
+
+
+def stack(frame):
+    """Function names from the outermost frame down to `frame`."""
+
+    names = []
+
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    names.reverse()
+
+    return names
+
+
+class Sampler:
+    """Counts the stacks of some threads, sampled every `interval` seconds.
+
+    `threads` returns {thread ident: tag} for the threads to sample now.
+    """
+
+    def __init__(self, threads, interval):
+        self.threads = threads
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        frames = sys._current_frames()
+
+        for ident, tag in list(self.threads().items()):
+            frame = frames.get(ident)
+
+            if frame is not None:
+                self.stacks[";".join([tag, *stack(frame)])] += 1
+
+        self.samples += 1
+
+    def start(self, seconds=None, done=None):
+        """Sample in a background thread for `seconds` (or until stop()),
+        then call `done(self)`."""
+
+        deadline = time.monotonic() + seconds if seconds is not None else None
+
+        def run():
+            while not self._stop.wait(self.interval):
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+
+                self.sample()
+
+            if done is not None:
+                done(self)
+
+        self._thread = threading.Thread(target=run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """The counts as collapsed stacks, most frequent first."""
+
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """One worker-wide sampling run at a time, written to `output_dir`."""
+
+    def __init__(self, output_dir, interval):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.running = None
+        self._lock = threading.Lock()
+
+    def start(self, seconds):
+        """Sample every serving thread for `seconds` in the background.
+
+        Returns the path the stacks will be written to, or None if a run is
+        already going.
+        """
+
+        with self._lock:
+            if self.running is not None:
+                return None
+
+            self.running = Sampler(lambda: _serving, self.interval)
+
+        path = os.path.join(
+            self.output_dir,
+            f"warbler-{os.getpid()}-{datetime.utcnow():%Y%m%dT%H%M%S}.collapsed")
+        self.running.start(seconds, done=lambda sampler: self._write(sampler, path))
+
+        return path
+
+    def _write(self, sampler, path):
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                f.write(sampler.collapsed())
+
+            os.replace(f"{path}.tmp", path)
+        finally:
+            with self._lock:
+                self.running = None
+
+
+def current_profiler():
+    return current_app.extensions["profiler"]
+
+
+def authorized():
+    """Whether this request carries the profiler token."""
+
+    token = current_app.config.get("PROFILER_TOKEN")
+
+    return bool(token) and hmac.compare_digest(
+        request.headers.get(HEADER, "").encode(), token.encode())
+
+
+##############################################################################
+# Request hooks
+
+
+def _begin():
+    ident = threading.get_ident()
+    _serving[ident] = request.endpoint or "-"
+
+    if HEADER in request.headers and request.endpoint != "warbler.start_profile" \
+            and authorized():
+        g.profile = Sampler(lambda: {ident: _serving.get(ident, "-")},
+                            current_app.config["PROFILER_REQUEST_INTERVAL_MS"] / 1000)
+        g.profile.start()
+
+
+def _report(response):
+    sampler = g.pop("profile", None)
+
+    if sampler is None:
+        return response
+
+    # Render the whole body (a streamed page included) while still sampling.
+    response.get_data()
+    sampler.stop()
+
+    return current_app.response_class(
+        sampler.collapsed(), mimetype="text/plain",
+        headers={"X-Profile-Samples": str(sampler.samples)})
+
+
+def _end(error=None):
+    _serving.pop(threading.get_ident(), None)
+    sampler = g.pop("profile", None)
+
+    # Only left over when the request failed before _report().
+    if sampler is not None:
+        sampler.stop()
+
+
+def init_profiler(app):
+    app.extensions["profiler"] = Profiler(
+        app.config.get("PROFILER_OUTPUT_DIR") or tempfile.gettempdir(),
+        app.config.get("PROFILER_INTERVAL_MS", 10) / 1000)
+    app.before_request(_begin)
+    app.after_request(_report)
+    app.teardown_request(_end)
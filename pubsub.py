@@ -0,0 +1,155 @@
+"""In-process pub/sub bus for live timeline updates.
+
+``add_message()`` and ``delete_message()`` publish events; each ``/stream``
+connection holds a Subscription for its author ids. Every subscriber gets a
+bounded queue that drops its oldest event when full, so one slow client can
+never hold up publishers or grow without limit.
+
+The bus keeps the last ``history`` events, so a reconnecting client that
+sends ``Last-Event-ID`` is caught up from memory instead of re-running the
+homepage query.
+
+The bus is per process: with several workers, a client only sees messages
+posted through the worker it is connected to. Run the stream on threaded
+(gthread) or async workers, since each open stream holds a connection.
+"""
+
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+
+class Event:
+    """One published timeline event."""
+
+    __slots__ = ("id", "type", "user_id", "data")
+
+    def __init__(self, id, type, user_id, data):
+        self.id = id
+        self.type = type
+        self.user_id = user_id
+        self.data = data
+
+    def to_sse(self):
+        """Format as a Server-Sent Events frame."""
+
+        return (f"id: {self.id}\n"
+                f"event: {self.type}\n"
+                f"data: {json.dumps(self.data)}\n\n")
+
+
+class Subscription:
+    """A subscriber's bounded, drop-oldest queue of events."""
+
+    def __init__(self, user_ids, maxsize):
+        self.user_ids = frozenset(user_ids)
+        self.dropped = 0
+
+        # Set when the client's Last-Event-ID is older than the bus history,
+        # i.e. it missed events and should reload the page.
+        self.stale = False
+
+        self._queue = deque(maxlen=maxsize)
+        self._ready = threading.Condition()
+
+    def wants(self, event):
+        return event.user_id in self.user_ids
+
+    def put(self, event):
+        with self._ready:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+
+            self._queue.append(event)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Next event, or None if nothing arrives within `timeout` seconds."""
+
+        with self._ready:
+            if not self._queue:
+                self._ready.wait(timeout)
+
+            return self._queue.popleft() if self._queue else None
+
+
+class Bus:
+    """Fan-out of timeline events to subscriber queues.
+
+    Event ids start from the current time in milliseconds, so they keep
+    increasing across restarts and a stale Last-Event-ID is detectable.
+    """
+
+    def __init__(self, history=1000, queue_size=100):
+        self.queue_size = queue_size
+
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._ids = itertools.count(int(time.time() * 1000))
+        self._lock = threading.Lock()
+
+    def publish(self, type, user_id, data):
+        """Send an event about `user_id`'s messages to interested subscribers."""
+
+        with self._lock:
+            event = Event(next(self._ids), type, user_id, data)
+            self._history.append(event)
+            subscribers = [s for s in self._subscribers if s.wants(event)]
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+        return event
+
+    def subscribe(self, user_ids, last_event_id=None):
+        """Start receiving events for `user_ids`.
+
+        With `last_event_id`, events published after it are queued first.
+        """
+
+        subscription = Subscription(user_ids, self.queue_size)
+
+        with self._lock:
+            if last_event_id is not None:
+                oldest = self._history[0].id if self._history else None
+                subscription.stale = oldest is not None and last_event_id < oldest - 1
+
+                for event in self._history:
+                    if event.id > last_event_id and subscription.wants(event):
+                        subscription.put(event)
+
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+def init_pubsub(app):
+    """Attach a timeline Bus to `app`."""
+
+    app.extensions["timeline_bus"] = Bus(
+        history=app.config.get("STREAM_HISTORY", 1000),
+        queue_size=app.config.get("STREAM_QUEUE_SIZE", 100),
+    )
+
+
+def message_event_data(message):
+    """Everything the client needs to render a message card."""
+
+    return {
+        "id": message.id,
+        "text": message.text,
+        "timestamp": message.timestamp.isoformat(),
+        "user_id": message.user_id,
+        "username": message.user.username,
+        "image_url": message.user.image_url,
+    }
@@ -0,0 +1,89 @@
+"""Read-replica routing for Warbler.
+
+GET/HEAD requests read from one of the replica binds listed in
+``REPLICA_BINDS`` (regular ``SQLALCHEMY_BINDS`` entries); everything else, and
+every flush, goes to the primary. After a request commits a write, that
+browser keeps reading from the primary for ``READ_YOUR_WRITES_SECONDS`` so
+users always see their own changes despite replication lag.
+
+Locally, point ``DATABASE_URL`` and ``REPLICA_DATABASE_URLS`` at two
+databases (e.g. two SQLite files) to exercise it.
+"""
+
+import random
+import time
+
+from flask import current_app, request, session
+from sqlalchemy import event
+
+from models import db, Session
+
+PRIMARY_UNTIL_KEY = "primary_until"
+READ_METHODS = ("GET", "HEAD")
+
+
+def init_replicas(app):
+    """Register request hooks that pick a bind for each request.
+
+    Must run before other ``before_request`` hooks so that loading
+    ``g.user`` is routed too.
+    """
+
+    app.before_request(choose_bind)
+    app.after_request(remember_write)
+
+
+def pick_replica():
+    """The replica bind for this request's reads, or None for the primary
+    (writes, or a browser that wrote recently)."""
+
+    replicas = current_app.config.get("REPLICA_BINDS") or []
+    sticky = session.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+
+    if replicas and request.method in READ_METHODS and not sticky:
+        return random.choice(replicas)
+
+    return None
+
+
+def choose_bind():
+    """Route this request's reads to a replica, or to the primary if sticky."""
+
+    db.session.info["replica"] = pick_replica()
+
+
+def use_primary():
+    """Send the rest of this request to the primary, and keep the browser
+    there afterwards, as after any write.
+
+    For GET handlers that write (which would otherwise go to a replica).
+    """
+
+    db.session.info["replica"] = None
+    db.session.info["wrote"] = True
+
+
+def remember_write(response):
+    """Keep this browser on the primary for a while after it writes."""
+
+    if db.session.info.pop("wrote", False):
+        window = current_app.config.get("READ_YOUR_WRITES_SECONDS", 0)
+        session[PRIMARY_UNTIL_KEY] = time.time() + window
+
+    return response
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flush(db_session, flush_context):
+    db_session.info["flushed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _note_commit(db_session):
+    if db_session.info.pop("flushed", False):
+        db_session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_rollback")
+def _note_rollback(db_session):
+    db_session.info.pop("flushed", None)
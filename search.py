@@ -0,0 +1,426 @@
+"""Full-text search over messages, backed by an inverted index table.
+
+``message_terms`` holds one posting per (term, message) with the term's word
+positions and a copy of the message timestamp. ``add_message()`` indexes a
+new message in the same transaction that creates it; ``delete_message()``
+removes its postings. ``flask search reindex`` rebuilds the table.
+
+Queries are words (all required), quoted phrases and ``prefix*`` terms:
+
+    cats "cute dog" photo*
+
+Results are ranked by relevance decayed by age, with a half-life of
+``SEARCH_HALF_LIFE_SECONDS``. Ordering by ``relevance * 2 ** (-age / H)``
+is the same as ordering by the time-invariant key
+
+    key = timestamp / H + log2(relevance)
+
+so a cursor of (key, id) stays valid between requests. Since relevance is
+capped, no posting older than ``timestamp <= (threshold - cap) * H`` can
+beat the current k-th best; postings are read newest-first in batches and
+the scan stops there.
+"""
+
+import base64
+import heapq
+import math
+import re
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import (
+    and_, bindparam, delete, exists, insert, or_, select, tuple_,
+)
+from sqlalchemy.orm import aliased
+
+from models import db, Message, MessageTerm
+
+TERM_LENGTH = MessageTerm.term.type.length
+
+# Relevance is the number of matched occurrences, capped so that relevance
+# can buy at most MAX_BOOST half-lives of recency.
+MAX_BOOST = 3
+
+EPOCH = datetime(2020, 1, 1)
+
+WORD_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+##############################################################################
+# Tokenizing and indexing
+
+
+def tokenize(text):
+    """Lower-cased words of `text`, truncated to the indexed term length."""
+
+    return [word[:TERM_LENGTH] for word in WORD_RE.findall(text.lower())]
+
+
+def postings(message):
+    """Index rows for `message`: one per distinct term."""
+
+    positions = {}
+
+    for position, term in enumerate(tokenize(message.text)):
+        positions.setdefault(term, []).append(str(position))
+
+    return [
+        {
+            "term": term,
+            "message_id": message.id,
+            "timestamp": message.timestamp,
+            "positions": " ".join(at),
+        }
+        for term, at in positions.items()
+    ]
+
+
+def index_message(message):
+    """Add `message` to the index (within the current transaction)."""
+
+    db.session.flush()
+    rows = postings(message)
+
+    if rows:
+        db.session.execute(insert(MessageTerm), rows)
+
+
+def unindex_message(message_id):
+    """Remove a message's postings (within the current transaction)."""
+
+    db.session.execute(
+        delete(MessageTerm).where(MessageTerm.message_id == message_id))
+
+
+##############################################################################
+# Queries
+
+
+class Query:
+    """A parsed search query."""
+
+    def __init__(self, words=(), prefixes=(), phrases=()):
+        self.words = list(words)
+        self.prefixes = list(prefixes)
+        self.phrases = [list(phrase) for phrase in phrases]
+
+    @classmethod
+    def parse(cls, text):
+        query = cls()
+
+        for phrase, token in QUERY_RE.findall(text):
+            if phrase:
+                words = tokenize(phrase)
+
+                if len(words) > 1:
+                    query.phrases.append(words)
+                query.words.extend(words)
+
+            elif token.endswith("*") and tokenize(token):
+                *words, prefix = tokenize(token)
+                query.words.extend(words)
+                query.prefixes.append(prefix)
+
+            else:
+                query.words.extend(tokenize(token))
+
+        query.words = list(dict.fromkeys(query.words))
+        query.prefixes = list(dict.fromkeys(query.prefixes))
+
+        return query
+
+    def __bool__(self):
+        return bool(self.words or self.prefixes)
+
+    def terms(self):
+        """Every (term, is_prefix) that a result must contain."""
+
+        return ([(word, False) for word in self.words]
+                + [(prefix, True) for prefix in self.prefixes])
+
+    def driver(self):
+        """The term to scan postings by: the longest (likely rarest) word,
+        else the longest prefix."""
+
+        return max(self.terms(), key=lambda term: (not term[1], len(term[0])))
+
+
+def term_match(table, term, prefix=False):
+    """Condition matching postings in `table` for `term` (or its prefix)."""
+
+    if not prefix:
+        return table.term == term
+
+    return and_(table.term >= term, table.term < term + "\uffff")
+
+
+class Cursor:
+    """Position after the last result of a page: ranking key and message id."""
+
+    def __init__(self, key, message_id):
+        self.key = key
+        self.message_id = message_id
+
+    def encode(self):
+        raw = f"{self.key!r}:{self.message_id}".encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    @classmethod
+    def decode(cls, token):
+        """Parse a token from ``encode``; None if it is malformed."""
+
+        try:
+            key, message_id = base64.urlsafe_b64decode(token).decode().split(":")
+            return cls(float(key), int(message_id))
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def precedes(self, key, message_id):
+        """Does a result ranked (key, message_id) belong after this cursor?"""
+
+        return (key, message_id) < (self.key, self.message_id)
+
+
+def age_key(timestamp, half_life):
+    return (timestamp - EPOCH).total_seconds() / half_life
+
+
+def rank(matches, timestamp, half_life):
+    """Time-invariant recency-weighted ranking key (see module docstring)."""
+
+    return age_key(timestamp, half_life) + min(math.log2(matches), MAX_BOOST)
+
+
+def has_phrase(positions, phrase):
+    """Do the words of `phrase` occur consecutively, given each word's
+    positions?"""
+
+    return any(
+        all(start + i in positions.get(word, ()) for i, word in enumerate(phrase))
+        for start in positions.get(phrase[0], ())
+    )
+
+
+def score(query, candidates, half_life):
+    """Ranking keys for `candidates` ((message_id, timestamp) rows) that
+    satisfy every phrase in `query`."""
+
+    timestamps = dict(candidates)
+    conditions = [term_match(MessageTerm, term, prefix)
+                  for term, prefix in query.terms()]
+
+    rows = db.session.execute(
+        select(MessageTerm.message_id, MessageTerm.term, MessageTerm.positions)
+        .where(MessageTerm.message_id.in_(timestamps), or_(*conditions))
+    )
+
+    positions = {}
+
+    for message_id, term, at in rows:
+        positions.setdefault(message_id, {})[term] = {int(p) for p in at.split()}
+
+    for message_id, terms in positions.items():
+        if all(has_phrase(terms, phrase) for phrase in query.phrases):
+            matches = sum(len(at) for at in terms.values())
+            yield rank(matches, timestamps[message_id], half_life), message_id
+
+
+def expand(prefix, limit=None):
+    """Indexed terms starting with `prefix`, at most `limit` of them."""
+
+    if limit is None:
+        limit = current_app.config.get("SEARCH_PREFIX_TERMS", 100)
+
+    return db.session.execute(
+        select(MessageTerm.term)
+        .where(term_match(MessageTerm, prefix, prefix=True))
+        .group_by(MessageTerm.term)
+        .order_by(MessageTerm.term)
+        .limit(limit)
+    ).scalars().all()
+
+
+def newest_first_query(filters, newest=None):
+    """Postings of a ``:term`` whose message also matches every
+    (term, is_prefix) in `filters`, newest first."""
+
+    driver = aliased(MessageTerm)
+    stmt = (
+        select(driver.timestamp, driver.message_id)
+        .where(driver.term == bindparam("term"))
+        .order_by(driver.timestamp.desc(), driver.message_id.desc())
+        .limit(bindparam("size"))
+    )
+
+    for other, prefix in filters:
+        stmt = stmt.where(exists().where(
+            MessageTerm.message_id == driver.message_id,
+            term_match(MessageTerm, other, prefix)))
+
+    if newest:
+        stmt = stmt.where(driver.timestamp <= newest)
+
+    after = stmt.where(tuple_(driver.timestamp, driver.message_id)
+                       < tuple_(bindparam("timestamp"), bindparam("message_id")))
+
+    return stmt, after
+
+
+def newest_first(queries, term, batch_size=500):
+    """Yield (timestamp, message_id) rows of `queries` (from
+    ``newest_first_query``) for `term`, reading the index in batches.
+
+    Batches start small and double up to `batch_size`, since when many
+    streams are merged most are only read a little way.
+    """
+
+    first, after = queries
+    size = min(16, batch_size)
+    batch = db.session.execute(first, {"term": term, "size": size}).all()
+
+    while batch:
+        yield from batch
+
+        if len(batch) < size:
+            return
+
+        size = min(size * 2, batch_size)
+        timestamp, message_id = batch[-1]
+        batch = db.session.execute(after, {
+            "term": term, "size": size,
+            "timestamp": timestamp, "message_id": message_id,
+        }).all()
+
+
+def find_messages(text, limit=20, cursor=None, half_life=None, batch_size=500):
+    """Search messages for query `text`, best first.
+
+    Returns ``(messages, next_cursor)``; `next_cursor` is None on the last
+    page. A prefix only matches its first ``SEARCH_PREFIX_TERMS`` terms.
+    """
+
+    query = Query.parse(text)
+
+    if not query:
+        return [], None
+
+    if half_life is None:
+        half_life = current_app.config.get("SEARCH_HALF_LIFE_SECONDS", 86400)
+
+    newest = None
+
+    if cursor:
+        # A result after the cursor has key <= cursor.key, and key >= its
+        # age key, so nothing newer than this can qualify. (+1s for rounding.)
+        newest = EPOCH + timedelta(seconds=cursor.key * half_life + 1)
+
+    # A prefix can't be read in timestamp order straight off the index, so
+    # it is expanded to its terms and their newest-first scans are merged.
+    driver, prefix = query.driver()
+    queries = newest_first_query(
+        [term for term in query.terms() if term != (driver, prefix)], newest)
+    postings = heapq.merge(
+        *(newest_first(queries, term, batch_size)
+          for term in (expand(driver) if prefix else [driver])),
+        reverse=True,
+    )
+
+    best = []       # min-heap of the limit + 1 best (key, message_id)
+    seen = set()
+
+    while True:
+        candidates = list(islice(postings, batch_size))
+
+        if not candidates:
+            break
+
+        fresh = [(m, t) for t, m in candidates if m not in seen]
+        seen.update(m for m, _ in fresh)
+
+        for item in score(query, fresh, half_life):
+            if cursor and not cursor.precedes(*item):
+                continue
+
+            if len(best) <= limit:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+        # Nothing older than the last posting read can outrank best[0].
+        ceiling = age_key(candidates[-1][0], half_life) + MAX_BOOST
+
+        if len(candidates) < batch_size or (len(best) > limit
+                                            and best[0][0] > ceiling):
+            break
+
+    ranked = sorted(best, reverse=True)
+    page = ranked[:limit]
+    next_cursor = Cursor(*page[-1]) if len(ranked) > limit else None
+
+    messages = {
+        msg.id: msg
+        for msg in Message.query
+        .filter(Message.id.in_([message_id for _, message_id in page]))
+        .options(db.selectinload(Message.user))
+    }
+
+    # A posting can outlive its message (e.g. an unenforced cascade).
+    return ([messages[message_id] for _, message_id in page
+             if message_id in messages], next_cursor)
+
+
+##############################################################################
+# Command line
+
+
+search_cli = AppGroup("search", help="Manage the message search index.")
+
+
+def init_search(app):
+    app.cli.add_command(search_cli)
+
+
+def reindex(batch_size=5000, echo=print):
+    """Rebuild the message search index from scratch."""
+
+    db.session.execute(delete(MessageTerm))
+    last_id = 0
+    total = 0
+
+    while True:
+        batch = (Message.query
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(batch_size)
+                 .all())
+
+        if not batch:
+            break
+
+        rows = [row for message in batch for row in postings(message)]
+        last_id = batch[-1].id
+
+        if rows:
+            db.session.execute(insert(MessageTerm), rows)
+
+        db.session.commit()
+        db.session.expunge_all()
+
+        total += len(batch)
+        echo(f"indexed {total} messages")
+
+    db.session.commit()
+
+    return total
+
+
+@search_cli.command("reindex")
+@click.option("--batch-size", default=5000)
+def reindex_command(batch_size):
+    """Rebuild the message search index from scratch."""
+
+    reindex(batch_size, echo=click.echo)
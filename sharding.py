@@ -0,0 +1,531 @@
+"""Horizontal sharding of messages and likes by user_id.
+
+Each user hashes to one of ``NUM_BUCKETS`` buckets (``user_id % NUM_BUCKETS``)
+and each bucket is assigned to a shard database. Moving a bucket is how we
+reshard, so adding a shard never means rehashing every user.
+
+This is the dual-write stage of the rollout: the primary's ``messages`` and
+``likes`` tables remain the source of truth, and every committed insert or
+delete of a ``Message``/``Like`` is mirrored to the owning shard. The
+homepage feed reads from the shards with a scatter-gather k-way merge.
+
+Configure shards with ``SHARD_DATABASE_URLS`` (comma-separated). Locally,
+several SQLite files are enough:
+
+    SHARD_DATABASE_URLS=sqlite:///shard0.db,sqlite:///shard1.db flask shards init
+    flask shards backfill
+    flask shards move 17 1
+"""
+
+import heapq
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table,
+    delete, event, insert, select, tuple_, update,
+)
+from sqlalchemy.orm import object_session
+
+from models import db, Session, User, Message, Like
+
+NUM_BUCKETS = 256
+
+# Schema that lives on every shard. Ids are the primary's message ids, and
+# there are no foreign keys: a like and its message may sit on different
+# shards.
+shard_metadata = MetaData()
+
+shard_messages = Table(
+    "messages",
+    shard_metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("text", String(140), nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+    Column("user_id", Integer, nullable=False),
+    Index("ix_messages_user_id_timestamp", "user_id", "timestamp"),
+)
+
+shard_likes = Table(
+    "likes",
+    shard_metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("message_id", BigInteger, primary_key=True),
+)
+
+# Bucket -> shard assignments, kept on the primary so every worker agrees.
+shard_buckets = db.Table(
+    "shard_buckets",
+    Column("bucket", Integer, primary_key=True, autoincrement=False),
+    Column("shard", Integer, nullable=False),
+    Column("moving_to", Integer, nullable=True),
+)
+
+
+class ShardRouter:
+    """Maps user ids to shard engines.
+
+    `engines` is a list of engines, one per shard. The bucket map is read
+    from ``shard_buckets`` on `primary` and cached for `refresh_seconds`;
+    without rows there, bucket ``b`` lives on shard ``b % len(engines)``.
+    """
+
+    def __init__(self, engines, primary=None, refresh_seconds=5):
+        self.engines = engines
+        self.primary = primary
+        self.refresh_seconds = refresh_seconds
+
+        self.assignments = {b: b % len(engines) for b in range(NUM_BUCKETS)}
+        self.moving = {}
+        self._loaded_at = None
+
+    def refresh(self, force=False):
+        """Reload the bucket map from the primary if it is stale."""
+
+        if self.primary is None:
+            return
+
+        now = time.monotonic()
+
+        if (not force and self._loaded_at is not None
+                and now - self._loaded_at < self.refresh_seconds):
+            return
+
+        with self.primary.connect() as conn:
+            rows = conn.execute(select(shard_buckets)).all()
+
+        for row in rows:
+            self.assignments[row.bucket] = row.shard
+
+            if row.moving_to is None:
+                self.moving.pop(row.bucket, None)
+            else:
+                self.moving[row.bucket] = row.moving_to
+
+        self._loaded_at = now
+
+    @staticmethod
+    def bucket_for(user_id):
+        return user_id % NUM_BUCKETS
+
+    def shard_for(self, user_id):
+        """Shard that serves reads for `user_id`."""
+
+        self.refresh()
+        return self.assignments[self.bucket_for(user_id)]
+
+    def write_shards(self, user_id):
+        """Shards that must receive writes for `user_id` (two while moving)."""
+
+        shard = self.shard_for(user_id)
+        target = self.moving.get(self.bucket_for(user_id))
+
+        return [shard] if target in (None, shard) else [shard, target]
+
+    def create_all(self):
+        """Create the shard schema on every shard."""
+
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+
+    ##########################################################################
+    # Writes
+
+    def apply(self, writes):
+        """Apply queued ``(op, user_id, values)`` writes to their shards."""
+
+        by_shard = defaultdict(list)
+
+        for op, user_id, values in writes:
+            for shard in self.write_shards(user_id):
+                by_shard[shard].append((op, values))
+
+        for shard, ops in by_shard.items():
+            with self.engines[shard].begin() as conn:
+                for op, values in ops:
+                    _execute(conn, op, values)
+
+    ##########################################################################
+    # Reads
+
+    def feed(self, user_ids, limit=100):
+        """Newest `limit` messages by any of `user_ids`, across all shards.
+
+        Each shard returns its own newest `limit` rows (index-backed on
+        ``user_id, timestamp``); the sorted streams are then k-way merged.
+        """
+
+        by_shard = defaultdict(list)
+
+        for user_id in user_ids:
+            by_shard[self.shard_for(user_id)].append(user_id)
+
+        def fetch(item):
+            shard, ids = item
+            query = (select(shard_messages)
+                     .where(shard_messages.c.user_id.in_(ids))
+                     .order_by(shard_messages.c.timestamp.desc())
+                     .limit(limit))
+
+            with self.engines[shard].connect() as conn:
+                return conn.execute(query).all()
+
+        if len(by_shard) > 1:
+            with ThreadPoolExecutor(max_workers=len(by_shard)) as pool:
+                streams = list(pool.map(fetch, by_shard.items()))
+        else:
+            streams = [fetch(item) for item in by_shard.items()]
+
+        merged = heapq.merge(
+            *streams, key=lambda row: row.timestamp, reverse=True)
+
+        return list(islice(merged, limit))
+
+    def liked_message_ids(self, user_id):
+        """Ids of every message `user_id` has liked."""
+
+        query = (select(shard_likes.c.message_id)
+                 .where(shard_likes.c.user_id == user_id))
+
+        with self.engines[self.shard_for(user_id)].connect() as conn:
+            return set(conn.execute(query).scalars())
+
+
+def _execute(conn, op, values):
+    """Run one queued shard write. Inserts are idempotent upserts, since a
+    bucket being moved may already have the row on its target shard."""
+
+    if op in ("add_message", "delete_message"):
+        conn.execute(
+            delete(shard_messages).where(shard_messages.c.id == values["id"]))
+
+        if op == "add_message":
+            conn.execute(insert(shard_messages), values)
+
+    elif op in ("add_like", "delete_like"):
+        conn.execute(delete(shard_likes).where(
+            shard_likes.c.user_id == values["user_id"],
+            shard_likes.c.message_id == values["message_id"]))
+
+        if op == "add_like":
+            conn.execute(insert(shard_likes), values)
+
+    elif op == "delete_user":
+        for table in (shard_messages, shard_likes):
+            conn.execute(
+                delete(table).where(table.c.user_id == values["user_id"]))
+
+    else:
+        raise ValueError(f"Unknown shard write: {op}")
+
+
+class FeedMessage:
+    """A message read from a shard, shaped like ``Message`` for templates.
+
+    Never attached to the ORM session (so assigning ``user`` can't cascade a
+    write back to the primary).
+    """
+
+    __slots__ = ("id", "text", "timestamp", "user_id", "user")
+
+    def __init__(self, row, user):
+        self.id = row.id
+        self.text = row.text
+        self.timestamp = row.timestamp
+        self.user_id = row.user_id
+        self.user = user
+
+
+def get_router():
+    """The current app's ShardRouter, or None when sharding is off."""
+
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get("shard_router")
+
+
+def sharded_feed(user_ids, limit=100):
+    """Homepage feed from the shards, with authors loaded in one query."""
+
+    rows = get_router().feed(user_ids, limit)
+    author_ids = {row.user_id for row in rows}
+    authors = {
+        user.id: user
+        for user in User.query.filter(User.id.in_(author_ids))
+    }
+
+    return [FeedMessage(row, authors[row.user_id]) for row in rows]
+
+
+##############################################################################
+# Mirroring ORM writes to the shards
+
+
+def _queue(target, op, user_id, values):
+    if get_router() is None:
+        return
+
+    session = object_session(target)
+    session.info.setdefault("shard_writes", []).append((op, user_id, values))
+
+
+@event.listens_for(Message, "after_insert")
+def _message_inserted(mapper, connection, target):
+    _queue(target, "add_message", target.user_id, {
+        "id": target.id,
+        "text": target.text,
+        "timestamp": target.timestamp,
+        "user_id": target.user_id,
+    })
+
+
+@event.listens_for(Message, "after_delete")
+def _message_deleted(mapper, connection, target):
+    _queue(target, "delete_message", target.user_id, {"id": target.id})
+
+
+@event.listens_for(Like, "after_insert")
+def _like_inserted(mapper, connection, target):
+    _queue(target, "add_like", target.user_id, {
+        "user_id": target.user_id,
+        "message_id": target.message_id,
+    })
+
+
+@event.listens_for(Like, "after_delete")
+def _like_deleted(mapper, connection, target):
+    _queue(target, "delete_like", target.user_id, {
+        "user_id": target.user_id,
+        "message_id": target.message_id,
+    })
+
+
+def queue_user_deletion(user_id):
+    """Queue shard deletes for everything that goes with user `user_id`.
+
+    Deleting a user removes their messages with a bulk delete and likes by
+    database cascade; neither fires the ORM events above. Call before the
+    delete, in the same session.
+    """
+
+    if get_router() is None:
+        return
+
+    writes = db.session.info.setdefault("shard_writes", [])
+    writes.append(("delete_user", user_id, {"user_id": user_id}))
+
+    # Other users' likes of their messages live on the likers' shards.
+    likes = db.session.execute(
+        select(Like.user_id, Like.message_id)
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.user_id == user_id, Like.user_id != user_id))
+    writes.extend(("delete_like", like.user_id, like._asdict()) for like in likes)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_shard_writes(session):
+    writes = session.info.pop("shard_writes", None)
+
+    if writes:
+        get_router().apply(writes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_shard_writes(session):
+    session.info.pop("shard_writes", None)
+
+
+##############################################################################
+# Setup, backfill and resharding
+
+
+def init_sharding(app):
+    """Attach a ShardRouter to `app` if ``SHARD_BINDS`` is configured."""
+
+    app.cli.add_command(shards_cli)
+
+    binds = app.config.get("SHARD_BINDS") or []
+
+    if not binds:
+        return
+
+    with app.app_context():
+        router = ShardRouter(
+            [db.engines[key] for key in binds],
+            primary=db.engines[None],
+            refresh_seconds=app.config.get("SHARD_MAP_REFRESH_SECONDS", 5),
+        )
+
+    app.extensions["shard_router"] = router
+
+
+def _copy_rows(source, target, table, where, order_by, batch_size):
+    """Copy rows matching `where` from `source` to `target` in batches."""
+
+    copied = 0
+    last = None
+
+    while True:
+        query = select(table).where(where).order_by(*order_by).limit(batch_size)
+
+        if last is not None:
+            query = query.where(tuple_(*order_by) > tuple_(*last))
+
+        with source.connect() as conn:
+            rows = [row._asdict() for row in conn.execute(query)]
+
+        if not rows:
+            return copied
+
+        with target.begin() as conn:
+            op = "add_message" if table is shard_messages else "add_like"
+
+            for values in rows:
+                _execute(conn, op, values)
+
+        copied += len(rows)
+        last = [rows[-1][col.name] for col in order_by]
+
+
+def _bucket_clause(table, bucket):
+    return table.c.user_id % NUM_BUCKETS == bucket
+
+
+def move_bucket(router, bucket, target, batch_size=1000, echo=print):
+    """Move one bucket to shard `target` while the app keeps serving.
+
+    1. Mark the bucket as moving, so writes go to both shards.
+    2. Wait for every worker to pick that up, then copy existing rows.
+    3. Point reads at the target.
+    4. Wait again, then delete the bucket's rows from the old shard.
+    """
+
+    router.refresh(force=True)
+    source = router.assignments[bucket]
+
+    if source == target:
+        echo(f"bucket {bucket} is already on shard {target}")
+        return
+
+    _set_bucket(router, bucket, shard=source, moving_to=target)
+    time.sleep(router.refresh_seconds)
+
+    for table, order_by in [
+        (shard_messages, [shard_messages.c.id]),
+        (shard_likes, [shard_likes.c.user_id, shard_likes.c.message_id]),
+    ]:
+        copied = _copy_rows(
+            router.engines[source], router.engines[target], table,
+            _bucket_clause(table, bucket), order_by, batch_size)
+        echo(f"copied {copied} {table.name} rows")
+
+    _set_bucket(router, bucket, shard=target, moving_to=None)
+    time.sleep(router.refresh_seconds)
+
+    with router.engines[source].begin() as conn:
+        for table in (shard_messages, shard_likes):
+            conn.execute(delete(table).where(_bucket_clause(table, bucket)))
+
+    router.refresh(force=True)
+    echo(f"bucket {bucket}: shard {source} -> shard {target}")
+
+
+def _set_bucket(router, bucket, shard, moving_to):
+    with router.primary.begin() as conn:
+        updated = conn.execute(
+            update(shard_buckets)
+            .where(shard_buckets.c.bucket == bucket)
+            .values(shard=shard, moving_to=moving_to)
+        ).rowcount
+
+        if not updated:
+            conn.execute(insert(shard_buckets), {
+                "bucket": bucket, "shard": shard, "moving_to": moving_to})
+
+    router.refresh(force=True)
+
+
+shards_cli = AppGroup("shards", help="Manage message/like shards.")
+
+
+def _cli_router():
+    router = get_router()
+
+    if router is None:
+        raise click.ClickException("SHARD_DATABASE_URLS is not configured.")
+
+    return router
+
+
+@shards_cli.command("init")
+def init_command():
+    """Create shard tables and record the default bucket map."""
+
+    router = _cli_router()
+    router.create_all()
+
+    with router.primary.begin() as conn:
+        shard_buckets.create(conn, checkfirst=True)
+
+        if not conn.execute(select(shard_buckets).limit(1)).first():
+            conn.execute(insert(shard_buckets), [
+                {"bucket": b, "shard": shard, "moving_to": None}
+                for b, shard in router.assignments.items()
+            ])
+
+    click.echo(f"{len(router.engines)} shards ready")
+
+
+@shards_cli.command("backfill")
+@click.option("--batch-size", default=1000)
+def backfill_command(batch_size):
+    """Copy existing messages and likes from the primary into the shards."""
+
+    router = _cli_router()
+
+    for table, op, model in [
+        (shard_messages, "add_message", Message),
+        (shard_likes, "add_like", Like),
+    ]:
+        columns = [model.__table__.c[col.name] for col in table.c]
+        query = select(*columns).execution_options(yield_per=batch_size)
+        total = 0
+
+        with router.primary.connect() as conn:
+            for rows in conn.execute(query).partitions():
+                router.apply([
+                    (op, row.user_id, row._asdict()) for row in rows])
+                total += len(rows)
+
+        click.echo(f"backfilled {total} {table.name}")
+
+
+@shards_cli.command("move")
+@click.argument("bucket", type=int)
+@click.argument("target", type=int)
+@click.option("--batch-size", default=1000)
+def move_command(bucket, target, batch_size):
+    """Move BUCKET to shard TARGET without downtime."""
+
+    move_bucket(_cli_router(), bucket, target, batch_size, echo=click.echo)
+
+
+@shards_cli.command("status")
+def status_command():
+    """Show how many buckets each shard owns."""
+
+    router = _cli_router()
+    router.refresh(force=True)
+
+    for shard in range(len(router.engines)):
+        owned = sum(1 for s in router.assignments.values() if s == shard)
+        click.echo(f"shard {shard}: {owned} buckets")
+
+    for bucket, target in router.moving.items():
+        click.echo(f"bucket {bucket} moving to shard {target}")
@@ -0,0 +1,339 @@
+"""Slow-query log with EXPLAIN capture.
+
+Every engine the app uses (primary, replicas and shards) is timed at the
+cursor. When a statement takes ``SLOW_QUERY_MS`` or longer, it is
+recorded along with:
+
+- its fingerprint: literals and placeholders become ``?`` and IN/VALUES
+  lists collapse, so one query shape gets one fingerprint however it was
+  called
+- the route that ran it (``GET /users/<int:user_id>``), or ``-`` outside a
+  request
+- its parameters, redacted to their types (``<str>``, ``<int>``)
+- its plan, taken on the same connection so uncommitted rows and session
+  settings match. On PostgreSQL a fraction (``SLOW_QUERY_ANALYZE_RATE``)
+  of slow SELECTs get ``EXPLAIN (ANALYZE, BUFFERS)``. That runs the
+  query a second time, so it is sampled and never used for writes.
+
+A fingerprint is written at most once per ``SLOW_QUERY_LOG_INTERVAL_SECONDS``,
+with the number of occurrences since its last line. The same slow query
+under load therefore costs one line and one EXPLAIN a minute, not one per
+execution.
+
+Lines are JSON, written to ``SLOW_QUERY_LOG_PATH`` (rotated at
+``SLOW_QUERY_LOG_MAX_BYTES``, keeping ``SLOW_QUERY_LOG_BACKUPS`` old files),
+or to the app logger when no path is set. ``{pid}`` in the path gives each
+worker its own file, since rotation isn't safe across processes; it is
+filled in by the worker that writes, so forking after setup still works.
+``flask slowlog summary`` groups the lines by fingerprint.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import has_request_context, request
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+from models import db
+
+_STARTED = "slow_query_started"
+_SAVEPOINT = "slow_query_explain"
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+|\?")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_REPEATED = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+_SELECT = re.compile(r"\s*select\b", re.IGNORECASE)
+
+
+def normalize(statement):
+    """`statement` with values replaced by ``?`` and lists collapsed."""
+
+    sql = _STRINGS.sub("?", statement)
+    sql = _PARAMS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _LISTS.sub("(...)", sql)
+    sql = _REPEATED.sub("(...)", sql)
+
+    return _SPACE.sub(" ", sql).strip()
+
+
+def fingerprint(statement):
+    """(fingerprint, normalized statement) for `statement`."""
+
+    normalized = normalize(statement)
+
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16], normalized
+
+
+def redact(parameters):
+    """`parameters` with every value replaced by its type name."""
+
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) for value in parameters]
+
+    if parameters is None:
+        return None
+
+    return f"<{type(parameters).__name__}>"
+
+
+def current_route():
+    if not has_request_context():
+        return "-"
+
+    rule = request.url_rule.rule if request.url_rule else request.path
+
+    return f"{request.method} {rule}"
+
+
+class Group:
+    """Running totals for one fingerprint."""
+
+    __slots__ = ("count", "total_ms", "max_ms", "logged_at", "logged_count")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.logged_at = None
+        self.logged_count = 0
+
+
+class SlowQueryRecorder:
+    """Times statements on the engines it is attached to, logging slow ones."""
+
+    def __init__(self, threshold_ms, logger, explain=True, analyze_rate=0.0,
+                 interval=60, clock=time.monotonic, rand=random.random):
+        self.threshold_ms = threshold_ms
+        self.logger = logger
+        self.explain = explain
+        self.analyze_rate = analyze_rate
+        self.interval = interval
+        self.clock = clock
+        self.rand = rand
+        self.groups = defaultdict(Group)
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._failed)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(_STARTED, []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info[_STARTED].pop()) * 1000
+
+        if elapsed_ms >= self.threshold_ms:
+            self.record(conn, statement, parameters, executemany, elapsed_ms)
+
+    def _failed(self, context):
+        # A failed statement never reaches _after(); drop its start time.
+        started = context.connection and context.connection.info.get(_STARTED)
+
+        if started:
+            started.pop()
+
+    def record(self, conn, statement, parameters, executemany, elapsed_ms):
+        key, normalized = fingerprint(statement)
+        now = self.clock()
+
+        with self._lock:
+            group = self.groups[key]
+            group.count += 1
+            group.total_ms += elapsed_ms
+            group.max_ms = max(group.max_ms, elapsed_ms)
+
+            if group.logged_at is not None and now - group.logged_at < self.interval:
+                return
+
+            group.logged_at = now
+            occurrences = group.count - group.logged_count
+            group.logged_count = group.count
+
+        entry = {
+            "time": datetime.utcnow().isoformat(timespec="seconds"),
+            "fingerprint": key,
+            "ms": round(elapsed_ms, 1),
+            "occurrences": occurrences,
+            "total": group.count,
+            "route": current_route(),
+            "statement": normalized,
+            "parameters": (redact(parameters[:1]) + [f"... {len(parameters)} rows"]
+                           if executemany else redact(parameters)),
+        }
+
+        if self.explain and not executemany:
+            entry["plan"], entry["analyzed"] = self.plan(conn, statement, parameters)
+
+        self.logger.warning(json.dumps(entry))
+
+    def plan(self, conn, statement, parameters):
+        """(plan lines, whether it was ANALYZEd) for `statement` on `conn`.
+
+        Runs on the DBAPI connection, so it isn't timed or logged itself.
+        """
+
+        dialect = conn.dialect.name
+        analyze = (dialect == "postgresql" and _SELECT.match(statement)
+                   and self.rand() < self.analyze_rate)
+
+        if dialect == "sqlite":
+            sql = f"EXPLAIN QUERY PLAN {statement}"
+        elif analyze:
+            sql = f"EXPLAIN (ANALYZE, BUFFERS) {statement}"
+        else:
+            sql = f"EXPLAIN {statement}"
+
+        # A failed statement aborts a PostgreSQL transaction; contain it.
+        savepoint = dialect == "postgresql"
+        cursor = conn.connection.cursor()
+
+        try:
+            if savepoint:
+                cursor.execute(f"SAVEPOINT {_SAVEPOINT}")
+
+            cursor.execute(sql, parameters)
+            lines = [str(row[-1]) for row in cursor.fetchall()]
+
+            if savepoint:
+                cursor.execute(f"RELEASE SAVEPOINT {_SAVEPOINT}")
+        except Exception as error:
+            if savepoint:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {_SAVEPOINT}")
+
+            return [f"EXPLAIN failed: {error}"], False
+        finally:
+            cursor.close()
+
+        return lines, bool(analyze)
+
+
+class PerProcessFileHandler(RotatingFileHandler):
+    """A RotatingFileHandler for a `path` with a ``{pid}`` in it.
+
+    The pid is filled in when a record is written, not when the handler is
+    made: with ``gunicorn --preload`` that happens in the master, and every
+    worker would share (and rotate) the master's file. A process writing
+    for the first time after a fork closes what it inherited and opens its
+    own file.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.pid = os.getpid()
+        super().__init__(path.format(pid=self.pid), maxBytes=max_bytes,
+                         backupCount=backups, delay=True)
+
+    def emit(self, record):
+        # Called with the handler's lock held.
+        pid = os.getpid()
+
+        if pid != self.pid:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+
+            self.pid = pid
+            self.baseFilename = os.path.abspath(self.path.format(pid=pid))
+
+        super().emit(record)
+
+
+def rotating_logger(path, max_bytes, backups):
+    """A logger writing bare lines to `path`, rotated at `max_bytes`."""
+
+    # Not from getLogger(): each app gets its own, holding only this handler.
+    logger = logging.Logger("warbler.slow_queries")
+    handler = PerProcessFileHandler(path, max_bytes, backups)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+
+    return logger
+
+
+##############################################################################
+# App setup and CLI
+
+
+slowlog_cli = AppGroup("slowlog", help="Inspect the slow-query log.")
+
+
+def init_slow_queries(app):
+    app.cli.add_command(slowlog_cli)
+    threshold = app.config.get("SLOW_QUERY_MS")
+
+    if threshold is None:
+        return
+
+    path = app.config.get("SLOW_QUERY_LOG_PATH")
+    logger = (rotating_logger(path, app.config["SLOW_QUERY_LOG_MAX_BYTES"],
+                              app.config["SLOW_QUERY_LOG_BACKUPS"])
+              if path else app.logger)
+
+    recorder = SlowQueryRecorder(
+        threshold, logger,
+        explain=app.config.get("SLOW_QUERY_EXPLAIN", True),
+        analyze_rate=app.config.get("SLOW_QUERY_ANALYZE_RATE", 0.0),
+        interval=app.config.get("SLOW_QUERY_LOG_INTERVAL_SECONDS", 60),
+    )
+
+    with app.app_context():
+        for engine in db.engines.values():
+            recorder.attach(engine)
+
+    app.extensions["slow_queries"] = recorder
+
+
+def summarize(lines):
+    """[(fingerprint, occurrences, max ms, routes, statement)] from log
+    `lines`, most frequent first."""
+
+    groups = {}
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+
+        key = entry["fingerprint"]
+        occurrences, max_ms, routes, _ = groups.get(key, (0, 0.0, set(), None))
+        routes.add(entry["route"])
+        groups[key] = (occurrences + entry["occurrences"], max(max_ms, entry["ms"]),
+                       routes, entry["statement"])
+
+    return sorted(((key, *group) for key, group in groups.items()),
+                  key=lambda group: group[1], reverse=True)
+
+
+@slowlog_cli.command("summary")
+@click.argument("files", nargs=-1, type=click.File("r"), required=True)
+@click.option("--top", default=20)
+def summary_command(files, top):
+    """Group slow-query log FILES by fingerprint, most frequent first."""
+
+    lines = (line for f in files for line in f)
+
+    for key, occurrences, max_ms, routes, statement in summarize(lines)[:top]:
+        click.echo(f"{key}  {occurrences:>7}x  max {max_ms:>8.1f} ms  "
+                   f"{', '.join(sorted(routes))}")
+        click.echo(f"    {statement[:200]}")
@@ -0,0 +1,43 @@
+"use strict";
+
+// Live "already taken" hints for the signup and edit profile forms. Checks
+// /api/availability as the user types (debounced), so they find out before
+// submitting. Only usernames can be checked; a taken email is reported when
+// the form is submitted.
+
+const DEBOUNCE_MS = 300;
+
+const MESSAGES = {
+  username: "Username already taken",
+};
+
+function watchAvailability(field) {
+  const $input = $(`#user_form #${field}`);
+  const $hint = $('<small class="text-danger availability-hint">').hide();
+  let timer = null;
+  let latest = null;
+
+  $input.after($hint);
+
+  $input.on("input", function () {
+    clearTimeout(timer);
+    $hint.hide();
+
+    const value = $input.val().trim();
+    if (!value) return;
+
+    timer = setTimeout(async function () {
+      latest = value;
+      const resp = await fetch(
+        `/api/availability?${field}=${encodeURIComponent(value)}`);
+      const result = await resp.json();
+
+      // Ignore answers for anything but the latest value.
+      if (value === latest && result[field] === false) {
+        $hint.text(MESSAGES[field]).show();
+      }
+    }, DEBOUNCE_MS);
+  });
+}
+
+watchAvailability("username");
@@ -0,0 +1,47 @@
+"use strict";
+
+// Live homepage timeline: new and deleted messages arrive over /stream
+// (Server-Sent Events) instead of reloading the page. EventSource resends
+// Last-Event-ID when it reconnects, so nothing is missed in between.
+
+const $messages = $("#messages");
+
+function messageItem(msg) {
+  const date = new Date(msg.timestamp).toLocaleDateString(
+    "en-GB", { day: "2-digit", month: "long", year: "numeric" });
+
+  const $item = $('<li class="list-group-item">')
+    .attr("data-message-id", msg.id);
+
+  $item.append($('<a class="message-link">').attr("href", `/messages/${msg.id}`));
+  $item.append(
+    $("<a>").attr("href", `/users/${msg.user_id}`).append(
+      $('<img class="timeline-image" alt="">').attr("src", msg.image_url)));
+  $item.append(
+    $('<div class="message-area">').append(
+      $("<a>").attr("href", `/users/${msg.user_id}`).text(`@${msg.username}`),
+      " ",
+      $('<span class="text-muted">').text(date),
+      $("<p>").text(msg.text)));
+
+  return $item;
+}
+
+const stream = new EventSource("/stream");
+
+stream.addEventListener("message", function (evt) {
+  const msg = JSON.parse(evt.data);
+
+  if ($messages.find(`[data-message-id="${msg.id}"]`).length === 0) {
+    $messages.prepend(messageItem(msg));
+  }
+});
+
+stream.addEventListener("delete", function (evt) {
+  const msg = JSON.parse(evt.data);
+  $messages.find(`[data-message-id="${msg.id}"]`).remove();
+});
+
+stream.addEventListener("reload", function () {
+  window.location.reload();
+});
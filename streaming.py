@@ -0,0 +1,100 @@
+"""Streamed rendering for long list pages.
+
+``render_template()`` builds the whole page before sending a byte.
+``stream_page()`` sends it as Jinja renders it, instead:
+
+- The rows are lazy (``iter_user_cards()``, or a ``Page`` over a
+  ``yield_per`` result), so they are fetched while the template loops over
+  them. Only the current chunk is held in memory.
+- Output is sent in chunks of about ``CHUNK_SIZE`` characters. Everything
+  before ``{{ flush }}`` (the nav bar and flashed messages in base.html)
+  goes out on its own, before the first row is fetched.
+
+Once the body is streaming, the session can no longer change, because the
+cookie went out with the headers. So the flashed messages are popped and
+the CSRF token is made before the first byte. Templates that use
+``get_flashed_messages()`` or ``form.hidden_tag()`` get the same values
+back.
+
+An error in the middle of the page can't become a 500 any more: the
+response is cut short. Anything that can 404 must be loaded before
+``stream_page()`` is called.
+"""
+
+from flask import current_app, get_flashed_messages, stream_template
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+
+CHUNK_SIZE = 16 * 1024
+
+FLUSH = Markup("<!-- flush -->")
+
+
+class Page:
+    """One page of a keyset-paginated query, fetched as it is iterated.
+
+    `rows` holds up to `limit` + 1 rows; the extra one only says there is
+    another page. Once iteration is done, `next_cursor` is `cursor(last row
+    shown)`, or None on the last page. A Page can be iterated only once.
+    """
+
+    def __init__(self, rows, limit, cursor):
+        self._rows = rows
+        self.limit = limit
+        self._cursor = cursor
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+
+        for count, row in enumerate(self._rows):
+            if count == self.limit:
+                self.next_cursor = self._cursor(last)
+                break
+
+            last = row
+            yield row
+
+
+def chunked(events, size=CHUNK_SIZE):
+    """Join Jinja's output `events` into chunks of about `size` characters.
+
+    ``FLUSH`` always ends a chunk.
+    """
+
+    buffer = []
+    buffered = 0
+
+    for event in events:
+        if FLUSH in event:
+            # As str: Markup.partition() would escape the pieces.
+            head, _, tail = str(event).partition(FLUSH)
+            yield "".join(buffer) + head
+            buffer, buffered = [tail], len(tail)
+            continue
+
+        buffer.append(event)
+        buffered += len(event)
+
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+def stream_page(template_name, **context):
+    """Render `template_name` with `context` as a streamed HTML response."""
+
+    # Both write to the session, which must be done before the headers go.
+    get_flashed_messages(with_categories=True)
+    generate_csrf()
+
+    events = stream_template(template_name, flush=FLUSH, **context)
+    response = current_app.response_class(chunked(events), mimetype="text/html")
+    # Closing chunked() doesn't close `events`, and that is what ends the
+    # request context.
+    response.call_on_close(events.close)
+
+    return response
@@ -0,0 +1,235 @@
+"""#tags and @mentions: extraction, index tables and timelines.
+
+``add_message()`` parses a new message's text and records each tag in
+``message_tags`` and each mention of an existing user in ``mentions``, in the
+same transaction. Tag names live once in ``tags``; the index rows are just
+(tag or user id, timestamp, message id), and that is also their primary key,
+so a timeline page is a range scan of the primary key index, however many
+messages a tag has.
+
+Timelines are paginated by a cursor holding the (timestamp, id) of the last
+message shown.
+
+``flask tags backfill`` indexes messages written before this existed.
+"""
+
+import base64
+import re
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, User, Message, Tag, MessageTag, Mention
+
+TAG_RE = re.compile(r"(?<![\w&])#(\w{1,40})")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w{1,30})")
+
+PAGE_SIZE = 50
+
+
+##############################################################################
+# Extraction and indexing
+
+
+def extract(text):
+    """(tags, usernames) used in `text`; tags are lower-cased."""
+
+    tags = dict.fromkeys(tag.lower() for tag in TAG_RE.findall(text))
+    usernames = dict.fromkeys(MENTION_RE.findall(text))
+
+    return list(tags), list(usernames)
+
+
+def insert_ignore(conn, table):
+    """INSERT that skips rows already present (by primary or unique key)."""
+
+    dialect = {"postgresql": postgresql, "sqlite": sqlite}[conn.dialect.name]
+    return dialect.insert(table).on_conflict_do_nothing()
+
+
+def tag_ids(conn, names):
+    """Ids for tag `names`, creating any that don't exist yet.
+
+    Safe against concurrent writers creating the same tag.
+    """
+
+    if not names:
+        return {}
+
+    conn.execute(insert_ignore(conn, Tag.__table__),
+                 [{"name": name} for name in names])
+
+    return dict(conn.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+
+
+def index_rows(conn, messages):
+    """message_tags and mentions rows for (id, text, timestamp) `messages`."""
+
+    extracted = [(message, *extract(message.text)) for message in messages]
+
+    ids = tag_ids(conn, sorted({tag for _, tags, _ in extracted for tag in tags}))
+    usernames = {name for _, _, names in extracted for name in names}
+    users = dict(conn.execute(
+        select(User.username, User.id).where(User.username.in_(usernames))
+    ).all()) if usernames else {}
+
+    tag_rows = []
+    mention_rows = []
+
+    for message, tags, names in extracted:
+        for tag in tags:
+            tag_rows.append({"tag_id": ids[tag], "timestamp": message.timestamp,
+                             "message_id": message.id})
+
+        for name in names:
+            if name in users:
+                mention_rows.append({"user_id": users[name],
+                                     "timestamp": message.timestamp,
+                                     "message_id": message.id})
+
+    return tag_rows, mention_rows
+
+
+def write_rows(conn, tag_rows, mention_rows):
+    if tag_rows:
+        conn.execute(insert_ignore(conn, MessageTag.__table__), tag_rows)
+
+    if mention_rows:
+        conn.execute(insert_ignore(conn, Mention.__table__), mention_rows)
+
+
+def index_message_tags(message):
+    """Record `message`'s tags and mentions (within the current transaction)."""
+
+    db.session.flush()
+    conn = db.session.connection()
+    write_rows(conn, *index_rows(conn, [message]))
+
+
+def unindex_message_tags(message_id):
+    """Remove a message's tags and mentions (within the current transaction)."""
+
+    for model in (MessageTag, Mention):
+        db.session.execute(
+            delete(model).where(model.message_id == message_id))
+
+
+##############################################################################
+# Timelines
+
+
+def encode_cursor(timestamp, message_id):
+    raw = f"{timestamp.isoformat()}|{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(token):
+    """(timestamp, message id) from ``encode_cursor``; None if malformed."""
+
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(token).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def timeline(model, condition, before=None, limit=PAGE_SIZE):
+    """A page of messages indexed in `model` (MessageTag or Mention) under
+    `condition`, newest first, plus the cursor for the next page."""
+
+    stmt = (
+        select(model.timestamp, model.message_id)
+        .where(condition)
+        .order_by(model.timestamp.desc(), model.message_id.desc())
+        .limit(limit + 1)
+    )
+
+    if before:
+        stmt = stmt.where(
+            tuple_(model.timestamp, model.message_id) < tuple_(*before))
+
+    rows = db.session.execute(stmt).all()
+    ids = [message_id for _, message_id in rows[:limit]]
+
+    messages = {
+        msg.id: msg
+        for msg in Message.query
+        .filter(Message.id.in_(ids))
+        .options(db.selectinload(Message.user))
+    }
+    # An index row can outlive its message (e.g. an unenforced cascade).
+    page = [messages[message_id] for message_id in ids if message_id in messages]
+    next_cursor = (encode_cursor(*rows[limit - 1])
+                   if len(rows) > limit else None)
+
+    return page, next_cursor
+
+
+def tag_timeline(name, before=None, limit=PAGE_SIZE):
+    """Messages tagged #`name`, newest first, and the next-page cursor."""
+
+    tag_id = db.session.execute(
+        select(Tag.id).where(Tag.name == name.lower())).scalar()
+
+    if tag_id is None:
+        return [], None
+
+    return timeline(MessageTag, MessageTag.tag_id == tag_id, before, limit)
+
+
+def mentions_timeline(user_id, before=None, limit=PAGE_SIZE):
+    """Messages mentioning `user_id`, newest first, and the next-page cursor."""
+
+    return timeline(Mention, Mention.user_id == user_id, before, limit)
+
+
+##############################################################################
+# Backfill
+
+
+tags_cli = AppGroup("tags", help="Manage the #tag and @mention indexes.")
+
+
+def init_tags(app):
+    app.cli.add_command(tags_cli)
+
+
+def backfill(engine, chunk_size=5000, after_id=0, echo=print):
+    """Index the tags and mentions of every message with id > `after_id`.
+
+    Messages are streamed through a server-side cursor on one connection;
+    each chunk is written and committed on another, so progress survives an
+    interruption (resume with `after_id`) and re-running is harmless. (On
+    SQLite this needs WAL mode, or the writer waits on the reader.)
+    """
+
+    query = (
+        select(Message.id, Message.text, Message.timestamp)
+        .where(Message.id > after_id)
+        .order_by(Message.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    total = 0
+
+    with engine.connect() as reader:
+        for chunk in reader.execute(query).partitions():
+            with engine.begin() as writer:
+                write_rows(writer, *index_rows(writer, chunk))
+
+            total += len(chunk)
+            echo(f"indexed {total} messages (through id {chunk[-1].id})")
+
+    return total
+
+
+@tags_cli.command("backfill")
+@click.option("--chunk-size", default=5000)
+@click.option("--after-id", default=0, help="Resume after this message id.")
+def backfill_command(chunk_size, after_id):
+    """Index tags and mentions of existing messages."""
+
+    backfill(db.engine, chunk_size, after_id, echo=click.echo)
@@ -0,0 +1,80 @@
+"""App factory and config tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+from unittest import TestCase
+
+from testing import app, TEST_DATABASE_URL
+from app import create_app
+from config import engine_options, get_config, ProductionConfig
+from models import db, dispose_engines_after_fork
+
+
+class ConfigTestCase(TestCase):
+    def test_get_config_profiles(self):
+        """each profile name returns its own config class"""
+
+        self.assertIsInstance(get_config("production"), ProductionConfig)
+        self.assertTrue(get_config("testing").TESTING)
+
+        with self.assertRaises(ValueError):
+            get_config("staging")
+
+
+    def test_engine_options_postgres(self):
+        """pool settings are included for server databases"""
+
+        options = engine_options("postgresql:///warbler", pool_size=3)
+
+        self.assertEqual(options["pool_size"], 3)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertIn("pool_recycle", options)
+
+
+    def test_engine_options_sqlite(self):
+        """sqlite only gets pre-ping, since it has no sized pool"""
+
+        self.assertEqual(list(engine_options("sqlite://")), ["pool_pre_ping"])
+
+
+class AppFactoryTestCase(TestCase):
+    def test_testing_app(self):
+        """the test app uses the test database and cheap bcrypt"""
+
+        self.assertEqual(app.config["SQLALCHEMY_DATABASE_URI"], TEST_DATABASE_URL)
+        self.assertEqual(app.config["BCRYPT_LOG_ROUNDS"], 4)
+        self.assertNotIn("debugtoolbar", app.extensions)
+
+
+    def test_production_app(self):
+        """production has no toolbar and compiles templates up front"""
+
+        prod = create_app("production")
+
+        self.assertNotIn("debugtoolbar", prod.extensions)
+        self.assertFalse(prod.debug)
+        self.assertGreater(len(prod.jinja_env.cache), 0)
+
+
+    def test_settings_override_profile(self):
+        """keyword settings are applied on top of the profile"""
+
+        other = create_app("testing", SQLALCHEMY_ECHO=True)
+
+        self.assertTrue(other.config["SQLALCHEMY_ECHO"])
+
+
+    def test_dispose_engines_after_fork(self):
+        """a forked child gets a fresh pool instead of the parent's"""
+
+        other = create_app("testing", SQLALCHEMY_DATABASE_URI="sqlite://")
+
+        with other.app_context():
+            pool = db.engine.pool
+
+            dispose_engines_after_fork([other])
+
+            self.assertIsNot(db.engine.pool, pool)
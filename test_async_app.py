@@ -0,0 +1,342 @@
+"""Async (ASGI) view tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_async_app.py
+
+
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import session
+from starlette.testclient import TestClient
+
+from testing import CURR_USER_KEY
+from app import create_app
+from async_app import async_database_url, create_asgi_app
+import notifications
+from models import db, User, Message, Like, NotificationCounter, Recommendation
+from replicas import PRIMARY_UNTIL_KEY
+from sharding import get_router
+
+
+def login(flask_app, client, user_id, **extra):
+    """sign a Flask session cookie for `user_id` (and any `extra` keys) into
+    `client`"""
+
+    with flask_app.test_request_context():
+        session[CURR_USER_KEY] = user_id
+        session.update(extra)
+        response = flask_app.make_response("")
+        flask_app.session_interface.save_session(flask_app, session, response)
+
+    cookie = response.headers["Set-Cookie"].split(";")[0]
+    name, value = cookie.split("=", 1)
+    client.cookies.set(name, value)
+
+
+class AsyncDatabaseUrlTestCase(TestCase):
+    def test_async_database_url(self):
+        """sync URLs are mapped to their asyncio drivers"""
+
+        self.assertEqual(
+            async_database_url("postgresql:///warbler").drivername,
+            "postgresql+asyncpg")
+        self.assertEqual(
+            async_database_url("sqlite:///x.db").drivername,
+            "sqlite+aiosqlite")
+
+
+class AsyncViewTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "warbler.db")
+
+        self.flask_app = create_app(
+            "testing", SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}")
+
+        with self.flask_app.app_context():
+            db.metadata.create_all(db.engine)
+
+            u1 = User.signup("u1", "u1@email.com", "password", None)
+            u2 = User.signup("u2", "u2@email.com", "password", None)
+            db.session.flush()
+
+            u1.following.append(u2)
+            m1 = Message(text="m1-text", user_id=u2.id)
+            db.session.add(m1)
+            db.session.flush()
+
+            db.session.add(Like(user_id=u1.id, message_id=m1.id))
+            db.session.commit()
+
+            self.u1_id = u1.id
+            self.u2_id = u2.id
+            self.m1_id = m1.id
+
+        self.client = TestClient(create_asgi_app(self.flask_app))
+        self.client.__enter__()
+
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+        with self.flask_app.app_context():
+            db.engine.dispose()
+
+        self.tmpdir.cleanup()
+
+
+    def login(self, user_id):
+        login(self.flask_app, self.client, user_id)
+
+
+    def test_anon_homepage(self):
+        """anonymous users get the signed-out homepage"""
+
+        resp = self.client.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Sign up", resp.text)
+
+
+    def test_homepage(self):
+        """the feed shows followed users' messages with like state"""
+
+        self.login(self.u1_id)
+        resp = self.client.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("TEST HOMEPAGE ROUTE", resp.text)
+        self.assertIn("m1-text", resp.text)
+        self.assertIn("bi-balloon-heart-fill", resp.text)
+
+
+    def test_homepage_matches_sync(self):
+        """the async homepage shows the same feed and suggestions as Flask's"""
+
+        with self.flask_app.app_context():
+            u3 = User.signup("u3", "u3@email.com", "password", None)
+            db.session.flush()
+            db.session.add(Recommendation(
+                user_id=self.u1_id, candidate_id=u3.id, score=1.0, rank=1))
+            db.session.commit()
+
+        self.login(self.u1_id)
+        resp = self.client.get("/")
+
+        flask_client = self.flask_app.test_client()
+
+        with flask_client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        expected = flask_client.get("/").text
+
+        self.assertIn("@u3", resp.text)
+        self.assertEqual(resp.text, expected)
+
+
+    def test_unread_badge_from_async_session(self):
+        """the nav badge's count is read without the sync session"""
+
+        with self.flask_app.app_context():
+            db.session.add(NotificationCounter(user_id=self.u1_id, unread=3))
+            db.session.commit()
+
+        def blocking(user_id):
+            raise AssertionError("sync query on the event loop")
+
+        unread_count = notifications.unread_count
+        notifications.unread_count = blocking
+        self.login(self.u1_id)
+
+        try:
+            resp = self.client.get("/")
+        finally:
+            notifications.unread_count = unread_count
+
+        self.assertIn('<span class="badge bg-primary">3</span>', resp.text)
+
+
+    def test_show_user(self):
+        """profile pages render from the async session"""
+
+        self.login(self.u1_id)
+        resp = self.client.get(f"/users/{self.u2_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u2", resp.text)
+        self.assertIn("Unfollow", resp.text)
+
+
+    def test_show_message(self):
+        """single messages render from the async session"""
+
+        self.login(self.u1_id)
+        resp = self.client.get(f"/messages/{self.m1_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("TEST FOR SHOW MESSAGE ROUTE", resp.text)
+
+
+    def test_missing_message(self):
+        """unknown ids are a 404, like get_or_404"""
+
+        self.login(self.u1_id)
+        resp = self.client.get("/messages/9999")
+
+        self.assertEqual(resp.status_code, 404)
+
+
+    def test_unauthorized_redirects(self):
+        """logged-out users are redirected with a flash message"""
+
+        resp = self.client.get(f"/users/{self.u1_id}", follow_redirects=False)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("session", resp.headers["set-cookie"])
+
+
+    def test_sync_routes_pass_through(self):
+        """everything else is still served by Flask"""
+
+        self.login(self.u1_id)
+        resp = self.client.get(f"/users/{self.u2_id}/followers")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u1", resp.text)
+
+
+class ShardedAsyncViewTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{self.tmpdir.name}/%s.db"
+
+        self.flask_app = create_app(
+            "testing",
+            SQLALCHEMY_DATABASE_URI=url % "warbler",
+            SQLALCHEMY_BINDS={"shard_0": url % "shard0", "shard_1": url % "shard1"},
+            SHARD_BINDS=["shard_0", "shard_1"],
+            SHARD_MAP_REFRESH_SECONDS=0,
+        )
+
+        with self.flask_app.app_context():
+            db.metadata.create_all(db.engine)
+            get_router().create_all()
+
+            u1 = User.signup("u1", "u1@email.com", "password", None)
+            db.session.flush()
+            db.session.add(Message(text="from-a-shard", user_id=u1.id))
+            db.session.commit()
+
+            self.u1_id = u1.id
+
+            # Only the shard has it now: the feed must come from there.
+            Message.query.delete()
+            db.session.commit()
+
+        self.client = TestClient(create_asgi_app(self.flask_app))
+        self.client.__enter__()
+
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+        with self.flask_app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+        self.tmpdir.cleanup()
+
+
+    def test_homepage_reads_shards(self):
+        """the async homepage uses the shard router like the sync one"""
+
+        login(self.flask_app, self.client, self.u1_id)
+        resp = self.client.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("from-a-shard", resp.text)
+
+
+class AsyncReplicaTestCase(TestCase):
+    def setUp(self):
+        """two SQLite files stand in for a primary and its replica"""
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{self.tmpdir.name}/%s.db"
+        self.log = os.path.join(self.tmpdir.name, "slow-{pid}.log")
+
+        self.flask_app = create_app(
+            "testing",
+            SQLALCHEMY_DATABASE_URI=url % "primary",
+            SQLALCHEMY_BINDS={"replica_0": url % "replica"},
+            REPLICA_BINDS=["replica_0"],
+            SLOW_QUERY_MS=0,
+            SLOW_QUERY_LOG_PATH=self.log,
+        )
+
+        # The same user on both sides, with a marker so we can tell which
+        # database served a page.
+        with self.flask_app.app_context():
+            for key, name in [(None, "on-primary"), ("replica_0", "on-replica")]:
+                engine = db.engines[key]
+                db.metadata.create_all(engine)
+
+                with engine.begin() as conn:
+                    conn.execute(User.__table__.insert(), {
+                        "id": 1,
+                        "username": name,
+                        "email": f"{name}@email.com",
+                        "password": "x",
+                    })
+
+        self.client = TestClient(create_asgi_app(self.flask_app))
+        self.client.__enter__()
+
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+        with self.flask_app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+        self.tmpdir.cleanup()
+
+
+    def test_reads_from_replica(self):
+        """async GETs read from the replica, like the sync routes"""
+
+        login(self.flask_app, self.client, 1)
+        resp = self.client.get("/users/1")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("on-replica", resp.text)
+        self.assertNotIn("on-primary", resp.text)
+
+
+    def test_recent_writer_reads_from_primary(self):
+        """a browser that just wrote reads its own writes from the primary"""
+
+        login(self.flask_app, self.client, 1,
+              **{PRIMARY_UNTIL_KEY: time.time() + 60})
+        resp = self.client.get("/users/1")
+
+        self.assertIn("on-primary", resp.text)
+        self.assertNotIn("on-replica", resp.text)
+
+
+    def test_slow_queries_tagged_with_route(self):
+        """async queries reach the slow-query log with their route"""
+
+        login(self.flask_app, self.client, 1)
+        self.client.get("/users/1")
+
+        with open(self.log.format(pid=os.getpid())) as f:
+            routes = {json.loads(line)["route"] for line in f}
+
+        self.assertIn("GET /users/<int:user_id>", routes)
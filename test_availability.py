@@ -0,0 +1,173 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY
+from app import create_app
+from models import db, User
+from availability import BloomFilter, current_availability
+
+
+class BloomFilterTestCase(TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+
+
+    def test_false_positive_rate(self):
+        """close to the configured rate at capacity"""
+
+        bloom = BloomFilter(5000, 0.01)
+
+        for i in range(5000):
+            bloom.add(f"user{i}")
+
+        hits = sum(f"other{i}" in bloom for i in range(20000))
+
+        self.assertLess(hits / 20000, 0.02)
+        self.assertAlmostEqual(bloom.expected_error_rate(), 0.01, delta=0.005)
+
+
+class BackgroundBuildTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "warbler.db")
+
+        self.app = create_app(
+            "testing", SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}",
+            AVAILABILITY_BACKGROUND_BUILD=True)
+
+        with self.app.app_context():
+            db.metadata.create_all(db.engine)
+            User.signup("alice", "alice@email.com", "password", None)
+            db.session.commit()
+
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+
+        self.tmpdir.cleanup()
+
+
+    def test_build_runs_off_the_request(self):
+        """checks before the first build are lookups; the scan runs on a thread"""
+
+        with self.app.app_context():
+            index = current_availability()
+            go = threading.Event()
+            build = index.build
+
+            def held_build():
+                go.wait(5)
+                build()
+
+            index.build = held_build
+
+            self.assertFalse(index.is_available("username", "alice"))
+            self.assertTrue(index.is_available("username", "zed"))
+            self.assertIsNone(index.filter)
+
+            go.set()
+
+            for thread in threading.enumerate():
+                if thread.name == "availability-build":
+                    thread.join(5)
+
+            self.assertIn("username:alice", index.filter)
+            self.assertFalse(index.is_available("username", "alice"))
+
+
+class AvailabilityTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("alice", "alice@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.index = current_availability()
+        self.index.build()
+
+
+    def test_check(self):
+        """taken names are confirmed by a lookup; fresh ones skip it"""
+
+        self.assertFalse(self.index.is_available("username", "alice"))
+        self.assertTrue(self.index.is_available("username", "alice", self.user_id))
+
+        # Names are unique (and log in) case-sensitively.
+        self.assertTrue(self.index.is_available("username", "Alice"))
+
+        hits = self.index.possible_hits
+        self.assertTrue(self.index.is_available("username", "zed"))
+        self.assertEqual(self.index.possible_hits, hits)
+
+
+    def test_tracks_writes(self):
+        """inserts and renames reach the filter without a rebuild"""
+
+        bob = User.signup("bob", "bob@email.com", "password", None)
+        db.session.flush()
+        self.assertFalse(self.index.is_available("email", "bob@email.com"))
+
+        bob.username = "robert"
+        db.session.flush()
+        self.assertFalse(self.index.is_available("username", "robert"))
+        self.assertTrue(self.index.is_available("username", "bob"))
+        self.assertEqual(self.index.stale, 1)
+
+
+    def test_api(self):
+        resp = self.client.get(
+            "/api/availability?username=alice&email=alice@email.com")
+
+        # Emails aren't answered: that would tell anyone who has an account.
+        self.assertEqual(resp.json, {"username": False})
+
+        # A case variant is free, as signup would accept it.
+        resp = self.client.get("/api/availability?username=ALICE")
+        self.assertEqual(resp.json, {"username": True})
+
+
+    def test_signup_reports_the_taken_field(self):
+        """a duplicate email is reported as such, not as a taken username"""
+
+        resp = self.client.post("/signup", data={
+            "username": "alice2",
+            "email": "alice@email.com",
+            "password": "password",
+        })
+
+        self.assertIn("Email already registered", resp.text)
+        self.assertNotIn("Username already taken", resp.text)
+        self.assertEqual(User.query.count(), 1)
+
+
+    def test_edit_profile_keeps_own_name(self):
+        User.signup("bob", "bob@email.com", "password", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            data = {"username": "alice", "email": "alice@email.com",
+                    "password": "password"}
+            resp = c.post("/users/profile", data=data)
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/users/profile", data={**data, "username": "bob"})
+            self.assertIn("Username already taken", resp.text)
@@ -0,0 +1,308 @@
+"""Page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import re
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message
+from cache import LRU, Cache, SharedStore, touch
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.calls = 0
+
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+    def compute(self, value="v", seconds=0):
+        def run():
+            self.calls += 1
+            time.sleep(seconds)
+            return value
+
+        return run
+
+
+    def test_lru(self):
+        lru = LRU(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+
+
+    def test_l2_shared_between_workers(self):
+        """a value computed by one worker is served from L2 by another"""
+
+        first = Cache(SharedStore(self.path))
+        second = Cache(SharedStore(self.path))
+
+        self.assertEqual(first.get("k", self.compute()), "v")
+        self.assertEqual(second.get("k", self.compute()), "v")
+        self.assertEqual(second.get("k", self.compute()), "v")
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.stats["l2_hits"], 1)
+        self.assertEqual(second.stats["l1_hits"], 1)
+
+
+    def test_versions(self):
+        """touching a version invalidates values stamped with it, everywhere"""
+
+        first = Cache(SharedStore(self.path))
+        second = Cache(SharedStore(self.path))
+
+        first.get("profile:1", self.compute("old"), depends=["user:1"])
+        second.get("profile:1", self.compute("old"), depends=["user:1"])
+        first.touch(["user:1"])
+
+        self.assertEqual(
+            second.get("profile:1", self.compute("new"), depends=["user:1"]), "new")
+        self.assertEqual(
+            first.get("profile:1", self.compute("newer"), depends=["user:1"]), "new")
+
+        # Names taken from the computed value.
+        first.get("message:5", self.compute({"author": 2}),
+                  depends=lambda msg: [f"user:{msg['author']}"])
+        second.touch(["user:2"])
+        self.assertIsNone(first._lookup("message:5"))
+
+
+    def test_single_flight(self):
+        """concurrent misses in one worker compute the value once"""
+
+        cache = Cache(SharedStore(self.path))
+        results = []
+
+        def request():
+            results.append(cache.get("hot", self.compute(seconds=0.1)))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["v"] * 8)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats["coalesced"], 7)
+
+
+    def test_errors_reach_waiters(self):
+        cache = Cache(SharedStore(self.path))
+        errors = []
+
+        def fail():
+            time.sleep(0.05)
+            raise LookupError("gone")
+
+        def request():
+            try:
+                cache.get("missing", fail)
+            except LookupError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertIsNone(cache.l2.get("missing"))
+
+
+    def test_lease_across_workers(self):
+        """a worker waits for the lease holder's value instead of computing"""
+
+        holder = Cache(SharedStore(self.path))
+        waiter = Cache(SharedStore(self.path))
+
+        self.assertTrue(holder.l2.acquire("hot", 5))
+
+        def finish():
+            time.sleep(0.05)
+            holder._compute("hot", self.compute("theirs"), (), None)
+            holder.l2.release("hot")
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        value = waiter.get("hot", self.compute("mine"))
+        thread.join()
+
+        self.assertEqual(value, "theirs")
+        self.assertEqual(self.calls, 1)
+
+
+    def test_early_refresh(self):
+        """close to expiry a request recomputes; a lucky draw doesn't"""
+
+        now = [1000.0]
+        draw = [0.0]
+        cache = Cache(SharedStore(self.path, clock=lambda: now[0]), ttl=60,
+                      clock=lambda: now[0], rand=lambda: draw[0])
+
+        cache.get("k", self.compute("v1", seconds=0.01))
+        now[0] += 59.9
+
+        self.assertEqual(cache.get("k", self.compute("v2")), "v1")
+
+        # -log(1e-7) * 0.01s = 0.16s ahead of now: past the expiry.
+        draw[0] = 1 - 1e-7
+        self.assertEqual(cache.get("k", self.compute("v2")), "v2")
+        self.assertEqual(cache.stats["early_refreshes"], 1)
+
+
+class CachedPagesTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.m1_id = u1.id, u2.id, m1.id
+
+        app.extensions["cache"] = Cache(SharedStore())
+
+
+    def tearDown(self):
+        del app.extensions["cache"]
+        super().tearDown()
+
+
+    def test_profile_invalidated_by_touch(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u2_id}")
+
+            db.session.get(User, self.u2_id).bio = "fresh bio"
+            db.session.commit()
+            self.assertNotIn("fresh bio", c.get(f"/users/{self.u2_id}").text)
+
+            touch(f"user:{self.u2_id}")
+            self.assertIn("fresh bio", c.get(f"/users/{self.u2_id}").text)
+
+
+    def test_write_handlers_touch(self):
+        """following and deleting update the cached pages at once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertIn("m1-text", c.get(f"/messages/{self.m1_id}").text)
+            self.assertIn("m1-text", c.get(f"/users/{self.u2_id}").text)
+
+            c.post(f"/messages/{self.m1_id}/delete")
+
+            self.assertEqual(c.get(f"/messages/{self.m1_id}").status_code, 404)
+            self.assertNotIn("m1-text", c.get(f"/users/{self.u2_id}").text)
+
+            c.get(f"/users/{self.u1_id}")
+            c.post(f"/users/follow/{self.u1_id}")
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn(f'action="/users/stop-following/{self.u1_id}"', resp.text)
+
+
+    def stat(self, client, user_id, link=""):
+        """the count shown on `user_id`'s profile for the stat linking to
+        /users/<user_id>`link`"""
+
+        html = client.get(f"/users/{user_id}").text
+        match = re.search(rf'href="/users/{user_id}{link}">\s*(\d+)', html)
+
+        return int(match.group(1))
+
+
+    def test_profile_invalidated_by_writes(self):
+        """posting, liking, following and deleting an account refresh the
+        cached profiles they change"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(self.stat(c, self.u1_id), 0)
+            c.post("/messages/new", data={"text": "fresh-post"})
+            self.assertEqual(self.stat(c, self.u1_id), 1)
+            self.assertIn("fresh-post", c.get(f"/users/{self.u1_id}").text)
+
+            self.assertEqual(self.stat(c, self.u1_id, "/likes"), 0)
+            c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(self.stat(c, self.u1_id, "/likes"), 1)
+
+            self.assertEqual(self.stat(c, self.u2_id, "/followers"), 0)
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(self.stat(c, self.u2_id, "/followers"), 1)
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(self.stat(c, self.u2_id, "/followers"), 0)
+            self.assertEqual(self.stat(c, self.u1_id, "/likes"), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/users/delete")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(c.get(f"/users/{self.u2_id}").status_code, 404)
+            # Not a follower, but the like of u2's message is gone too.
+            self.assertEqual(self.stat(c, self.u1_id, "/likes"), 0)
+
+
+    def test_homepage_refresh(self):
+        """a refresh with nothing new is served from the cache; posts, likes
+        and follows show up at once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertNotIn("m1-text", c.get("/").text)
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertIn("m1-text", c.get("/").text)
+
+            # Written behind the app's back: no touch(), so still cached.
+            db.session.add(Message(text="sneaky", user_id=self.u2_id))
+            db.session.commit()
+            self.assertNotIn("sneaky", c.get("/").text)
+
+            c.post(f"/messages/{self.m1_id}/like")
+            self.assertIn("bi-balloon-heart-fill", c.get("/").text)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "posted"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("posted", c.get("/").text)
@@ -0,0 +1,119 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import unittest
+import zlib
+from unittest import TestCase
+
+from flask import Response
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User
+from compression import brotli, compress_response
+
+
+class CompressRouteTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                 for i in range(20)]
+        db.session.commit()
+
+        self.user_id = users[0].id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+
+    def test_gzip(self):
+        path = f"/users/{self.user_id}"
+        plain = self.client.get(path)
+        resp = self.client.get(path, headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.vary)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.vary)
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+        self.assertEqual(resp.content_length, len(resp.data))
+        self.assertLess(len(resp.data), len(plain.data))
+
+
+    def test_gzip_streamed(self):
+        plain = self.client.get("/users")
+        resp = self.client.get("/users", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIsNone(resp.content_length)
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+
+    def test_negotiation(self):
+        for accept in ["identity", "gzip;q=0", "compress"]:
+            resp = self.client.get("/users", headers={"Accept-Encoding": accept})
+            self.assertNotIn("Content-Encoding", resp.headers, accept)
+            resp.close()
+
+
+    @unittest.skipIf(brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        plain = self.client.get("/users")
+        resp = self.client.get("/users", headers={"Accept-Encoding": "gzip, br"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+
+class CompressResponseTestCase(TestCase):
+    def compress(self, response, accept="gzip"):
+        with app.test_request_context(headers={"Accept-Encoding": accept}):
+            return compress_response(response)
+
+
+    def test_skipped(self):
+        """tiny, already compressed or marked no-transform bodies pass through"""
+
+        body = b"x" * 1000
+        responses = [
+            Response(b"tiny", mimetype="text/html"),
+            Response(body, mimetype="image/png"),
+            Response(body, mimetype="text/html", headers={"Content-Encoding": "br"}),
+            Response(body, mimetype="text/html",
+                     headers={"Cache-Control": "no-transform"}),
+            Response(body, status=206, mimetype="text/html"),
+        ]
+
+        for resp in responses:
+            self.assertEqual(self.compress(resp).get_data(), resp.get_data())
+
+
+    def test_streamed(self):
+        """each chunk of a streamed body is sent as soon as it is produced"""
+
+        chunks = [f"line {i}\n".encode() * 50 for i in range(5)]
+        resp = self.compress(Response(iter(chunks), mimetype="application/x-ndjson"))
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIsNone(resp.content_length)
+
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output = iter(resp.response)
+
+        for chunk in chunks:
+            self.assertEqual(decoder.decompress(next(output)), chunk)
+
+        decoder.decompress(next(output))
+        self.assertTrue(decoder.eof)
+
+
+    def test_weak_etag(self):
+        resp = Response(b"x" * 1000, mimetype="text/css")
+        resp.set_etag("abc")
+
+        self.assertEqual(self.compress(resp).get_etag(), ("abc", True))
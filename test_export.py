@@ -0,0 +1,128 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+from export import encode, export_all
+
+
+class ExportRouteTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="mine", user_id=u1.id)
+        m2 = Message(text="theirs", user_id=u2.id)
+        db.session.add_all([m1, m2, Follow(user_following_id=u2.id,
+                                           user_being_followed_id=u1.id)])
+        db.session.flush()
+        db.session.add(Like(user_id=u1.id, message_id=m2.id))
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.m2_id = u1.id, u2.id, m2.id
+
+
+    def get(self, fmt):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            return c.get(f"/users/export?format={fmt}")
+
+
+    def test_ndjson(self):
+        resp = self.get("ndjson")
+        self.assertTrue(resp.is_streamed)
+
+        records = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertEqual([r["type"] for r in records],
+                         ["profile", "message", "like", "follower"])
+        self.assertEqual(records[0]["username"], "u1")
+        self.assertNotIn("password", records[0])
+        self.assertEqual(records[1]["text"], "mine")
+        self.assertEqual(records[2]["message_id"], self.m2_id)
+        self.assertEqual(records[3]["username"], "u2")
+
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.get("csv").text)))
+
+        self.assertEqual([row["type"] for row in rows],
+                         ["profile", "message", "like", "follower"])
+        self.assertEqual(rows[1]["text"], "mine")
+        self.assertEqual(rows[1]["username"], "")
+
+
+    def test_bad_format(self):
+        self.assertEqual(self.get("xml").status_code, 400)
+
+
+class EncodeTestCase(TestCase):
+    def test_chunks(self):
+        """the first line goes out alone, the rest in chunks"""
+
+        records = ({"type": "message", "id": i} for i in range(100))
+        chunks = list(encode(records, "ndjson", chunk_bytes=500))
+
+        self.assertEqual(chunks[0].count("\n"), 1)
+        self.assertTrue(all(len(chunk) >= 500 for chunk in chunks[1:-1]))
+        self.assertEqual("".join(chunks).count("\n"), 100)
+
+
+class ExportAllTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{os.path.join(self.tmpdir.name, 'export.db')}"
+        engine = create_engine(self.url)
+        db.metadata.create_all(engine)
+
+        with engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com",
+                 "password": "x"}
+                for i in range(1, 6)
+            ])
+            conn.execute(insert(Message), [
+                {"id": i, "user_id": i, "timestamp": datetime(2023, 1, i),
+                 "text": f"hi from u{i}"}
+                for i in range(1, 6)
+            ])
+
+        engine.dispose()
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_export_all(self):
+        out = os.path.join(self.tmpdir.name, "out")
+
+        self.assertEqual(export_all(self.url, out, "ndjson", 2, echo=lambda _: None), 5)
+
+        with open(os.path.join(out, "users-1.ndjson")) as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual([(r["type"], r.get("username") or r.get("text"))
+                          for r in records],
+                         [("profile", "u1"), ("message", "hi from u1"),
+                          ("profile", "u3"), ("message", "hi from u3"),
+                          ("profile", "u5"), ("message", "hi from u5")])
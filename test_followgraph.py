@@ -0,0 +1,208 @@
+"""Follow graph snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+
+import os
+import tempfile
+import threading
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User
+from followgraph import (
+    FollowGraph, build_snapshot, record_follow, UNFOLLOW,
+)
+
+
+class FollowGraphTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "follows.graph")
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.flush()
+
+        u0, u1, u2, u3 = users
+        u0.following.extend([u1, u2])
+        u1.following.append(u2)
+        u3.following.append(u0)
+        db.session.commit()
+
+        self.ids = [u.id for u in users]
+
+
+    def tearDown(self):
+        app.extensions.pop("follow_graph", None)
+        app.config.pop("FOLLOW_GRAPH_PATH", None)
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+
+    def build(self):
+        build_snapshot(db.session.connection(), self.path)
+        graph = FollowGraph(self.path, check_seconds=0)
+        self.addCleanup(graph.close)
+        return graph
+
+
+    def test_snapshot_lookups(self):
+        """checks, counts and id lists come from the CSR arrays"""
+
+        u0, u1, u2, u3 = self.ids
+        graph = self.build()
+
+        self.assertEqual(graph.edge_count, 4)
+        self.assertTrue(graph.is_following(u0, u2))
+        self.assertFalse(graph.is_following(u2, u0))
+        self.assertEqual(graph.following_ids(u0), sorted([u1, u2]))
+        self.assertEqual(graph.follower_ids(u2), sorted([u0, u1]))
+        self.assertEqual(graph.following_count(u2), 0)
+        self.assertEqual(graph.follower_count(u0), 1)
+        self.assertEqual(graph.following_ids(9999), [])
+
+
+    def test_overlay(self):
+        """follows logged after the snapshot are overlaid on it"""
+
+        u0, u1, u2, u3 = self.ids
+        graph = self.build()
+
+        record_follow(self.path, u2, u3)
+        record_follow(self.path, u0, u1, UNFOLLOW)
+
+        self.assertTrue(graph.is_following(u2, u3))
+        self.assertFalse(graph.is_following(u0, u1))
+        self.assertEqual(graph.following_ids(u0), [u2])
+        self.assertEqual(graph.following_count(u0), 1)
+        self.assertEqual(graph.follower_ids(u3), [u2])
+        self.assertEqual(graph.follower_count(u1), 0)
+
+
+    def test_rebuild_is_picked_up(self):
+        """a rebuilt snapshot replaces the overlay it already covers"""
+
+        u0, u1, u2, u3 = self.ids
+        graph = self.build()
+
+        record_follow(self.path, u2, u3)
+        follower = User.query.get(u2)
+        follower.following.append(User.query.get(u3))
+        db.session.commit()
+
+        build_snapshot(db.session.connection(), self.path)
+
+        self.assertEqual(graph.edge_count, 4)
+        self.assertTrue(graph.is_following(u2, u3))
+        self.assertEqual(graph.edge_count, 5)
+        self.assertEqual(graph.following_count(u2), 1)
+
+
+    def test_rebuild_rotates_log(self):
+        """each build starts a new log; the one before last is dropped"""
+
+        u0, u1, u2, u3 = self.ids
+        graph = self.build()
+        graph.check_seconds = 60
+        graph.refresh()
+
+        record_follow(self.path, u2, u3)
+        build_snapshot(db.session.connection(), self.path)
+
+        self.assertEqual(os.path.getsize(f"{self.path}.log"), 0)
+        self.assertGreater(os.path.getsize(f"{self.path}.log.old"), 0)
+
+        # Still on the old snapshot: it finishes the rotated log, then
+        # follows the new one.
+        record_follow(self.path, u3, u2)
+
+        self.assertTrue(graph.is_following(u2, u3))
+        self.assertTrue(graph.is_following(u3, u2))
+
+        build_snapshot(db.session.connection(), self.path)
+
+        self.assertEqual(os.path.getsize(f"{self.path}.log"), 0)
+        self.assertEqual(os.path.getsize(f"{self.path}.log.old"), 9)
+
+
+    def test_threaded_reads_during_rebuilds(self):
+        """readers never see a snapshot being swapped out"""
+
+        u0, u1, u2, u3 = self.ids
+        graph = self.build()
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    graph.follower_count(u2)
+                    graph.following_ids(u0)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for _ in range(20):
+                build_snapshot(db.session.connection(), self.path)
+                graph.refresh()
+        finally:
+            done.set()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+
+
+    def test_delete_user_is_logged(self):
+        """a deleted user's cascaded follows are unfollowed in the overlay"""
+
+        u0, u1, u2, u3 = self.ids
+        app.config["FOLLOW_GRAPH_PATH"] = self.path
+        graph = app.extensions["follow_graph"] = self.build()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            c.post("/users/delete")
+
+        self.assertEqual(graph.following_ids(u3), [])
+        self.assertEqual(graph.follower_ids(u2), [u1])
+        self.assertEqual(graph.follower_count(u1), 0)
+
+
+    def test_follow_routes_use_graph(self):
+        """follow/unfollow routes log to the overlay the app reads from"""
+
+        u0, u1, u2, u3 = self.ids
+        app.config["FOLLOW_GRAPH_PATH"] = self.path
+        app.extensions["follow_graph"] = self.build()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2
+
+            c.post(f"/users/follow/{u3}")
+
+            u2_user = User.query.get(u2)
+            u3_user = User.query.get(u3)
+
+            self.assertTrue(u2_user.is_following(u3_user))
+            self.assertTrue(u3_user.is_followed_by(u2_user))
+            self.assertEqual(u3_user.followers_count, 1)
+
+            c.post(f"/users/stop-following/{u3}")
+
+            self.assertFalse(u2_user.is_following(u3_user))
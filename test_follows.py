@@ -0,0 +1,77 @@
+"""Followers/following page tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follows.py
+
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Follow
+from follows import FOLLOWERS, FOLLOWING, follow_page
+
+
+class FollowPageTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(6)]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+        star, viewer = self.ids[0], self.ids[1]
+
+        # u1..u5 follow u0; u0 follows u1 and u2; the viewer (u1) follows u3.
+        db.session.add_all(
+            [Follow(user_following_id=i, user_being_followed_id=star)
+             for i in self.ids[1:]] +
+            [Follow(user_following_id=star, user_being_followed_id=i)
+             for i in self.ids[1:3]] +
+            [Follow(user_following_id=viewer, user_being_followed_id=self.ids[3])]
+        )
+        db.session.commit()
+
+
+    def test_pages(self):
+        """pages follow on in id order without gaps or repeats"""
+
+        star, viewer = self.ids[0], self.ids[1]
+
+        first, cursor = follow_page(star, FOLLOWERS, viewer, limit=2)
+        second, cursor = follow_page(star, FOLLOWERS, viewer, cursor, limit=2)
+        third, last = follow_page(star, FOLLOWERS, viewer, cursor, limit=2)
+
+        self.assertEqual([card.user.id for card in first + second + third],
+                         self.ids[1:])
+        self.assertIsNone(last)
+
+
+    def test_flags(self):
+        """each row says whether the viewer follows it and it follows back"""
+
+        star, viewer = self.ids[0], self.ids[1]
+        cards, _ = follow_page(star, FOLLOWERS, viewer)
+        flags = {card.user.id: (card.viewer_follows, card.follows_viewer)
+                 for card in cards}
+
+        self.assertEqual(flags[self.ids[3]], (True, False))
+        self.assertEqual(flags[self.ids[4]], (False, False))
+
+        cards, _ = follow_page(star, FOLLOWING, viewer)
+
+        self.assertEqual([card.user.id for card in cards], self.ids[1:3])
+        self.assertEqual([card.follows_viewer for card in cards], [False, False])
+
+
+    def test_routes(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[2]
+
+            resp = c.get(f"/users/{self.ids[1]}/following")
+            self.assertIn("@u0", resp.text)
+            self.assertIn("Follows you", resp.text)
+            self.assertIn("Unfollow", resp.text)
+
+            resp = c.get(f"/users/{self.ids[0]}/followers?after={self.ids[4]}")
+            self.assertIn("@u5", resp.text)
+            self.assertNotIn("@u4", resp.text)
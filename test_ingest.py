@@ -0,0 +1,288 @@
+"""Bulk ingest and group commit tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ingest.py
+
+
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, func, insert, select
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from app import create_app
+from models import db, User, Message, MessageTag
+from ingest import GroupCommitter, InvalidMessage, ingest, parse_line
+from search import find_messages
+
+
+def ndjson(*texts):
+    return "\n".join(json.dumps({"text": text}) for text in texts)
+
+
+class ParseTestCase(TestCase):
+    def test_parse_line(self):
+        now = datetime(2023, 6, 1)
+
+        self.assertEqual(parse_line('{"text": "hi"}', now),
+                         {"text": "hi", "timestamp": now})
+        self.assertEqual(
+            parse_line('{"text": "hi", "timestamp": "2023-01-02T03:04:05"}', now),
+            {"text": "hi", "timestamp": datetime(2023, 1, 2, 3, 4, 5)})
+
+        for line in ['nope', '[1]', '{"text": ""}', '{"text": 5}',
+                     json.dumps({"text": "x" * 141}),
+                     '{"text": "hi", "timestamp": "soon"}',
+                     '{"text": "hi", "timestamp": "2030-01-01T00:00:00"}']:
+            with self.assertRaises(InvalidMessage, msg=line):
+                parse_line(line, now)
+
+
+class BulkRouteTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+
+    def post(self, body, login=True):
+        with (self.client if login else app.test_client()) as c:
+            if login:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+            return c.post("/messages/bulk", data=body,
+                          content_type="application/x-ndjson")
+
+
+    def count(self):
+        return db.session.execute(select(func.count(Message.id))).scalar()
+
+
+    def test_bulk(self):
+        sub = app.extensions["timeline_bus"].subscribe([self.user_id])
+
+        try:
+            resp = self.post(ndjson("first #bulk", "second", "third #bulk"))
+        finally:
+            app.extensions["timeline_bus"].unsubscribe(sub)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["posted"], 3)
+        self.assertEqual(self.count(), 3)
+
+        texts = db.session.execute(
+            select(Message.text).where(Message.id.in_(resp.json["ids"]))
+            .order_by(Message.id)).scalars().all()
+        self.assertEqual(texts, ["first #bulk", "second", "third #bulk"])
+
+        # Indexed for search and tags like a regular post.
+        messages, _ = find_messages("second")
+        self.assertEqual([m.text for m in messages], ["second"])
+        self.assertEqual(db.session.execute(
+            select(func.count()).select_from(MessageTag)).scalar(), 2)
+
+        # And pushed to live timelines like one.
+        self.assertEqual([sub.get(timeout=0).data["text"] for _ in range(3)],
+                         ["first #bulk", "second", "third #bulk"])
+
+
+    def test_invalid_batch(self):
+        """one bad line rejects the whole batch"""
+
+        resp = self.post(ndjson("fine", "x" * 141) + "\nnot json")
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual([e["line"] for e in resp.json["errors"]], [2, 3])
+        self.assertEqual(self.count(), 0)
+
+
+    def test_limits(self):
+        app.config["INGEST_MAX_BATCH"] = 2
+
+        try:
+            self.assertEqual(self.post(ndjson("a", "b", "c")).status_code, 413)
+        finally:
+            app.config["INGEST_MAX_BATCH"] = 5000
+
+        # Too many bytes is refused from the header, before the body is read.
+        app.config["INGEST_MAX_BYTES"] = 10
+
+        try:
+            self.assertEqual(self.post(ndjson("a", "b")).status_code, 413)
+        finally:
+            app.config["INGEST_MAX_BYTES"] = 5 * 1024 * 1024
+
+        self.assertEqual(self.post(ndjson("a"), login=False).status_code, 401)
+
+
+class GroupCommitRouteTestCase(TestCase):
+    """Posting through the form with group commit on."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "warbler.db")
+
+        self.app = create_app(
+            "testing", SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}",
+            INGEST_GROUP_COMMIT=True)
+
+        with self.app.app_context():
+            db.metadata.create_all(db.engine)
+            user = User.signup("u1", "u1@email.com", "password", None)
+            db.session.commit()
+            self.user_id = user.id
+
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+
+        self.tmpdir.cleanup()
+
+
+    def test_add_message(self):
+        committer = self.app.extensions["group_commit"]
+        sub = self.app.extensions["timeline_bus"].subscribe([self.user_id])
+
+        with self.app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/messages/new", data={"text": "grouped #post"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(committer.stats["commits"], 1)
+        self.assertEqual(sub.get(timeout=0).data["text"], "grouped #post")
+
+        with self.app.app_context():
+            self.assertEqual(db.session.execute(
+                select(Message.text)).scalars().all(), ["grouped #post"])
+            self.assertEqual(db.session.execute(
+                select(func.count()).select_from(MessageTag)).scalar(), 1)
+
+
+    def test_slow_commit(self):
+        """a post the writer is slow to commit isn't a 500, and is finished
+        (published, mirrored, cache touched) once it lands"""
+
+        committer = self.app.extensions["group_commit"]
+        sub = self.app.extensions["timeline_bus"].subscribe([self.user_id])
+        gate = threading.Event()
+        commit = committer._commit
+
+        def slow_commit(batch):
+            gate.wait(5)
+            commit(batch)
+
+        committer._commit = slow_commit
+        committer.timeout = 0
+
+        try:
+            with self.app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.post("/messages/new", data={"text": "slow post"},
+                              follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("taking a while to post", resp.text)
+
+            gate.set()
+            self.assertEqual(sub.get(timeout=5).data["text"], "slow post")
+        finally:
+            gate.set()
+            committer._commit = commit
+
+        with self.app.app_context():
+            self.assertEqual(db.session.execute(
+                select(Message.text)).scalars().all(), ["slow post"])
+
+
+class EngineTestCase(TestCase):
+    """Against a SQLite file, as the writer thread needs its own connection."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'ingest.db')}")
+        db.metadata.create_all(self.engine)
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com",
+                 "password": "x"}
+                for i in (1, 2)
+            ])
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def test_group_commit(self):
+        """concurrent posts share commits; a failing one fails alone"""
+
+        committer = GroupCommitter(self.engine, max_batch=50, max_wait=0.05)
+        rows = []
+        errors = []
+
+        def post(user_id, text):
+            try:
+                rows.append(committer.submit(
+                    user_id, {"text": text, "timestamp": datetime.utcnow()}))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=post, args=(1 + i % 2, f"msg {i}"))
+                   for i in range(20)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(row.text for row in rows),
+                         sorted(f"msg {i}" for i in range(20)))
+        self.assertLess(committer.stats["commits"], 20)
+
+        # A bad message in a batch is retried alone, and only it fails.
+        threads = [threading.Thread(target=post, args=(1, text))
+                   for text in ("good", None, "also good")]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(rows), 22)
+        self.assertEqual(len(errors), 1)
+
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(
+                select(func.count(Message.id))).scalar(), 22)
+
+
+    def test_ingest(self):
+        lines = [json.dumps({"text": f"line {i}"}) for i in range(5)]
+        lines.insert(2, "garbage")
+
+        with app.app_context():
+            posted, skipped = ingest(self.engine, 1, lines, batch_size=2,
+                                     echo=lambda _: None)
+
+        self.assertEqual((posted, skipped), (5, 1))
+
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(
+                select(Message.text).order_by(Message.id)).scalars().all(),
+                [f"line {i}" for i in range(5)])
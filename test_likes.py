@@ -0,0 +1,108 @@
+"""Likes page tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Message, Like
+from likes import backfill, likes_page
+from tags import decode_cursor
+
+
+class LikesPageTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        self.user_id = user.id
+
+        now = datetime.utcnow()
+        self.messages = [Message(text=f"msg {i}", user_id=user.id,
+                                 timestamp=now - timedelta(days=i))
+                         for i in range(5)]
+        db.session.add_all(self.messages)
+        db.session.flush()
+
+        # Liked oldest message first, so like order is the reverse of
+        # message order.
+        db.session.add_all([
+            Like(user_id=user.id, message_id=msg.id,
+                 liked_at=now + timedelta(minutes=i))
+            for i, msg in enumerate(reversed(self.messages))
+        ])
+        db.session.commit()
+
+
+    def test_newest_like_first(self):
+        first, cursor = likes_page(self.user_id, limit=3)
+        rest, last = likes_page(self.user_id, decode_cursor(cursor), limit=3)
+
+        self.assertEqual([msg.id for _, msg in first + rest],
+                         [msg.id for msg in self.messages])
+        self.assertIsNone(last)
+
+
+    def test_route(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get(f"/users/{self.user_id}/likes")
+
+        self.assertIn("msg 4", resp.text)
+        self.assertLess(resp.text.index("msg 0"), resp.text.index("msg 4"))
+
+
+class BackfillTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'likes.db')}")
+        db.metadata.create_all(self.engine)
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def test_backfill(self):
+        """untimed likes get their message's timestamp; timed ones are kept"""
+
+        then = datetime(2022, 1, 1)
+        now = datetime(2023, 1, 1)
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com",
+                 "password": "x"}
+                for i in range(1, 4)
+            ])
+            conn.execute(insert(Message), [
+                {"id": 1, "user_id": 1, "timestamp": then, "text": "hi"}])
+            conn.execute(insert(Like), [
+                {"user_id": 1, "message_id": 1, "message_timestamp": then,
+                 "liked_at": None},
+                {"user_id": 2, "message_id": 1, "message_timestamp": then,
+                 "liked_at": now},
+                {"user_id": 3, "message_id": 1, "message_timestamp": then,
+                 "liked_at": None},
+            ])
+
+        self.assertEqual(backfill(self.engine, batch_size=1, echo=lambda _: None), 2)
+
+        with self.engine.connect() as conn:
+            liked_at = conn.execute(
+                select(Like.liked_at).order_by(Like.user_id)).scalars().all()
+
+        self.assertEqual(liked_at, [then, now, then])
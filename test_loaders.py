@@ -0,0 +1,102 @@
+"""Batch loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loaders.py
+
+
+from sqlalchemy import event
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message, Follow
+from loaders import dispatch_all, load, load_many, want
+
+
+class LoaderTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(11)]
+        db.session.flush()
+        self.ids = [user.id for user in users]
+        viewer = self.ids[0]
+
+        db.session.add_all(
+            [Follow(user_following_id=viewer, user_being_followed_id=i)
+             for i in self.ids[1:]] +
+            [Message(text=f"hello from u{n}", user_id=i)
+             for n, i in enumerate(self.ids)]
+        )
+        db.session.commit()
+
+        self.statements = []
+        event.listen(self.connection, "before_cursor_execute", self.record)
+
+
+    def tearDown(self):
+        event.remove(self.connection, "before_cursor_execute", self.record)
+        super().tearDown()
+
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+
+    def user_selects(self):
+        return [s for s in self.statements
+                if s.lstrip().startswith("SELECT users.")]
+
+
+    def test_feed_authors_in_one_query(self):
+        """the homepage feed brings its authors along; only g.user is loaded"""
+
+        db.session.expunge_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            app.config["LOADER_STATS_HEADER"] = True
+
+            try:
+                resp = c.get("/")
+            finally:
+                app.config["LOADER_STATS_HEADER"] = False
+
+        self.assertIn("hello from u10", resp.text)
+        self.assertEqual(len(self.user_selects()), 1)
+        self.assertEqual(resp.headers["X-Loader-Stats"],
+                         "queries=1 fetched=1 saved=0")
+
+
+    def test_prefetch_message_authors(self):
+        """loading messages queues their authors for one IN query"""
+
+        db.session.expunge_all()
+
+        with app.test_request_context():
+            messages = Message.query.all()
+            dispatch_all()
+            self.statements.clear()
+
+            self.assertEqual(len({msg.user.username for msg in messages}), 11)
+            self.assertEqual(self.user_selects(), [])
+
+
+    def test_load_api(self):
+        """queued ids are fetched together and memoized"""
+
+        db.session.expunge_all()
+
+        with app.test_request_context():
+            want(User, self.ids[:5])
+            first = load(User, self.ids[0])
+            users = load_many(User, self.ids[:5])
+            missing = load(User, -1)
+
+        self.assertEqual(first.username, "u0")
+        self.assertEqual([user.username for user in users],
+                         [f"u{i}" for i in range(5)])
+        self.assertIsNone(missing)
+        self.assertEqual(len(self.user_selects()), 2)
@@ -2,48 +2,16 @@
 
 # run these tests like:
 #
-#    FLASK_DEBUG=False python -m unittest test_message_views.py
+#    python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
-
+from testing import DBTestCase, CURR_USER_KEY
 from models import db, Message, User, Like
 
-from flask import jsonify
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-# This is a bit of hack, but don't use Flask DebugToolbar
 
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageBaseViewTestCase(TestCase):
+class MessageBaseViewTestCase(DBTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -58,8 +26,6 @@ class MessageBaseViewTestCase(TestCase):
 
         self.m1_id = m1.id
 
-        self.client = app.test_client()
-
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
     def test_add_message(self):
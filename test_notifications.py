@@ -0,0 +1,159 @@
+"""Coalesced notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select, update
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message, Notification, NotificationCounter
+from notifications import (
+    FOLLOW, LIKE, NotificationBuffer, notifications_page, recount, unread_count,
+    window_start,
+)
+from tags import decode_cursor
+
+
+class BufferTestCase(TestCase):
+    """Against a SQLite file, as the writer thread needs its own connection."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'notes.db')}")
+        db.metadata.create_all(self.engine)
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com", "password": "x"}
+                for i in range(1, 301)
+            ])
+            conn.execute(insert(Message), [
+                {"id": 1, "user_id": 1, "text": "viral", "timestamp": datetime(2023, 1, 1)}
+            ])
+
+        self.buffer = NotificationBuffer(self.engine, window=3600, max_wait=60)
+        self.at = datetime(2023, 1, 1, 12, 5)
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def rows(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(Notification.kind, Notification.actor_count,
+                       Notification.actor_id, Notification.window_start)
+                .order_by(Notification.id)).all()
+
+
+    def unread(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(NotificationCounter.unread)
+                                .where(NotificationCounter.user_id == 1)).scalar()
+
+
+    def test_window_start(self):
+        self.assertEqual(window_start(self.at, 3600), datetime(2023, 1, 1, 12))
+        self.assertEqual(window_start(self.at, 24 * 3600), datetime(2023, 1, 1))
+
+
+    def test_coalesced(self):
+        """250 likes and 2 follows make two rows"""
+
+        for actor in range(2, 252):
+            self.buffer.add(LIKE, 1, 1, actor, self.at + timedelta(seconds=actor))
+        for actor in (252, 253):
+            self.buffer.add(FOLLOW, 1, 1, actor, self.at)
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.rows(), [(LIKE, 250, 251, datetime(2023, 1, 1, 12)),
+                                       (FOLLOW, 2, 253, datetime(2023, 1, 1, 12))])
+        self.assertEqual(self.unread(), 2)
+
+        # Already unread: more likes in the window don't add to the count.
+        self.buffer.add(LIKE, 1, 1, 260, self.at + timedelta(minutes=10))
+        self.buffer.flush()
+
+        self.assertEqual(self.rows()[0][:3], (LIKE, 251, 260))
+        self.assertEqual(self.unread(), 2)
+
+        # Once seen, fresh activity makes it unread again.
+        with self.engine.begin() as conn:
+            conn.execute(update(NotificationCounter).values(
+                unread=0, seen_at=self.at + timedelta(minutes=20)))
+
+        self.buffer.add(LIKE, 1, 1, 261, self.at + timedelta(minutes=30))
+        self.buffer.add(LIKE, 1, 1, 262, self.at + timedelta(hours=1))
+        self.buffer.flush()
+
+        self.assertEqual([row.actor_count for row in self.rows()], [252, 2, 1])
+        self.assertEqual(self.unread(), 2)
+
+        with self.engine.begin() as conn:
+            conn.execute(update(NotificationCounter).values(unread=99))
+            self.assertEqual(recount(conn), 1)
+
+        self.assertEqual(self.unread(), 2)
+
+
+class NotificationRouteTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(1, 4)]
+        db.session.flush()
+
+        message = Message(text="hello", user_id=users[0].id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.ids = [user.id for user in users]
+        self.message_id = message.id
+
+
+    def as_user(self, user_id):
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client
+
+
+    def test_like_and_follow(self):
+        u1, u2, u3 = self.ids
+
+        self.as_user(u2).post(f"/messages/{self.message_id}/like")
+        self.as_user(u3).post(f"/messages/{self.message_id}/like")
+        self.as_user(u1).post(f"/messages/{self.message_id}/like")
+        self.as_user(u2).post(f"/users/follow/{u1}")
+
+        self.assertEqual(unread_count(u1), 2)
+
+        client = self.as_user(u1)
+        self.assertIn('<span class="badge bg-primary">2</span>', client.get("/").text)
+
+        html = client.get("/notifications").text
+        self.assertNotIn('class="badge', html)
+        self.assertIn("followed you", html)
+        self.assertIn("@u3</a>", html)
+        self.assertIn("and 1 other", html)
+        self.assertIn("liked your", html)
+        self.assertEqual(unread_count(u1), 0)
+
+        first, cursor = notifications_page(u1, limit=1)
+        rest, last = notifications_page(u1, decode_cursor(cursor), limit=1)
+
+        self.assertEqual([note.kind for note in first + rest], [FOLLOW, LIKE])
+        self.assertIsNone(last)
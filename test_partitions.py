@@ -0,0 +1,165 @@
+"""Message partitioning tests.
+
+The DDL itself needs PostgreSQL; these cover the month arithmetic, the
+archive schedule and what the app does on any database.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select, text
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message, Like
+from partitions import (
+    add_months, months, partition_name, partition_month, due_for_archive,
+    create_partition_sql, add_like_timestamps,
+)
+
+
+class MonthsTestCase(TestCase):
+    def test_months(self):
+        self.assertEqual(add_months(date(2023, 11, 1), 3), date(2024, 2, 1))
+        self.assertEqual(add_months(date(2023, 1, 1), -1), date(2022, 12, 1))
+        self.assertEqual(
+            list(months(datetime(2023, 11, 20), date(2024, 1, 1))),
+            [date(2023, 11, 1), date(2023, 12, 1), date(2024, 1, 1)])
+
+
+    def test_names(self):
+        name = partition_name("likes", date(2023, 5, 1))
+
+        self.assertEqual(name, "likes_p2023_05")
+        self.assertEqual(partition_month("likes", name), date(2023, 5, 1))
+        self.assertIsNone(partition_month("likes", "likes_default"))
+        self.assertIsNone(partition_month("messages", name))
+        self.assertEqual(
+            create_partition_sql("messages", date(2023, 12, 1)),
+            "CREATE TABLE IF NOT EXISTS messages_p2023_12 PARTITION OF messages "
+            "FOR VALUES FROM ('2023-12-01') TO ('2024-01-01')")
+
+
+    def test_due_for_archive(self):
+        """only months that ended before the cutoff go cold"""
+
+        hot = [date(2023, m, 1) for m in range(1, 7)]
+        now = datetime(2023, 6, 15)
+
+        self.assertEqual(due_for_archive(hot, now, hot_days=60),
+                         [date(2023, 1, 1), date(2023, 2, 1), date(2023, 3, 1)])
+
+
+class PartitionedAppTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        self.user_id = user.id
+
+        now = datetime.utcnow()
+        self.new = Message(text="new", user_id=user.id, timestamp=now)
+        self.old = Message(text="old", user_id=user.id,
+                           timestamp=now - timedelta(days=400))
+        db.session.add_all([self.new, self.old])
+        db.session.commit()
+
+
+    def test_like_gets_message_timestamp(self):
+        like = Like(user_id=self.user_id, message_id=self.old.id)
+        db.session.add(like)
+        db.session.commit()
+
+        self.assertEqual(like.message_timestamp, self.old.timestamp)
+
+
+    def test_feed_hot_only(self):
+        """with FEED_HOT_ONLY the feed skips messages past the hot window"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            self.assertIn(">old<", c.get("/").text)
+
+            app.config["FEED_HOT_ONLY"] = True
+
+            try:
+                resp = c.get("/")
+            finally:
+                app.config["FEED_HOT_ONLY"] = False
+
+            self.assertIn(">new<", resp.text)
+            self.assertNotIn(">old<", resp.text)
+
+
+    def test_commands_need_postgres(self):
+        result = app.test_cli_runner().invoke(args=["partitions", "maintain"])
+
+        self.assertIn("needs PostgreSQL", result.output)
+
+
+class AddLikeTimestampsTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'likes.db')}")
+
+        # The schema from before likes.message_timestamp.
+        db.metadata.create_all(self.engine, tables=[User.__table__,
+                                                    Message.__table__])
+
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE likes (user_id INTEGER NOT NULL,"
+                " message_id INTEGER NOT NULL, liked_at TIMESTAMP,"
+                " PRIMARY KEY (user_id, message_id))"))
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def test_add_like_timestamps(self):
+        """the column is added and filled in batches; leftovers are reported"""
+
+        then = datetime(2022, 1, 1)
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com",
+                 "password": "x"}
+                for i in range(1, 4)
+            ])
+            conn.execute(insert(Message), [
+                {"id": i, "user_id": 1, "timestamp": then + timedelta(days=i),
+                 "text": "hi"}
+                for i in range(1, 3)
+            ])
+            conn.execute(text("INSERT INTO likes (user_id, message_id) VALUES "
+                              "(1, 1), (2, 1), (2, 2), (3, 2), (3, 9)"))
+
+        # Message 9 is gone, so its like can't be filled.
+        self.assertEqual(
+            add_like_timestamps(self.engine, 2, echo=lambda _: None), 1)
+
+        with self.engine.begin() as conn:
+            timestamps = conn.execute(
+                select(Like.message_timestamp)
+                .order_by(Like.user_id, Like.message_id)).scalars().all()
+            conn.execute(text("DELETE FROM likes WHERE message_id = 9"))
+
+        self.assertEqual(timestamps, [then + timedelta(days=1)] * 2
+                         + [then + timedelta(days=2)] * 2 + [None])
+
+        # Re-running is safe and finishes once nothing is missing.
+        self.assertEqual(
+            add_like_timestamps(self.engine, 2, echo=lambda _: None), 0)
@@ -0,0 +1,97 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User
+from profiler import Sampler
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplerTestCase(TestCase):
+    def test_sample(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=spin, args=(stop,))
+        thread.start()
+
+        try:
+            sampler = Sampler(lambda: {thread.ident: "tag"}, 0.001)
+
+            for _ in range(5):
+                sampler.sample()
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertEqual(sampler.samples, 5)
+        self.assertEqual(sum(sampler.stacks.values()), 5)
+
+        for line in sampler.collapsed().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("tag;"))
+            self.assertIn("test_profiler.spin", stack)
+
+
+class ProfileRouteTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app.config["PROFILER_TOKEN"] = "s3cret"
+        app.extensions["profiler"].output_dir = self.tmpdir.name
+
+
+    def tearDown(self):
+        app.config["PROFILER_TOKEN"] = None
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+
+    def test_request_profile(self):
+        """the header swaps a page for its collapsed stacks"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            page = c.get("/", headers={"X-Profile": "wrong"})
+            resp = c.get("/", headers={"X-Profile": "s3cret"})
+
+        self.assertEqual(page.mimetype, "text/html")
+        self.assertEqual(resp.mimetype, "text/plain")
+        self.assertIn("X-Profile-Samples", resp.headers)
+
+        for line in resp.text.splitlines():
+            self.assertTrue(line.startswith("warbler.homepage;"), line)
+
+
+    def test_start(self):
+        self.assertEqual(self.client.post("/_profile").status_code, 404)
+
+        resp = self.client.post("/_profile?seconds=0.05",
+                                headers={"X-Profile": "s3cret"})
+        self.assertEqual(resp.status_code, 202)
+
+        deadline = time.monotonic() + 5
+
+        while not os.path.exists(resp.json["path"]) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(os.path.exists(resp.json["path"]))
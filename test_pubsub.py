@@ -0,0 +1,170 @@
+"""Live timeline (pub/sub + SSE) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message
+from pubsub import Bus
+
+
+class BusTestCase(TestCase):
+    def setUp(self):
+        self.bus = Bus(history=5, queue_size=2)
+
+
+    def test_fan_out_filters_by_author(self):
+        """subscribers only get events about authors they follow"""
+
+        sub = self.bus.subscribe([1, 2])
+        self.bus.publish("message", 1, {"id": 10})
+        self.bus.publish("message", 3, {"id": 11})
+
+        self.assertEqual(sub.get(timeout=0).data, {"id": 10})
+        self.assertIsNone(sub.get(timeout=0))
+
+
+    def test_drop_oldest(self):
+        """a full queue drops its oldest event"""
+
+        sub = self.bus.subscribe([1])
+
+        for i in range(3):
+            self.bus.publish("message", 1, {"id": i})
+
+        self.assertEqual(sub.dropped, 1)
+        self.assertEqual(sub.get(timeout=0).data, {"id": 1})
+        self.assertEqual(sub.get(timeout=0).data, {"id": 2})
+
+
+    def test_resume_from_last_event_id(self):
+        """reconnecting replays only the events after Last-Event-ID"""
+
+        first = self.bus.publish("message", 1, {"id": 1})
+        self.bus.publish("message", 1, {"id": 2})
+
+        sub = self.bus.subscribe([1], last_event_id=first.id)
+
+        self.assertFalse(sub.stale)
+        self.assertEqual(sub.get(timeout=0).data, {"id": 2})
+        self.assertIsNone(sub.get(timeout=0))
+
+
+    def test_stale_last_event_id(self):
+        """an id older than the history marks the subscription stale"""
+
+        first = self.bus.publish("message", 1, {"id": 0})
+
+        for i in range(1, 7):
+            self.bus.publish("message", 1, {"id": i})
+
+        sub = self.bus.subscribe([1], last_event_id=first.id)
+
+        self.assertTrue(sub.stale)
+
+
+    def test_unsubscribe(self):
+        sub = self.bus.subscribe([1])
+        self.bus.unsubscribe(sub)
+
+        self.assertEqual(self.bus.subscriber_count, 0)
+
+
+class StreamViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        app.config["STREAM_ENABLED"] = True
+
+
+    def tearDown(self):
+        app.config["STREAM_ENABLED"] = False
+        app.config["STREAM_MAX_SECONDS"] = 5 * 60
+        super().tearDown()
+
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+
+    def test_stream_off_by_default(self):
+        """without STREAM_ENABLED there is no stream and no script for it"""
+
+        app.config["STREAM_ENABLED"] = False
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            self.assertEqual(c.get("/stream").status_code, 404)
+            self.assertNotIn("timeline.js", c.get("/").text)
+
+            app.config["STREAM_ENABLED"] = True
+            self.assertIn("timeline.js", c.get("/").text)
+
+
+    def test_stream_ends(self):
+        """a stream is closed after STREAM_MAX_SECONDS, for the client to
+        reconnect"""
+
+        app.config["STREAM_MAX_SECONDS"] = 0
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.get("/stream", buffered=False)
+            frames = [frame.decode() for frame in resp.response]
+
+        self.assertEqual(len(frames), 1)
+        self.assertTrue(frames[0].startswith("retry:"))
+        self.assertEqual(app.extensions["timeline_bus"].subscriber_count, 0)
+
+
+    def test_stream_requires_login(self):
+        resp = self.client.get("/stream")
+
+        self.assertEqual(resp.status_code, 302)
+
+
+    def test_stream_pushes_followed_messages(self):
+        """a followed user's new message arrives on the stream"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/stream", buffered=False)
+            frames = (frame.decode() for frame in resp.response)
+
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            self.assertTrue(next(frames).startswith("retry:"))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "live!"})
+            msg = Message.query.filter_by(text="live!").one()
+
+            frame = next(frames)
+            self.assertIn("event: message", frame)
+            self.assertIn('"text": "live!"', frame)
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertIn("event: delete", next(frames))
+
+            resp.close()
+
+        self.assertEqual(app.extensions["timeline_bus"].subscriber_count, 0)
@@ -0,0 +1,181 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+from scipy import sparse
+from sqlalchemy import select
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message, Follow, Like, Recommendation, StaleRecommendation
+from recommendations import (
+    edges_to_matrix, top_k_per_row, compute, stale_rows, build, read_edges,
+)
+
+
+class ScoringTestCase(DBTestCase):
+    def test_top_k_per_row(self):
+        """rows are ranked by score, ties broken by lower column"""
+
+        matrix = sparse.csr_matrix(
+            ([1, 5, 5, 2], ([0, 0, 0, 1], [3, 1, 2, 0])), shape=(2, 4))
+
+        rows, cols, scores, ranks = top_k_per_row(matrix, 2)
+
+        self.assertEqual(rows.tolist(), [0, 0, 1])
+        self.assertEqual(cols.tolist(), [1, 2, 0])
+        self.assertEqual(scores.tolist(), [5, 5, 2])
+        self.assertEqual(ranks.tolist(), [0, 1, 0])
+
+
+    def test_friends_of_friends(self):
+        """candidates are followed by followees, minus self and followed"""
+
+        # 0 follows 1 and 2; 1 follows 2, 3 and 0; 2 follows 3 and 4.
+        F = edges_to_matrix([0, 0, 1, 1, 1, 2, 2],
+                            [1, 2, 2, 3, 0, 3, 4], (5, 5))
+        L = edges_to_matrix([], [], (5, 1))
+
+        users, candidates, scores, ranks = next(compute(F, L, [0]))
+
+        self.assertEqual(users.tolist(), [0, 0])
+        self.assertEqual(candidates.tolist(), [3, 4])
+        self.assertEqual(scores.tolist(), [2, 1])
+
+
+    def test_shared_likes_boost(self):
+        """shared likes break ties between equally-connected candidates"""
+
+        F = edges_to_matrix([0, 1, 1], [1, 2, 3], (4, 4))
+        L = edges_to_matrix([0, 3], [0, 0], (4, 1))
+
+        _, candidates, scores, _ = next(compute(F, L, [0], like_weight=0.5))
+
+        self.assertEqual(candidates.tolist(), [3, 2])
+        self.assertEqual(scores.tolist(), [1.5, 1])
+
+
+    def test_stale_rows(self):
+        """a stale user's followers are refreshed too"""
+
+        F = edges_to_matrix([0, 1, 2], [2, 2, 3], (4, 4))
+
+        self.assertEqual(stale_rows(F, [2]).tolist(), [0, 1, 2])
+        self.assertEqual(stale_rows(F, []).tolist(), [])
+
+
+    def test_bench_command(self):
+        result = app.test_cli_runner().invoke(args=[
+            "recommendations", "bench", "--users", "200", "--messages", "100"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("200 users", result.output)
+
+
+class RecommendationBuildTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(4)
+        ]
+        db.session.flush()
+
+        u0, u1, u2, u3 = users
+        u0.following.append(u1)
+        u1.following.extend([u2, u3])
+        db.session.commit()
+
+        self.ids = [u.id for u in users]
+
+
+    def build(self, **kwargs):
+        stats = build(db.session.connection(), **kwargs)
+        db.session.commit()
+        return stats
+
+
+    def test_build_and_for_user(self):
+        """stored suggestions come back in rank order with candidates"""
+
+        u0, u1, u2, u3 = self.ids
+        self.build()
+
+        suggestions = Recommendation.for_user(u0)
+
+        self.assertEqual([s.candidate_id for s in suggestions], [u2, u3])
+        self.assertEqual([s.rank for s in suggestions], [0, 1])
+        self.assertEqual(suggestions[0].candidate.username, "u2")
+        self.assertEqual(Recommendation.for_user(u1), [])
+
+
+    def test_incremental(self):
+        """only stale users and their followers are rebuilt"""
+
+        u0, u1, u2, u3 = self.ids
+        self.build()
+
+        msg = Message(text="hi", user_id=u3)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add_all([Like(user_id=u0, message_id=msg.id),
+                            Like(user_id=u3, message_id=msg.id)])
+        StaleRecommendation.mark(u0)
+        db.session.commit()
+
+        stats = self.build(incremental=True)
+
+        self.assertEqual(stats.users, 1)
+        self.assertEqual(
+            [s.candidate_id for s in Recommendation.for_user(u0)], [u3, u2])
+        self.assertEqual(StaleRecommendation.query.count(), 0)
+
+
+    def test_read_edges(self):
+        """edges stream into one (n, 2) int32 array, across batches"""
+
+        u0, u1, u2, u3 = self.ids
+        edges = read_edges(
+            db.session.connection(),
+            select(Follow.user_following_id, Follow.user_being_followed_id)
+            .order_by(Follow.user_following_id, Follow.user_being_followed_id),
+            batch_size=2)
+
+        self.assertEqual(edges.dtype, "int32")
+        self.assertEqual(edges.tolist(), [[u0, u1], [u1, u2], [u1, u3]])
+
+
+    def test_mark_twice(self):
+        """marking an already-stale user is a no-op, not a conflict"""
+
+        u0, u1, u2, u3 = self.ids
+
+        StaleRecommendation.mark(u0)
+        StaleRecommendation.mark(u0)
+        db.session.commit()
+
+        self.assertEqual(
+            [s.user_id for s in StaleRecommendation.query], [u0])
+
+
+    def test_routes_mark_stale(self):
+        """following and liking flag the user and homepage shows suggestions"""
+
+        u0, u1, u2, u3 = self.ids
+        self.build()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            resp = c.get("/")
+            self.assertIn("Who to follow", resp.text)
+            self.assertIn("@u2", resp.text)
+
+            c.post(f"/users/follow/{u2}")
+
+        self.assertEqual(
+            [s.user_id for s in StaleRecommendation.query], [u0])
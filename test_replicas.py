@@ -0,0 +1,119 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from testing import CURR_USER_KEY
+from app import create_app
+from models import db, User, Message, NotificationCounter
+from replicas import PRIMARY_UNTIL_KEY
+
+
+class ReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        """two SQLite files stand in for a primary and its replica"""
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        primary = os.path.join(self.tmpdir.name, "primary.db")
+        replica = os.path.join(self.tmpdir.name, "replica.db")
+
+        self.app = create_app(
+            "testing",
+            SQLALCHEMY_DATABASE_URI=f"sqlite:///{primary}",
+            SQLALCHEMY_BINDS={"replica_0": f"sqlite:///{replica}"},
+            REPLICA_BINDS=["replica_0"],
+            READ_YOUR_WRITES_SECONDS=60,
+        )
+
+        # The same user on both sides, with a marker so we can tell which
+        # database served a page.
+        with self.app.app_context():
+            for key, name in [(None, "on-primary"), ("replica_0", "on-replica")]:
+                engine = db.engines[key]
+                db.metadata.create_all(engine)
+
+                with engine.begin() as conn:
+                    conn.execute(User.__table__.insert(), {
+                        "id": 1,
+                        "username": name,
+                        "email": f"{name}@email.com",
+                        "password": "x",
+                    })
+
+                engine.dispose()
+
+        self.client = self.app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_get_reads_from_replica(self):
+        """GET handlers read from the replica"""
+
+        html = self.client.get("/users").get_data(as_text=True)
+
+        self.assertIn("on-replica", html)
+        self.assertNotIn("on-primary", html)
+
+
+    def test_post_writes_to_primary_and_sticks(self):
+        """a write lands on the primary and later reads follow it there"""
+
+        resp = self.client.post("/messages/new", data={"text": "hello"})
+        self.assertEqual(resp.status_code, 302)
+
+        with self.app.app_context():
+            primary_msgs = db.session.query(Message).count()
+            replica_msgs = db.session.execute(
+                Message.__table__.select(),
+                bind_arguments={"bind": db.engines["replica_0"]},
+            ).all()
+
+        self.assertEqual(primary_msgs, 1)
+        self.assertEqual(replica_msgs, [])
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("on-primary", html)
+
+
+    def test_notifications_mark_seen_on_primary(self):
+        """opening notifications is a GET, but its write still goes to the primary"""
+
+        resp = self.client.get("/notifications")
+        self.assertEqual(resp.status_code, 200)
+
+        with self.app.app_context():
+            primary = db.session.query(NotificationCounter).count()
+            replica = db.session.execute(
+                NotificationCounter.__table__.select(),
+                bind_arguments={"bind": db.engines["replica_0"]},
+            ).all()
+
+        self.assertEqual(primary, 1)
+        self.assertEqual(replica, [])
+
+        with self.client.session_transaction() as sess:
+            self.assertGreater(sess[PRIMARY_UNTIL_KEY], time.time())
+
+
+    def test_stickiness_expires(self):
+        """once the window has passed, reads go back to the replica"""
+
+        with self.client.session_transaction() as sess:
+            sess[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+        html = self.client.get("/users").get_data(as_text=True)
+
+        self.assertIn("on-replica", html)
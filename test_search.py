@@ -0,0 +1,150 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Message, MessageTerm
+from search import Query, Cursor, find_messages, index_message, reindex, tokenize
+
+
+class QueryTestCase(TestCase):
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Hello, World! it's 2023"),
+                         ["hello", "world", "it", "s", "2023"])
+
+
+    def test_parse(self):
+        """words, quoted phrases and prefix* terms"""
+
+        query = Query.parse('Cats "cute  DOG" pho*')
+
+        self.assertEqual(query.words, ["cats", "cute", "dog"])
+        self.assertEqual(query.phrases, [["cute", "dog"]])
+        self.assertEqual(query.prefixes, ["pho"])
+        self.assertEqual(query.driver(), ("cats", False))
+        self.assertFalse(Query.parse(' "" * '))
+
+
+    def test_cursor_round_trip(self):
+        cursor = Cursor.decode(Cursor(123.456, 7).encode())
+
+        self.assertEqual((cursor.key, cursor.message_id), (123.456, 7))
+        self.assertIsNone(Cursor.decode("not a cursor"))
+
+
+class SearchTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        self.user_id = user.id
+
+        now = datetime.utcnow()
+        texts = [
+            ("a cute dog in the park", 5),
+            ("dog cute dog", 4),
+            ("photos of my cat", 3),
+            ("photography class today", 2),
+            ("the dog is cute", 1),
+        ]
+
+        self.ids = {}
+
+        for text, days_ago in texts:
+            msg = Message(text=text, user_id=user.id,
+                          timestamp=now - timedelta(days=days_ago))
+            db.session.add(msg)
+            index_message(msg)
+            self.ids[text] = msg.id
+
+        db.session.commit()
+
+
+    def search(self, text, **kwargs):
+        messages, cursor = find_messages(text, half_life=86400, **kwargs)
+        return [msg.text for msg in messages], cursor
+
+
+    def test_words_are_anded(self):
+        texts, _ = self.search("dog cute")
+
+        self.assertEqual(set(texts), {"a cute dog in the park", "dog cute dog",
+                                      "the dog is cute"})
+        self.assertEqual(self.search("dog cat")[0], [])
+
+
+    def test_phrase(self):
+        texts, _ = self.search('"cute dog"')
+
+        self.assertEqual(set(texts), {"a cute dog in the park", "dog cute dog"})
+
+
+    def test_prefix(self):
+        texts, _ = self.search("photo*")
+
+        self.assertEqual(texts, ["photography class today", "photos of my cat"])
+
+
+    def test_recency_weighted_ranking(self):
+        """newer wins, unless an older message matches more often"""
+
+        texts, _ = self.search("dog")
+
+        # "dog cute dog" has two matches (worth one half-life), so it
+        # outranks the day-newer single match but not the 3-day-newer one.
+        self.assertEqual(texts, ["the dog is cute", "dog cute dog",
+                                 "a cute dog in the park"])
+
+
+    def test_cursor_pagination(self):
+        """pages follow on from each other without gaps or repeats"""
+
+        first, cursor = self.search("dog", limit=2)
+        second, last = self.search("dog", limit=2, cursor=cursor)
+
+        self.assertEqual(first + second, self.search("dog")[0])
+        self.assertIsNone(last)
+
+
+    def test_early_termination_is_exact(self):
+        """small batches give the same results as one big scan"""
+
+        self.assertEqual(self.search("dog", limit=1, batch_size=1)[0],
+                         ["the dog is cute"])
+        self.assertEqual(self.search("cute", batch_size=1)[0],
+                         self.search("cute")[0])
+
+
+    def test_reindex(self):
+        db.session.query(MessageTerm).delete()
+        self.assertEqual(self.search("cat")[0], [])
+
+        reindex(echo=lambda line: None)
+
+        self.assertEqual(self.search("cat")[0], ["photos of my cat"])
+
+
+    def test_views_maintain_index(self):
+        """adding and deleting messages updates search results"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "zebra crossing"})
+            resp = c.get("/messages/search?q=zebra")
+            self.assertIn("zebra crossing", resp.text)
+
+            msg_id = Message.query.filter_by(text="zebra crossing").one().id
+            c.post(f"/messages/{msg_id}/delete")
+
+            resp = c.get("/messages/search?q=zebra")
+            self.assertNotIn("zebra crossing", resp.text)
+            self.assertIn("no warbles found", resp.text)
@@ -0,0 +1,185 @@
+"""Message/like sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.pool import StaticPool
+
+from testing import CURR_USER_KEY
+from app import create_app
+from models import db, User, Message, Like
+from sharding import (
+    NUM_BUCKETS, ShardRouter, get_router, move_bucket, shard_likes,
+    shard_messages,
+)
+
+
+def memory_engine():
+    return create_engine("sqlite://", poolclass=StaticPool,
+                         connect_args={"check_same_thread": False})
+
+
+class ShardRouterTestCase(TestCase):
+    def setUp(self):
+        self.router = ShardRouter([memory_engine(), memory_engine()])
+        self.router.create_all()
+
+
+    def test_shard_for(self):
+        """users are spread over shards by bucket"""
+
+        self.assertEqual(self.router.shard_for(2), 0)
+        self.assertEqual(self.router.shard_for(3), 1)
+        self.assertEqual(self.router.shard_for(NUM_BUCKETS + 3), 1)
+
+
+    def test_feed_merges_shards(self):
+        """the feed is a newest-first merge across every shard"""
+
+        now = datetime(2023, 1, 1)
+        writes = [
+            ("add_message", user_id, {
+                "id": i,
+                "text": f"m{i}",
+                "timestamp": now + timedelta(minutes=i),
+                "user_id": user_id,
+            })
+            for i, user_id in enumerate([2, 3, 2, 3, 5], start=1)
+        ]
+        self.router.apply(writes)
+
+        feed = self.router.feed([2, 3], limit=3)
+
+        self.assertEqual([row.id for row in feed], [4, 3, 2])
+
+
+    def test_moving_bucket_writes_to_both(self):
+        """while a bucket moves, writes land on both shards"""
+
+        self.router.moving[self.router.bucket_for(2)] = 1
+
+        self.assertEqual(self.router.write_shards(2), [0, 1])
+
+
+class ShardedAppTestCase(TestCase):
+    def setUp(self):
+        self.app = create_app(
+            "testing",
+            SQLALCHEMY_DATABASE_URI="sqlite://",
+            SQLALCHEMY_BINDS={"shard_0": "sqlite://", "shard_1": "sqlite://"},
+            SHARD_BINDS=["shard_0", "shard_1"],
+            SHARD_MAP_REFRESH_SECONDS=0,
+        )
+
+        with self.app.app_context():
+            db.metadata.create_all(db.engine)
+            get_router().create_all()
+
+            u1 = User.signup("u1", "u1@email.com", "password", None)
+            u2 = User.signup("u2", "u2@email.com", "password", None)
+            db.session.commit()
+
+            self.u1_id = u1.id
+            self.u2_id = u2.id
+
+        self.client = self.app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+
+    def shard_count(self, shard, table):
+        with self.app.app_context():
+            engine = get_router().engines[shard]
+
+            with engine.connect() as conn:
+                return conn.execute(
+                    select(func.count()).select_from(table)).scalar()
+
+
+    def test_writes_are_mirrored(self):
+        """new messages and likes reach the author's/liker's shard"""
+
+        self.client.post("/messages/new", data={"text": "sharded!"})
+
+        with self.app.app_context():
+            msg = Message.query.one()
+            shard = get_router().shard_for(self.u1_id)
+
+            db.session.add(Like(user_id=self.u2_id, message_id=msg.id))
+            db.session.commit()
+            like_shard = get_router().shard_for(self.u2_id)
+
+        self.assertEqual(self.shard_count(shard, shard_messages), 1)
+        self.assertEqual(self.shard_count(1 - shard, shard_messages), 0)
+        self.assertEqual(self.shard_count(like_shard, shard_likes), 1)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("sharded!", html)
+
+
+    def test_delete_is_mirrored(self):
+        """deleting a message removes it from its shard"""
+
+        self.client.post("/messages/new", data={"text": "short-lived"})
+
+        with self.app.app_context():
+            msg_id = Message.query.one().id
+            shard = get_router().shard_for(self.u1_id)
+
+        self.client.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(self.shard_count(shard, shard_messages), 0)
+
+
+    def test_move_bucket(self):
+        """moving a bucket relocates its rows and keeps the feed intact"""
+
+        self.client.post("/messages/new", data={"text": "on the move"})
+
+        with self.app.app_context():
+            router = get_router()
+            source = router.shard_for(self.u1_id)
+            target = 1 - source
+
+            move_bucket(router, router.bucket_for(self.u1_id), target,
+                        echo=lambda msg: None)
+
+            self.assertEqual(router.shard_for(self.u1_id), target)
+
+        self.assertEqual(self.shard_count(source, shard_messages), 0)
+        self.assertEqual(self.shard_count(target, shard_messages), 1)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("on the move", html)
+
+
+    def test_delete_user_is_mirrored(self):
+        """deleting a user removes their messages and likes from the shards"""
+
+        self.client.post("/messages/new", data={"text": "bye"})
+
+        with self.app.app_context():
+            msg = Message.query.one()
+            db.session.add(Message(text="stays", user_id=self.u2_id))
+            db.session.flush()
+            other = Message.query.filter_by(user_id=self.u2_id).one()
+            db.session.add_all([Like(user_id=self.u2_id, message_id=msg.id),
+                                Like(user_id=self.u1_id, message_id=other.id)])
+            db.session.commit()
+
+        self.client.post("/users/delete")
+
+        with self.app.app_context():
+            router = get_router()
+            messages = router.feed([self.u1_id, self.u2_id])
+
+            self.assertEqual([row.text for row in messages], ["stays"])
+            self.assertEqual(router.liked_message_ids(self.u1_id), set())
+            self.assertEqual(router.liked_message_ids(self.u2_id), set())
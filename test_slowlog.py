@@ -0,0 +1,146 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select
+
+from testing import app
+from models import db, User
+from slowlog import SlowQueryRecorder, fingerprint, redact, rotating_logger, summarize
+
+
+class FingerprintTestCase(TestCase):
+    def test_same_shape(self):
+        a, normalized = fingerprint(
+            "SELECT * FROM users WHERE id IN (?, ?, ?) AND username = 'bob' LIMIT 10")
+        b, _ = fingerprint(
+            "SELECT *  FROM users\n WHERE id IN (?) AND username = 'o''neil' LIMIT 20")
+        c, _ = fingerprint("SELECT * FROM messages WHERE id IN (?)")
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertEqual(normalized,
+                         "SELECT * FROM users WHERE id IN (...) AND username = ? LIMIT ?")
+
+
+    def test_placeholders(self):
+        self.assertEqual(
+            fingerprint("INSERT INTO t (a, b) VALUES (%(a)s, %(b)s), (%(a_1)s, %(b_1)s)")[1],
+            "INSERT INTO t (a, b) VALUES (...)")
+        self.assertEqual(fingerprint("SELECT x::text FROM t WHERE y = $1")[1],
+                         "SELECT x::text FROM t WHERE y = ?")
+
+
+    def test_redact(self):
+        self.assertEqual(redact({"name": "bob", "id": 3, "bio": None}),
+                         {"name": "<str>", "id": "<int>", "bio": None})
+        self.assertEqual(redact(("bob", 1.5)), ["<str>", "<float>"])
+
+
+class RecorderTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'slow.db')}")
+        db.metadata.create_all(self.engine)
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": i, "username": f"u{i}", "email": f"u{i}@x.com", "password": "x"}
+                for i in range(1, 4)
+            ])
+
+        self.now = 0
+        self.log = os.path.join(self.tmpdir.name, "slow-{pid}.log")
+        self.recorder = SlowQueryRecorder(
+            0, rotating_logger(self.log, 1024 * 1024, 1), interval=60,
+            clock=lambda: self.now)
+        self.recorder.attach(self.engine)
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def lines(self):
+        with open(self.log.format(pid=os.getpid())) as f:
+            return [json.loads(line) for line in f]
+
+
+    def query(self, username):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(User.id).where(User.username == username)).scalar()
+
+
+    def test_grouped(self):
+        """repeats of a slow query are counted, not logged"""
+
+        with app.test_request_context("/users/1"):
+            for i in range(1, 4):
+                self.assertEqual(self.query(f"u{i}"), i)
+
+        entries = [e for e in self.lines() if "username" in e["statement"]]
+
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry["occurrences"], 1)
+        self.assertEqual(entry["route"], "GET /users/<int:user_id>")
+        self.assertEqual(entry["parameters"], ["<str>"])
+        self.assertNotIn("u1", json.dumps(entry))
+        self.assertFalse(entry["analyzed"])
+        self.assertTrue(any("users" in line for line in entry["plan"]))
+
+        group = self.recorder.groups[entry["fingerprint"]]
+        self.assertEqual(group.count, 3)
+
+        # Once the interval is up, the next one is logged with the backlog.
+        self.now = 61
+        self.query("u1")
+
+        entries = [e for e in self.lines() if "username" in e["statement"]]
+        self.assertEqual([e["occurrences"] for e in entries], [1, 3])
+        self.assertEqual(entries[1]["route"], "-")
+
+        summary = summarize(json.dumps(e) for e in entries)
+        self.assertEqual(summary[0][:2], (entry["fingerprint"], 4))
+
+
+    def test_forked_workers_get_their_own_file(self):
+        """{pid} is the writing process's, not the one that made the logger"""
+
+        logger = rotating_logger(self.log, 1024 * 1024, 1)
+        logger.warning("parent")
+
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                logger.warning("child")
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        logger.handlers[0].close()
+
+        with open(self.log.format(pid=pid)) as f:
+            self.assertEqual(f.read(), "child\n")
+
+        with open(self.log.format(pid=os.getpid())) as f:
+            self.assertEqual(f.read(), "parent\n")
+
+
+    def test_threshold(self):
+        self.recorder.threshold_ms = 60_000
+        self.query("u1")
+
+        self.assertFalse(os.path.exists(self.log.format(pid=os.getpid())))
@@ -0,0 +1,107 @@
+"""Streamed page rendering tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streaming.py
+
+
+import re
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User
+from streaming import FLUSH, Page, chunked
+
+
+class StreamedPageTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"user{i}", f"user{i}@email.com", "password", None)
+                 for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+
+    def test_header_first(self):
+        """the nav bar goes out before any row is rendered"""
+
+        with app.test_client() as c:
+            self.login(c)
+            resp = c.get("/users")
+
+            self.assertTrue(resp.is_streamed)
+            chunks = iter(resp.response)
+            first = next(chunks)
+
+            self.assertIn(b"</nav>", first)
+            self.assertNotIn(b"user-card", first)
+
+            rest = b"".join(chunks)
+            resp.close()
+
+        self.assertEqual(rest.count(b'class="card user-card"'), 5)
+        self.assertNotIn(FLUSH.encode(), first + rest)
+
+
+    def test_flash_shown_once(self):
+        with app.test_client() as c:
+            self.login(c)
+
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("info", "Hello there")]
+
+            self.assertIn("Hello there", c.get("/users").text)
+            self.assertNotIn("Hello there", c.get("/users").text)
+
+
+    def test_csrf(self):
+        """the token in a streamed page is in the session cookie too"""
+
+        app.config["WTF_CSRF_ENABLED"] = True
+
+        try:
+            with app.test_client() as c:
+                self.login(c)
+                html = c.get("/users").text
+                token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                                  html).group(1)
+
+                resp = c.post(f"/users/follow/{self.ids[1]}",
+                              data={"csrf_token": token})
+        finally:
+            app.config["WTF_CSRF_ENABLED"] = False
+
+        self.assertEqual(resp.location, f"/users/{self.ids[0]}/following")
+
+
+    def test_no_users(self):
+        with app.test_client() as c:
+            self.login(c)
+
+            self.assertIn("Sorry, no users found", c.get("/users?q=nobody").text)
+
+
+class ChunkedTestCase(TestCase):
+    def test_chunked(self):
+        events = ["<head>", "x" * 10, FLUSH, "y" * 10, "z" * 30, "w"]
+
+        self.assertEqual(list(chunked(iter(events), size=20)),
+                         ["<head>" + "x" * 10, "y" * 10 + "z" * 30, "w"])
+
+
+    def test_page(self):
+        page = Page(iter(range(1, 5)), 3, lambda n: n * 10)
+
+        self.assertEqual(list(page), [1, 2, 3])
+        self.assertEqual(page.next_cursor, 30)
+
+        last = Page(iter(range(1, 3)), 3, lambda n: n * 10)
+
+        self.assertEqual(list(last), [1, 2])
+        self.assertIsNone(last.next_cursor)
@@ -0,0 +1,191 @@
+"""#tag and @mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select, func
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Message, MessageTerm, Tag, MessageTag, Mention
+from tags import (
+    extract, backfill, tag_timeline, mentions_timeline, decode_cursor,
+)
+
+
+class ExtractTestCase(TestCase):
+    def test_extract(self):
+        """tags are lower-cased and de-duplicated; emails aren't mentions"""
+
+        tags, names = extract(
+            "#Flask and #flask with @alice, @bob_2 (me@example.com) &#39;x")
+
+        self.assertEqual(tags, ["flask"])
+        self.assertEqual(names, ["alice", "bob_2"])
+
+
+class TagTimelineTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        alice = User.signup("alice", "alice@email.com", "password", None)
+        bob = User.signup("bob", "bob@email.com", "password", None)
+        db.session.commit()
+
+        self.alice_id, self.bob_id = alice.id, bob.id
+
+
+    def post(self, text, user_id=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id or self.alice_id
+
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one().id
+
+
+    def test_add_message_indexes(self):
+        """tags and mentions of known users are stored at write time"""
+
+        msg_id = self.post("hi @bob and @nobody #Python #python #web")
+
+        names = {
+            name for (name,) in db.session.execute(
+                select(Tag.name).join(MessageTag).where(
+                    MessageTag.message_id == msg_id))
+        }
+        self.assertEqual(names, {"python", "web"})
+
+        mentions = Mention.query.filter_by(message_id=msg_id).all()
+        self.assertEqual([m.user_id for m in mentions], [self.bob_id])
+
+
+    def test_tag_pages(self):
+        """tag timelines are newest first and paginate by cursor"""
+
+        ids = [self.post(f"post {i} #paged") for i in range(5)]
+        self.post("other #unrelated")
+
+        first, cursor = tag_timeline("PAGED", limit=2)
+        second, cursor2 = tag_timeline("paged", decode_cursor(cursor), limit=2)
+        third, cursor3 = tag_timeline("paged", decode_cursor(cursor2), limit=2)
+
+        self.assertEqual([m.id for m in first + second + third], ids[::-1])
+        self.assertIsNone(cursor3)
+        self.assertEqual(tag_timeline("missing"), ([], None))
+
+
+    def test_routes(self):
+        """tag and mention pages render; deleting a message unindexes it"""
+
+        msg_id = self.post("ping @bob #hello")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.bob_id
+
+            resp = c.get("/mentions")
+            self.assertIn("ping @bob #hello", resp.text)
+
+            resp = c.get("/tags/Hello")
+            self.assertIn("ping @bob #hello", resp.text)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice_id
+
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(mentions_timeline(self.bob_id), ([], None))
+        self.assertEqual(MessageTag.query.count(), 0)
+
+
+    def test_deleted_user(self):
+        """a deleted user's messages leave search and tag pages cleanly"""
+
+        self.post("farewell @bob #gone")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.alice_id
+
+            c.post("/users/delete")
+
+        self.assertEqual(MessageTerm.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+        # Index rows left behind by an earlier delete are skipped.
+        tag = Tag.query.filter_by(name="gone").one()
+        db.session.add_all([
+            MessageTag(tag_id=tag.id, timestamp=datetime.utcnow(), message_id=999),
+            MessageTerm(term="farewell", timestamp=datetime.utcnow(),
+                        message_id=999, positions="0"),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.bob_id
+
+            resp = c.get("/messages/search?q=farewell")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("farewell @bob", resp.text)
+
+            resp = c.get("/tags/gone")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("farewell @bob", resp.text)
+
+
+class BackfillTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'backfill.db')}")
+        db.metadata.create_all(self.engine)
+
+        # The backfill writes while its reader's cursor is open; SQLite only
+        # allows that in WAL mode.
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+
+    def test_backfill(self):
+        """existing messages are indexed in chunks; re-running is harmless"""
+
+        now = datetime.utcnow()
+
+        with self.engine.begin() as conn:
+            conn.execute(insert(User), [
+                {"id": 1, "username": "alice", "email": "a@x.com", "password": "x"},
+                {"id": 2, "username": "bob", "email": "b@x.com", "password": "x"},
+            ])
+            conn.execute(insert(Message), [
+                {"id": i, "user_id": 1, "timestamp": now + timedelta(seconds=i),
+                 "text": f"#tag{i % 3} hello @bob"}
+                for i in range(1, 11)
+            ])
+
+        self.assertEqual(backfill(self.engine, chunk_size=3, echo=lambda _: None), 10)
+        backfill(self.engine, chunk_size=4, after_id=5, echo=lambda _: None)
+
+        with self.engine.connect() as conn:
+            tags = conn.execute(select(func.count()).select_from(Tag)).scalar()
+            tagged = conn.execute(
+                select(func.count()).select_from(MessageTag)).scalar()
+            mentions = conn.execute(
+                select(func.count()).select_from(Mention)).scalar()
+
+        self.assertEqual((tags, tagged, mentions), (3, 10, 10))
@@ -0,0 +1,297 @@
+"""Trending aggregator and route tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from testing import DBTestCase, CURR_USER_KEY, app
+from models import db, User, Message
+from trending import TrendingAggregator, CountMinSketch, Checkpointer
+
+
+class Clock:
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TrendingAggregatorTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+
+    def aggregator(self, **kwargs):
+        kwargs.setdefault("cache_seconds", 0)
+        return TrendingAggregator(clock=self.clock, **kwargs)
+
+
+    def test_sketch_never_undercounts(self):
+        """Count-Min estimates are >= the true count and close to it"""
+
+        sketch = CountMinSketch(width=256, depth=4)
+        rng = random.Random(1)
+        truth = {}
+
+        for _ in range(5000):
+            key = int(rng.paretovariate(1.1)) % 2000
+            sketch.add(key)
+            truth[key] = truth.get(key, 0) + 1
+
+        for key, count in truth.items():
+            self.assertGreaterEqual(sketch[key], count)
+            self.assertLessEqual(sketch[key], count + 5000 * 2.72 / 256)
+
+
+    def test_top_matches_exact(self):
+        """sketched top-K agrees with exact counting on the heavy hitters"""
+
+        exact = self.aggregator(exact=True)
+        sketched = self.aggregator(candidates=50)
+        rng = random.Random(2)
+
+        for _ in range(5000):
+            message_id = int(rng.paretovariate(1.2))
+            exact.record(message_id)
+            sketched.record(message_id)
+
+        expected = exact.top(k=5)
+        actual = sketched.top(k=5)
+
+        self.assertEqual([m for m, _ in actual], [m for m, _ in expected])
+        for (_, got), (_, want) in zip(actual, expected):
+            self.assertGreaterEqual(got, want)
+
+
+    def test_windows_slide(self):
+        """likes drop out of the hour window but stay in the day window"""
+
+        agg = self.aggregator(exact=True)
+
+        agg.record(1)
+        agg.record(1)
+        agg.record(2)
+        self.assertEqual(agg.top("hour"), [(1, 2), (2, 1)])
+
+        self.clock.now += 2 * 60 * 60
+        agg.record(2)
+
+        self.assertEqual(agg.top("hour"), [(2, 1)])
+        self.assertEqual(agg.top("day"), [(1, 2), (2, 2)])
+
+        self.clock.now += 24 * 60 * 60
+        self.assertEqual(agg.top("day"), [])
+
+
+    def test_unlike_and_forget(self):
+        """unlikes decrement counts and forgotten messages are not ranked"""
+
+        agg = self.aggregator(exact=True)
+
+        agg.record(1)
+        agg.record(1)
+        agg.record(1, -1)
+        agg.record(2)
+        agg.record(2)
+
+        self.assertEqual(agg.count(1), 1)
+
+        agg.forget(2)
+        self.assertEqual(agg.top(), [(1, 1)])
+
+
+    def test_candidates_bounded(self):
+        """the heavy-hitter candidate set never grows far past its limit"""
+
+        agg = self.aggregator(candidates=10)
+
+        for _ in range(20):
+            agg.record(1)
+        for message_id in range(2, 500):
+            agg.record(message_id)
+
+        self.assertLessEqual(len(agg._candidates), 12)
+        self.assertEqual(agg.top(k=1), [(1, 20)])
+
+
+    def test_checkpoint_round_trip(self):
+        """a saved aggregator is restored with the same counts"""
+
+        agg = self.aggregator()
+        for message_id in (1, 1, 2):
+            agg.record(message_id)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trending.pickle")
+            agg.save(path)
+
+            restored = self.aggregator()
+            self.assertTrue(restored.load(path))
+            self.assertEqual(restored.top(), agg.top())
+
+            self.assertFalse(self.aggregator(exact=True).load(path))
+
+
+    def test_load_adds_counts(self):
+        """loading a checkpoint adds its sketches to the current counts"""
+
+        first, second = self.aggregator(), self.aggregator()
+
+        for message_id in (1, 1, 2):
+            first.record(message_id)
+
+        second.record(1)
+        self.clock.now += 60 * 60
+        second.record(3)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trending.pickle")
+            first.save(path)
+            second.load(path)
+
+        self.assertEqual(second.count(1, "day"), 3)
+        self.assertEqual(second.count(2, "day"), 1)
+        self.assertEqual(second.top("hour"), [(3, 1)])
+
+
+    def test_workers_adopt_orphaned_checkpoints(self):
+        """a starting worker merges dead workers' checkpoints, not live ones"""
+
+        dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                              capture_output=True, text=True).stdout.strip()
+        live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.addCleanup(live.wait)
+        self.addCleanup(live.kill)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trending.pickle")
+
+            for pid_suffix, likes in [(f".{dead}", 2), ("", 1), (f".{live.pid}", 5)]:
+                agg = self.aggregator()
+
+                for _ in range(likes):
+                    agg.record(1)
+
+                agg.save(path + pid_suffix)
+
+            worker = Checkpointer(self.aggregator(), path)
+            worker.start()
+            worker.start()
+
+            self.assertEqual(worker.aggregator.count(1), 3)
+            self.assertEqual(sorted(os.listdir(tmpdir)), sorted([
+                f"trending.pickle.{os.getpid()}", f"trending.pickle.{live.pid}"]))
+
+
+    def test_combined_counts_every_live_worker(self):
+        """each worker ranks from its own counts plus live workers' checkpoints"""
+
+        live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.addCleanup(live.wait)
+        self.addCleanup(live.kill)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trending.pickle")
+
+            other = self.aggregator()
+            for message_id in (2, 2, 2):
+                other.record(message_id)
+            other.save(f"{path}.{live.pid}")
+
+            worker = Checkpointer(self.aggregator(), path)
+            worker.start()
+
+            for message_id in (1, 1, 2):
+                worker.aggregator.record(message_id)
+
+            self.assertEqual(worker.combined().top(), [(2, 4), (1, 2)])
+
+            # Its own aggregator still holds only the likes it served.
+            self.assertEqual(worker.aggregator.top(), [(1, 2), (2, 1)])
+
+
+class TrendingViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        app.extensions["trending"] = TrendingAggregator(
+            exact=True, cache_seconds=0)
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="popular", user_id=u1.id)
+        m2 = Message(text="quiet", user_id=u1.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.u1_id, self.u2_id = u1.id, u2.id
+        self.m1_id, self.m2_id = m1.id, m2.id
+
+
+    def test_like_feeds_trending(self):
+        """likes through the routes show up on /trending, most liked first"""
+
+        for user_id in (self.u1_id, self.u2_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/messages/{self.m1_id}/like")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m2_id}/like")
+            c.post(f"/messages/{self.m2_id}/unlike")
+
+            resp = c.get("/trending")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("popular", resp.text)
+        self.assertNotIn("quiet", resp.text)
+        self.assertEqual(app.extensions["trending"].top(),
+                         [(self.m1_id, 2)])
+
+
+    def test_trending_requires_login(self):
+        resp = self.client.get("/trending", follow_redirects=True)
+        self.assertIn("Access unauthorized", resp.text)
+
+
+    def test_trending_includes_other_workers(self):
+        """/trending counts likes served by other live workers"""
+
+        live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.addCleanup(live.wait)
+        self.addCleanup(live.kill)
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "trending.pickle")
+
+        other = TrendingAggregator(exact=True, cache_seconds=0)
+        other.record(self.m2_id)
+        other.save(f"{path}.{live.pid}")
+
+        app.extensions["trending_checkpointer"] = Checkpointer(
+            app.extensions["trending"], path)
+        self.addCleanup(app.extensions.pop, "trending_checkpointer")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/trending")
+
+        self.assertIn("quiet", resp.text)
@@ -5,34 +5,14 @@
 #    python -m unittest test_user_model.py
 
 
-from app import app
-import os
-from unittest import TestCase
-
+from testing import DBTestCase
 from models import db, User, Message, Follow
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
 
-db.drop_all()
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DBTestCase):
     def setUp(self):
         """set up the testing environment before each test"""
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -48,13 +28,6 @@ class UserModelTestCase(TestCase):
         self.u1_id = u1.id
         self.u2_id = u2.id
 
-        self.client = app.test_client()
-
-
-    def tearDown(self):
-        """break down the testing environment after every test"""
-        db.session.rollback()
-
 
     def test_user_model(self):
         """tests creation of user model"""
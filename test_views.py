@@ -0,0 +1,86 @@
+"""List view model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_views.py
+
+
+from datetime import datetime, timedelta
+
+from testing import DBTestCase, CURR_USER_KEY
+from models import db, User, Message, Follow, Like
+from views import MessageView, feed, user_cards, user_messages
+
+
+class ViewsTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("other", "u3@email.com", "password", None)
+        db.session.flush()
+        self.ids = [u1.id, u2.id, u3.id]
+
+        now = datetime.utcnow()
+        db.session.add_all(
+            [Message(text=f"u1 msg {i}", user_id=u1.id,
+                     timestamp=now - timedelta(hours=i)) for i in range(3)] +
+            [Message(text=f"u2 msg {i}", user_id=u2.id,
+                     timestamp=now - timedelta(hours=i, minutes=30)) for i in range(3)] +
+            [Message(text="u3 msg", user_id=u3.id, timestamp=now)]
+        )
+        db.session.commit()
+
+
+    def test_feed(self):
+        """newest first, detached, one author object per user"""
+
+        messages = feed(self.ids[:2], limit=4)
+
+        self.assertEqual([m.text for m in messages],
+                         ["u1 msg 0", "u2 msg 0", "u1 msg 1", "u2 msg 1"])
+        self.assertTrue(all(isinstance(m, MessageView) for m in messages))
+        self.assertIs(messages[0].user, messages[2].user)
+        self.assertEqual(messages[1].user.username, "u2")
+        self.assertFalse(hasattr(messages[0], "__dict__"))
+
+        since = datetime.utcnow() - timedelta(minutes=45)
+        self.assertEqual(len(feed(self.ids[:2], since=since)), 2)
+
+
+    def test_user_messages_and_cards(self):
+        self.assertEqual([m.text for m in user_messages(self.ids[0])],
+                         ["u1 msg 0", "u1 msg 1", "u1 msg 2"])
+        self.assertEqual([m.text for m in user_messages(self.ids[0], limit=2)],
+                         ["u1 msg 0", "u1 msg 1"])
+
+        self.assertEqual(len(user_cards()), 3)
+        self.assertEqual([card.username for card in user_cards("u")],
+                         ["u1", "u2"])
+
+
+    def test_pages_render_views(self):
+        """profile, directory and homepage render from the views"""
+
+        u1, u2, _ = self.ids
+        db.session.add(Follow(user_following_id=u1, user_being_followed_id=u2))
+        msg = Message.query.filter_by(text="u2 msg 1").one()
+        db.session.add(Like(user_id=u1, message_id=msg.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1
+
+            resp = c.get(f"/users/{u2}")
+            self.assertIn("u2 msg 2", resp.text)
+            self.assertIn(f'action="/messages/{msg.id}/unlike"', resp.text)
+
+            resp = c.get("/users")
+            self.assertIn(f'action="/users/stop-following/{u2}"', resp.text)
+            self.assertIn("@other", resp.text)
+
+            resp = c.get("/")
+            self.assertIn("u2 msg 0", resp.text)
+            self.assertNotIn("u3 msg", resp.text)
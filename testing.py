@@ -0,0 +1,161 @@
+"""Shared setup for the Warbler test suite.
+
+Import the app through this module (``from testing import app, ...``); it is
+built once per process with the "testing" profile.
+
+- Each test runs inside an outer transaction that is rolled back afterwards,
+  so tests never need to delete rows and the schema is only built once.
+- bcrypt runs with the lowest cost factor (see ``config.TestingConfig``), so
+  ``User.signup`` is cheap.
+- The database comes from ``TEST_DATABASE_URL`` (default: in-memory SQLite).
+  Under ``pytest -n auto`` (pytest-xdist) each worker gets its own database,
+  e.g. ``postgresql:///warbler_test_gw0``, which is created if missing.
+
+    python -m unittest
+    TEST_DATABASE_URL=postgresql:///warbler_test pytest -n auto
+"""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_TEST_DATABASE_URL = "sqlite://"
+
+
+def worker_database_url(url, worker=None):
+    """Return `url` with the database renamed for this test worker.
+
+    In-memory SQLite is already private to each process, so it is returned
+    unchanged.
+    """
+
+    worker = worker or os.environ.get("PYTEST_XDIST_WORKER")
+    url = make_url(url)
+
+    if not worker or not url.database or url.database == ":memory:":
+        return url.render_as_string(hide_password=False)
+
+    if url.get_backend_name() == "sqlite":
+        root, ext = os.path.splitext(url.database)
+        database = f"{root}_{worker}{ext}"
+    else:
+        database = f"{url.database}_{worker}"
+
+    return url.set(database=database).render_as_string(hide_password=False)
+
+
+def ensure_database(url):
+    """Create the Postgres database at `url` if it doesn't exist yet."""
+
+    url = make_url(url)
+
+    if url.get_backend_name() != "postgresql":
+        return
+
+    admin = create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+
+    with admin.connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": url.database},
+        ).scalar()
+
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    admin.dispose()
+
+
+TEST_DATABASE_URL = worker_database_url(
+    os.environ.get("TEST_DATABASE_URL", DEFAULT_TEST_DATABASE_URL))
+
+ensure_database(TEST_DATABASE_URL)
+
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from models import db  # noqa: E402
+
+app = create_app("testing")
+
+
+def use_sqlite_savepoints(engine):
+    """Let pysqlite run real SAVEPOINTs (it otherwise manages BEGIN itself)."""
+
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        use_sqlite_savepoints(db.engine)
+
+_schema_ready = False
+
+
+def create_schema():
+    """Build the tables once per process."""
+
+    global _schema_ready
+
+    if _schema_ready:
+        return
+
+    # Only the default bind: other test apps may have registered extra bind
+    # keys (replicas, shards) on the shared ``db``.
+    with app.app_context():
+        db.metadata.drop_all(db.engine)
+        db.metadata.create_all(db.engine)
+
+    _schema_ready = True
+
+
+class DBTestCase(TestCase):
+    """TestCase whose database work is rolled back after every test.
+
+    ``db.session.commit()`` inside a test only releases a SAVEPOINT; the outer
+    transaction is discarded in tearDown.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        create_schema()
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        db.session.remove()
+        db.session.configure(
+            bind=self.connection,
+            join_transaction_mode="create_savepoint",
+        )
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.session.configure(
+            bind=None,
+            join_transaction_mode="conditional_savepoint",
+        )
+
+        self.transaction.rollback()
+        self.connection.close()
+
+        self.app_context.pop()
+
+
+__all__ = ["app", "db", "CURR_USER_KEY", "DBTestCase", "TEST_DATABASE_URL"]
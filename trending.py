@@ -0,0 +1,499 @@
+"""Trending messages: like counts over sliding windows, without scanning likes.
+
+``like_message()`` and ``unlike_message()`` feed every like into a
+TrendingAggregator. Each window is cut into a ring of time buckets (the
+hour into 5-minute buckets, the day into hourly ones) and each bucket
+counts likes per message in a Count-Min sketch (a ``depth`` x ``width``
+grid of counters), so its size is fixed no matter how many messages are
+liked. A message's count over a window is the sum of its estimates in the
+window's live buckets; windows slide one bucket at a time.
+
+Sketches only answer "how many likes does message m have?", so the
+aggregator also keeps a bounded set of heavy-hitter candidates: messages
+liked within the last day, trimmed back to the highest-count ones whenever
+it overflows. ``top()`` ranks those candidates by their windowed estimate.
+
+Count-Min never under-counts a like it has seen, and over-counts by at most
+``e / width`` of the bucket's total likes (with probability
+``1 - e^-depth``). With ``exact=True`` every bucket is a plain Counter
+instead, which is what the tests compare against.
+
+Like the timeline bus, the aggregator is per process: with several workers
+each one counts the likes it served. So each worker pickles its own state
+to ``TRENDING_CHECKPOINT_PATH.<pid>`` every ``TRENDING_CHECKPOINT_SECONDS``
+(and at exit). When a worker first handles a request, it adopts the
+checkpoints of workers that are gone and adds their counts to its own
+(sketches add cell by cell). Each checkpoint is claimed by exactly one
+worker, so after a restart no like is lost or counted twice.
+
+``/trending`` ranks from ``combined_trending()``: this worker's live counts
+plus the latest checkpoint of every other live worker, so every worker
+shows (to within a checkpoint interval) the same page with full counts.
+"""
+
+import atexit
+import glob
+import heapq
+import operator
+import os
+import pickle
+import re
+import threading
+import time
+from array import array
+from collections import Counter, deque
+
+from flask import current_app
+
+# name -> (length in seconds, number of buckets it is cut into)
+WINDOWS = {
+    "hour": (60 * 60, 12),
+    "day": (24 * 60 * 60, 24),
+}
+
+# A Mersenne prime larger than any message id, for the sketch's hash family.
+PRIME = (1 << 61) - 1
+
+
+class CountMinSketch:
+    """Fixed-size approximate counter of integer keys."""
+
+    def __init__(self, width=2048, depth=4, seed=0x5EED):
+        self.width = width
+        self.depth = depth
+        self.counts = array("i", [0]) * (width * depth)
+
+        # Pairwise-independent hashes h(x) = ((a * x + b) mod p) mod width.
+        self._salts = [
+            ((seed * (2 * i + 1) * 0x9E3779B97F4A7C15) % PRIME or 1,
+             (seed * (2 * i + 2) * 0xC2B2AE3D27D4EB4F) % PRIME)
+            for i in range(depth)
+        ]
+
+    def _cells(self, key):
+        width = self.width
+        return [row * width + (a * key + b) % PRIME % width
+                for row, (a, b) in enumerate(self._salts)]
+
+    def add(self, key, count=1):
+        for cell in self._cells(key):
+            self.counts[cell] += count
+
+    def __getitem__(self, key):
+        return max(0, min(self.counts[cell] for cell in self._cells(key)))
+
+    def merge(self, other):
+        """Add `other`'s counts (same width, depth and seed) to these."""
+
+        self.counts = array("i", map(operator.add, self.counts, other.counts))
+
+
+class ExactCounter(Counter):
+    """Exact stand-in for CountMinSketch (same ``add``/``[]``/``merge``
+    interface)."""
+
+    def add(self, key, count=1):
+        self[key] += count
+
+    def merge(self, other):
+        self.update(other)
+
+
+class TrendingAggregator:
+    """Sliding-window like counts with a bounded heavy-hitter candidate set."""
+
+    def __init__(self, width=2048, depth=4, candidates=1000, exact=False,
+                 cache_seconds=10, clock=time.time):
+        self.width = width
+        self.depth = depth
+        self.max_candidates = candidates
+        self.exact = exact
+        self.cache_seconds = cache_seconds
+        self.clock = clock
+
+        # window -> deque of (bucket number, counter), oldest first
+        self._buckets = {
+            name: deque(maxlen=slots) for name, (_, slots) in WINDOWS.items()
+        }
+        self._candidates = {}   # message id -> time of its last like
+        self._top_cache = {}    # (window, k) -> (computed at, result)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket_seconds(window):
+        seconds, slots = WINDOWS[window]
+        return seconds // slots
+
+    def _new_counter(self):
+        if self.exact:
+            return ExactCounter()
+
+        return CountMinSketch(self.width, self.depth)
+
+    def _live_counters(self, window, now):
+        """Counters for the buckets of `window` that still cover `now`."""
+
+        number = int(now // self._bucket_seconds(window))
+        first = number - WINDOWS[window][1] + 1
+
+        return [c for n, c in self._buckets[window] if n >= first]
+
+    def record(self, message_id, count=1):
+        """Count a like (`count=1`) or an unlike (`count=-1`) of `message_id`."""
+
+        with self._lock:
+            now = self.clock()
+
+            for window, buckets in self._buckets.items():
+                number = int(now // self._bucket_seconds(window))
+
+                if not buckets or buckets[-1][0] != number:
+                    buckets.append((number, self._new_counter()))
+
+                buckets[-1][1].add(message_id, count)
+
+            if count > 0:
+                self._candidates[message_id] = now
+
+                # Evict in batches, so the cost is spread over many likes.
+                if len(self._candidates) > self.max_candidates * 5 // 4:
+                    self._evict(now)
+
+    def _evict(self, now):
+        """Shrink the candidate set to its limit, keeping the highest counts
+        over the longest window."""
+
+        longest = max(WINDOWS, key=lambda w: WINDOWS[w][0])
+        counters = self._live_counters(longest, now)
+        cutoff = now - WINDOWS[longest][0]
+
+        live = [m for m, last in self._candidates.items() if last > cutoff]
+        keep = heapq.nlargest(self.max_candidates, live,
+                              key=lambda m: self._estimate(m, counters))
+
+        self._candidates = {m: self._candidates[m] for m in keep}
+
+    @staticmethod
+    def _estimate(message_id, counters):
+        return max(0, sum(counter[message_id] for counter in counters))
+
+    def count(self, message_id, window="hour"):
+        """Estimated likes of `message_id` within `window`."""
+
+        with self._lock:
+            counters = self._live_counters(window, self.clock())
+            return self._estimate(message_id, counters)
+
+    def top(self, window="hour", k=20):
+        """The `k` most-liked messages in `window`, as (message id, count).
+
+        Results are cached for ``cache_seconds``.
+        """
+
+        with self._lock:
+            now = self.clock()
+            cached = self._top_cache.get((window, k))
+
+            if cached and now - cached[0] < self.cache_seconds:
+                return cached[1]
+
+            counters = self._live_counters(window, now)
+            cutoff = now - WINDOWS[window][0]
+
+            # Ties go to the older (lower id) message.
+            best = heapq.nlargest(k, (
+                (self._estimate(message_id, counters), -message_id)
+                for message_id, last in self._candidates.items()
+                if last > cutoff
+            ))
+            result = [(-m, count) for count, m in best if count > 0]
+            self._top_cache[(window, k)] = (now, result)
+
+        return result
+
+    def forget(self, message_id):
+        """Stop ranking a deleted message (its sketch counts just age out)."""
+
+        with self._lock:
+            self._candidates.pop(message_id, None)
+            self._top_cache.clear()
+
+    ##########################################################################
+    # Checkpoints
+
+    def dumps(self):
+        """The aggregator's state, pickled (see ``loads``)."""
+
+        with self._lock:
+            return pickle.dumps({
+                "settings": self._settings(),
+                "buckets": {w: list(b) for w, b in self._buckets.items()},
+                "candidates": self._candidates,
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def save(self, path):
+        """Write the aggregator's state to `path` atomically."""
+
+        data = self.dumps()
+        tmp_path = f"{path}.tmp{os.getpid()}"
+
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Add the counts saved by ``save`` at `path` to this aggregator's
+        (into an empty one, that restores it). Ignored if the settings
+        changed."""
+
+        with open(path, "rb") as f:
+            return self.loads(f.read())
+
+    def loads(self, data):
+        """Add the counts pickled by ``dumps`` to this aggregator's."""
+
+        state = pickle.loads(data)
+
+        if state["settings"] != self._settings():
+            return False
+
+        with self._lock:
+            for window, buckets in self._buckets.items():
+                merged = dict(buckets)
+
+                for number, counter in state["buckets"][window]:
+                    if number in merged:
+                        merged[number].merge(counter)
+                    else:
+                        merged[number] = counter
+
+                buckets.clear()
+                buckets.extend(sorted(merged.items(), key=lambda b: b[0]))
+
+            for message_id, last in state["candidates"].items():
+                self._candidates[message_id] = max(
+                    last, self._candidates.get(message_id, last))
+
+            if len(self._candidates) > self.max_candidates:
+                self._evict(self.clock())
+
+            self._top_cache.clear()
+
+        return True
+
+    def empty_copy(self):
+        """A new, empty aggregator with the same settings."""
+
+        return TrendingAggregator(
+            self.width, self.depth, self.max_candidates, self.exact,
+            self.cache_seconds, self.clock)
+
+    def reset(self):
+        """Forget every count."""
+
+        with self._lock:
+            for buckets in self._buckets.values():
+                buckets.clear()
+
+            self._candidates = {}
+            self._top_cache.clear()
+
+    def _settings(self):
+        return (WINDOWS, self.exact, self.width, self.depth)
+
+
+##############################################################################
+# Flask integration
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _worker_checkpoints(path):
+    """(file name, pid) of each ``<path>.<pid>`` checkpoint."""
+
+    pattern = re.compile(re.escape(path) + r"\.(\d+)$")
+
+    for name in glob.glob(f"{glob.escape(path)}.*"):
+        match = pattern.match(name)
+
+        if match:
+            yield name, int(match.group(1))
+
+
+def orphaned_checkpoints(path):
+    """Checkpoints under `path` whose worker is gone (or is a previous life
+    of this process's pid). A plain `path` from before per-worker files is
+    included."""
+
+    found = [path] if os.path.exists(path) else []
+
+    for name, pid in _worker_checkpoints(path):
+        if pid == os.getpid() or not _alive(pid):
+            found.append(name)
+
+    return found
+
+
+def live_checkpoints(path):
+    """Checkpoints under `path` saved by other workers that are running."""
+
+    return [name for name, pid in _worker_checkpoints(path)
+            if pid != os.getpid() and _alive(pid)]
+
+
+class Checkpointer:
+    """Saves this worker's aggregator to ``<path>.<pid>`` every `seconds`,
+    piggybacking on ``record`` calls."""
+
+    def __init__(self, aggregator, path, seconds=60):
+        self.aggregator = aggregator
+        self.path = path
+        self.seconds = seconds
+        self._saved_at = time.monotonic()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._combined = None
+        self._combined_at = 0
+
+    def start(self):
+        """Adopt orphaned checkpoints, once per process.
+
+        Runs on first use rather than in ``init_trending``, which under
+        ``gunicorn --preload`` runs in the master: every worker would
+        inherit (and later save) the same counts.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            pid = self._pid = os.getpid()
+            self.aggregator.reset()
+            self._saved_at = time.monotonic()
+            adopted = []
+
+            for orphan in orphaned_checkpoints(self.path):
+                # The rename is the claim: only one worker can win it.
+                claim = f"{orphan}.claim{pid}"
+
+                try:
+                    os.rename(orphan, claim)
+                except FileNotFoundError:
+                    continue
+
+                self.aggregator.load(claim)
+                adopted.append(claim)
+
+            if adopted:
+                self.save()
+
+                for claim in adopted:
+                    os.remove(claim)
+
+    def combined(self):
+        """This worker's counts plus every other live worker's last
+        checkpoint, in a new aggregator. Rebuilt at most every
+        ``cache_seconds``."""
+
+        aggregator = self.aggregator
+        now = time.monotonic()
+        cached = self._combined
+
+        if cached is not None and now - self._combined_at < aggregator.cache_seconds:
+            return cached
+
+        combined = aggregator.empty_copy()
+        combined.loads(aggregator.dumps())
+
+        for path in live_checkpoints(self.path):
+            try:
+                combined.load(path)
+            except FileNotFoundError:
+                # That worker exited (and its file was adopted) meanwhile.
+                continue
+
+        self._combined, self._combined_at = combined, now
+
+        return combined
+
+    def maybe_save(self):
+        now = time.monotonic()
+
+        if now - self._saved_at >= self.seconds:
+            self._saved_at = now
+            self.save()
+
+    def save(self):
+        # Nothing to save in a process that never served (e.g. the master).
+        if self._pid == os.getpid():
+            self.aggregator.save(f"{self.path}.{self._pid}")
+
+
+def init_trending(app):
+    """Attach a TrendingAggregator (restored from its checkpoint) to `app`."""
+
+    aggregator = TrendingAggregator(
+        width=app.config.get("TRENDING_SKETCH_WIDTH", 2048),
+        depth=app.config.get("TRENDING_SKETCH_DEPTH", 4),
+        candidates=app.config.get("TRENDING_CANDIDATES", 1000),
+        exact=app.config.get("TRENDING_EXACT", False),
+        cache_seconds=app.config.get("TRENDING_CACHE_SECONDS", 10),
+    )
+    app.extensions["trending"] = aggregator
+
+    path = app.config.get("TRENDING_CHECKPOINT_PATH")
+
+    if path:
+        checkpointer = Checkpointer(
+            aggregator, path, app.config.get("TRENDING_CHECKPOINT_SECONDS", 60))
+        app.extensions["trending_checkpointer"] = checkpointer
+        atexit.register(checkpointer.save)
+
+
+def current_trending():
+    """The current app's TrendingAggregator."""
+
+    checkpointer = current_app.extensions.get("trending_checkpointer")
+
+    if checkpointer:
+        checkpointer.start()
+
+    return current_app.extensions["trending"]
+
+
+def combined_trending():
+    """The aggregator to rank from: every live worker's counts merged (see
+    ``Checkpointer.combined``), or just this process's without
+    checkpoints."""
+
+    checkpointer = current_app.extensions.get("trending_checkpointer")
+
+    if checkpointer:
+        checkpointer.start()
+        return checkpointer.combined()
+
+    return current_app.extensions["trending"]
+
+
+def record_like(message_id, count=1):
+    """Feed a committed like (or unlike, `count=-1`) to the aggregator."""
+
+    current_trending().record(message_id, count)
+
+    checkpointer = current_app.extensions.get("trending_checkpointer")
+
+    if checkpointer:
+        checkpointer.maybe_save()
@@ -0,0 +1,224 @@
+"""Read-only view models for list pages.
+
+The homepage, profile, likes and user directory render long lists. Loading
+them as ORM instances costs an instance state, identity-map entry and
+lazy-loader bookkeeping per row, plus every column (``password``, ``bio``,
+...) whether the template uses it or not. These functions select just the
+rendered columns into small ``__slots__`` objects that are never attached to
+the session. Each author is built once per page and shared by their
+messages.
+
+The objects have the same attribute names as the models, so templates work
+with either, and they pickle, so they can be cached (see cache.py). See
+``bench_views.py`` for the memory comparison.
+"""
+
+from sqlalchemy import func, select
+
+from models import db, User, Message, Follow, Like
+
+
+class AuthorView:
+    """The parts of a ``User`` shown next to a message."""
+
+    __slots__ = ("id", "username", "image_url")
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class UserCardView:
+    """The parts of a ``User`` shown on a directory card."""
+
+    __slots__ = ("id", "username", "image_url", "header_image_url", "bio")
+
+    def __init__(self, id, username, image_url, header_image_url, bio):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+
+
+class ProfileView:
+    """A user's profile header: their details and counts."""
+
+    __slots__ = ("id", "username", "image_url", "bio", "location",
+                 "messages_count", "following_count", "followers_count",
+                 "likes_count")
+
+    def __init__(self, user):
+        for name in self.__slots__:
+            setattr(self, name, getattr(user, name))
+
+
+class MessageView:
+    """A message in a list, shaped like ``Message`` for templates."""
+
+    __slots__ = ("id", "text", "timestamp", "user_id", "user")
+
+    def __init__(self, id, text, timestamp, user_id, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.user = user
+
+
+class SuggestionView:
+    """A "who to follow" entry, shaped like ``Recommendation`` for templates."""
+
+    __slots__ = ("candidate",)
+
+    def __init__(self, recommendation):
+        candidate = recommendation.candidate
+        self.candidate = AuthorView(candidate.id, candidate.username,
+                                    candidate.image_url)
+
+
+def detach(messages):
+    """MessageViews for any Message-shaped objects (e.g. a shard's
+    ``FeedMessage``s), so they can be cached."""
+
+    authors = {}
+    views = []
+
+    for msg in messages:
+        author = authors.get(msg.user_id)
+
+        if author is None:
+            author = authors[msg.user_id] = AuthorView(
+                msg.user.id, msg.user.username, msg.user.image_url)
+
+        views.append(MessageView(msg.id, msg.text, msg.timestamp, msg.user_id,
+                                 author))
+
+    return views
+
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id,
+                   User.username, User.image_url)
+
+
+def iter_message_views(rows):
+    """MessageViews for rows of ``MESSAGE_COLUMNS`` (plus anything after),
+    built as `rows` is iterated."""
+
+    authors = {}
+
+    for id, text, timestamp, user_id, username, image_url, *_ in rows:
+        author = authors.get(user_id)
+
+        if author is None:
+            author = authors[user_id] = AuthorView(user_id, username, image_url)
+
+        yield MessageView(id, text, timestamp, user_id, author)
+
+
+def message_views(rows):
+    """MessageViews for rows of ``MESSAGE_COLUMNS`` (plus anything after)."""
+
+    return list(iter_message_views(rows))
+
+
+def feed_query(user_ids, limit=100, since=None):
+    """Select ``MESSAGE_COLUMNS`` for the newest `limit` messages by any of
+    `user_ids` (not before `since`)."""
+
+    stmt = (
+        select(*MESSAGE_COLUMNS)
+        .join(User, User.id == Message.user_id)
+        .where(Message.user_id.in_(user_ids))
+        .order_by(Message.timestamp.desc())
+        .limit(limit)
+    )
+
+    if since:
+        stmt = stmt.where(Message.timestamp >= since)
+
+    return stmt
+
+
+def feed(user_ids, limit=100, since=None):
+    """Newest `limit` messages by any of `user_ids` (not before `since`)."""
+
+    return message_views(db.session.execute(feed_query(user_ids, limit, since)))
+
+
+def user_messages_query(user_id, limit=100):
+    """Select ``MESSAGE_COLUMNS`` for `user_id`'s newest `limit` messages."""
+
+    return (
+        select(*MESSAGE_COLUMNS)
+        .join(User, User.id == Message.user_id)
+        .where(Message.user_id == user_id)
+        .order_by(Message.timestamp.desc())
+        .limit(limit)
+    )
+
+
+def user_messages(user_id, limit=100):
+    """`user_id`'s newest `limit` messages, newest first."""
+
+    return message_views(
+        db.session.execute(user_messages_query(user_id, limit)))
+
+
+def message_query(message_id):
+    """Select ``MESSAGE_COLUMNS`` for `message_id`."""
+
+    return (
+        select(*MESSAGE_COLUMNS)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id)
+    )
+
+
+def message(message_id):
+    """The MessageView for `message_id`, or None."""
+
+    views = message_views(db.session.execute(message_query(message_id)))
+    return views[0] if views else None
+
+
+def _count(column):
+    return select(func.count()).where(column == User.id).scalar_subquery()
+
+
+def profile_query(user_id):
+    """Select `user_id`'s ProfileView fields (and header image), counts
+    included, as one row."""
+
+    return (
+        select(User.id, User.username, User.image_url, User.header_image_url,
+               User.bio, User.location,
+               _count(Message.user_id).label("messages_count"),
+               _count(Follow.user_following_id).label("following_count"),
+               _count(Follow.user_being_followed_id).label("followers_count"),
+               _count(Like.user_id).label("likes_count"))
+        .where(User.id == user_id)
+    )
+
+
+def iter_user_cards(search=None, yield_per=500):
+    """Directory cards for every user, or those whose username has `search`,
+    read `yield_per` rows at a time off a server-side cursor."""
+
+    stmt = select(User.id, User.username, User.image_url,
+                  User.header_image_url, User.bio)
+
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+
+    result = db.session.execute(stmt.execution_options(yield_per=yield_per))
+
+    for row in result:
+        yield UserCardView(*row)
+
+
+def user_cards(search=None):
+    """Directory cards for every user, or those whose username has `search`."""
+
+    return list(iter_user_cards(search))
@@ -0,0 +1,22 @@
+"""WSGI entry point.
+
+    WARBLER_ENV=production gunicorn wsgi:app --preload
+
+With ``--preload`` the app (and its template cache) is built once in the
+gunicorn master; each worker discards the inherited connection pool after
+forking (see ``models.dispose_engines_after_fork``).
+
+The live timeline (``STREAM_ENABLED=1``) keeps one connection open per
+homepage tab, which would take a sync worker out of service each. Turn it on
+only with threaded workers, sized for the open tabs, e.g.
+
+    STREAM_ENABLED=1 WARBLER_ENV=production \
+        gunicorn wsgi:app --preload --worker-class gthread --threads 64
+
+Streams are closed after ``STREAM_MAX_SECONDS``; the browser reconnects with
+Last-Event-ID and is caught up from the bus.
+"""
+
+from app import create_app
+
+app = create_app()